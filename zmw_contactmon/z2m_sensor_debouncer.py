@@ -19,7 +19,8 @@ class Z2mContactSensorDebouncer:
         self._actions_on_sensor_change = actions_on_sensor_change
         self._z2m = Z2MProxy(cfg, mqtt, scheduler,
                              cb_on_z2m_network_discovery=self._on_z2m_network,
-                             cb_is_device_interesting=lambda t: 'contact' in t.actions.keys())
+                             cb_is_device_interesting=lambda t: 'contact' in t.actions.keys(),
+                             selective_subscriptions=True)
 
     def get_sensors_state(self):
         """ Return most recent state for each sensor as known by this service """
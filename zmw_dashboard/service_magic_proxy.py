@@ -1,5 +1,6 @@
 """ Forward requests from a Flask http server to arbitrary downstream http services """
 import aiohttp
+import asyncio
 import os
 import signal
 import ssl
@@ -10,6 +11,66 @@ from zzmw_lib.logs import build_logger
 
 log = build_logger("ServiceMagicProxy")
 
+_HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers',
+                       'transfer-encoding', 'upgrade'}
+# Bodies are streamed, so a long response (eg a big CSV export) only times out if the upstream stalls. Event streams
+# stay open for as long as the client is subscribed: they only time out if the upstream doesn't accept the connection.
+_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=5, sock_read=5)
+_EVENT_STREAM_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=5)
+
+
+def _is_event_stream(content_type):
+    return content_type is not None and content_type.split(';')[0].strip() == 'text/event-stream'
+
+
+class _UpstreamRequest:
+    """ A request to an upstream service, running in its own event loop so that its body can still be read after
+    the Flask handler returned, while the response is streamed to the client """
+
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._session = None
+        self._resp = None
+
+    def _run(self, coro):
+        return self._loop.run_until_complete(coro)
+
+    def send(self, method, url, **kwargs):
+        """ Send the request, and return the response once its headers are received """
+        async def _send():
+            # Create SSL context that accepts self-signed certificates
+            ssl_context = ssl.create_default_context()
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+            connector = aiohttp.TCPConnector(ssl=ssl_context)
+            # Forward compressed bodies as they are, together with their Content-Encoding header
+            self._session = aiohttp.ClientSession(connector=connector, auto_decompress=False)
+            self._resp = await self._session.request(method, url, **kwargs)
+            return self._resp
+        return self._run(_send())
+
+    def iter_body(self):
+        """ Yield the body as it arrives """
+        try:
+            while True:
+                chunk = self._run(self._resp.content.readany())
+                if not chunk:
+                    return
+                yield chunk
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.warning("Upstream stream from %s ended: %s", self._resp.url, str(e))
+        finally:
+            self.close()
+
+    def close(self):
+        if self._loop.is_closed():
+            return
+        if self._resp is not None:
+            self._resp.release()
+        if self._session is not None:
+            self._run(self._session.close())
+        self._loop.close()
+
 class ServiceMagicProxy:
     """ Proxy forwarder: will forward request from a local flask server to another http server based on
     service prefix """
@@ -49,19 +110,16 @@ class ServiceMagicProxy:
             # Register catch-all route for this service
             route = f'/{svc_prefix}/<path:subpath>'
 
-            # Create wrapper that properly handles async
             # We need a closure to capture the svc_prefix value
             def make_handler(prefix):
-                # Use www.serve_url style registration which handles async
-                async def handler(subpath):
-                    return await self._forward_to_service(prefix, subpath)
+                def handler(subpath):
+                    return self._forward_to_service(prefix, subpath)
                 # Set the function name for Flask
                 handler.__name__ = f'proxy_{prefix}'
                 return handler
 
             handler_func = make_handler(svc_prefix)
 
-            # Register using Flask's route decorator syntax which handles async properly
             www.route(
                 route,
                 methods=['GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'HEAD', 'OPTIONS'],
@@ -69,7 +127,7 @@ class ServiceMagicProxy:
             )(handler_func)
             log.info("Registered proxy route: %s -> %s", route, svc_route)
 
-    async def _forward_to_service(self, svc_prefix, subpath):
+    def _forward_to_service(self, svc_prefix, subpath):
         """Generic proxy handler that forwards requests to upstream services."""
         if svc_prefix not in self._service_map:
             log.error("Unknown service prefix: %s", svc_prefix)
@@ -84,56 +142,37 @@ class ServiceMagicProxy:
 
         log.debug("Proxying %s %s -> %s", request.method, request.path, target_url)
 
+        # Prepare request kwargs
+        kwargs = {
+            'timeout': _EVENT_STREAM_TIMEOUT if _is_event_stream(request.headers.get('Accept')) else _TIMEOUT,
+            'allow_redirects': False,
+        }
+        # Forward request headers (excluding hop-by-hop headers)
+        kwargs['headers'] = {key: value for key, value in request.headers if key.lower() not in _HOP_BY_HOP_HEADERS}
+        # Forward request body for methods that support it
+        if request.method in ['POST', 'PUT', 'PATCH']:
+            data = request.get_data()
+            if data:
+                kwargs['data'] = data
+
+        upstream = _UpstreamRequest()
         try:
-            # Create SSL context that accepts self-signed certificates
-            ssl_context = ssl.create_default_context()
-            ssl_context.check_hostname = False
-            ssl_context.verify_mode = ssl.CERT_NONE
-
-            connector = aiohttp.TCPConnector(ssl=ssl_context)
-            async with aiohttp.ClientSession(connector=connector) as session:
-                # Prepare request kwargs
-                kwargs = {
-                    'timeout': aiohttp.ClientTimeout(total=5),
-                    'allow_redirects': False,
-                }
-
-                # Forward request headers (excluding hop-by-hop headers)
-                headers = {}
-                hop_by_hop = {'connection', 'keep-alive', 'proxy-authenticate',
-                             'proxy-authorization', 'te', 'trailers', 'transfer-encoding', 'upgrade'}
-                for key, value in request.headers:
-                    if key.lower() not in hop_by_hop:
-                        headers[key] = value
-                kwargs['headers'] = headers
-
-                # Forward request body for methods that support it
-                if request.method in ['POST', 'PUT', 'PATCH']:
-                    data = request.get_data()
-                    if data:
-                        kwargs['data'] = data
-
-                # Make the request
-                async with session.request(request.method, target_url, **kwargs) as resp:
-                    # Read response body
-                    body = await resp.read()
-
-                    # Forward response headers (excluding hop-by-hop headers)
-                    response_headers = {}
-                    for key, value in resp.headers.items():
-                        if key.lower() not in hop_by_hop:
-                            response_headers[key] = value
-
-                    # Create Flask response with upstream status code and headers
-                    return Response(
-                        body,
-                        status=resp.status,
-                        headers=response_headers
-                    )
+            resp = upstream.send(request.method, target_url, **kwargs)
+            # Forward response headers (excluding hop-by-hop headers)
+            response_headers = {key: value for key, value in resp.headers.items()
+                                if key.lower() not in _HOP_BY_HOP_HEADERS}
+            # The body is passed on as it arrives (for event streams, for as long as the client stays connected).
+            # If the client goes away before the first chunk, the body is never iterated: close when the response
+            # is closed, too
+            proxied = Response(upstream.iter_body(), status=resp.status, headers=response_headers)
+            proxied.call_on_close(upstream.close)
+            return proxied
 
         except aiohttp.ClientError as e:
+            upstream.close()
             log.error("Error proxying to %s: %s", target_url, str(e))
             return abort(502, f"Error connecting to upstream service: {str(e)}")
         except Exception as e:  # pylint: disable=broad-exception-caught
+            upstream.close()
             log.error("Unexpected error proxying to %s: %s", target_url, str(e), exc_info=True)
             return abort(500, f"Internal proxy error: {str(e)}")
@@ -74,6 +74,7 @@ class ZmwDashboard(ZmwMqttServiceMonitor):
         log.info("Proxy routes registered, starting dashboard www")
         self._www.serve_url('/get_proxied_services', self._svc_proxy.get_proxied_services)
         self._www.serve_url('/get_user_defined_links', self._get_user_defined_links)
+        self._www.serve_url('/svc_metrics_all', self.get_services_metrics)
         self._www.setup_complete()
 
     def _get_user_defined_links(self):
@@ -105,6 +106,33 @@ class ZmwDashboard(ZmwMqttServiceMonitor):
                     alerts.append(f"{svc_name}: {alert}")
         return alerts
 
+    def _fetch_service_metrics(self, svc_name, svc_url):
+        """Fetch the metrics of a single service, or None if the service doesn't respond."""
+        try:
+            resp = requests.get(f"{svc_url}/svc_metrics", params={'format': 'json'}, timeout=2, verify=False)
+            if resp.status_code == 200:
+                return svc_name, resp.json()
+        except Exception:  # pylint: disable=broad-exception-caught
+            log.debug("Failed to get metrics from %s", svc_name, exc_info=True)
+        return svc_name, None
+
+    def get_services_metrics(self):
+        """Metrics of all proxied services (and of the dashboard itself), as {service name: metrics}. Services that
+        don't respond are reported as null."""
+        metrics = {"ZmwDashboard": self._www.metrics.as_json()}
+        # Aliased services are proxied twice, only fetch each url once
+        services = {}
+        for name, url in self._svc_proxy.get_proxied_services().items():
+            services.setdefault(url, name)
+        if not services:
+            return metrics
+        with ThreadPoolExecutor(max_workers=len(services)) as executor:
+            futures = [executor.submit(self._fetch_service_metrics, name, url) for url, name in services.items()]
+            for future in as_completed(futures):
+                svc_name, svc_metrics = future.result()
+                metrics[svc_name] = svc_metrics
+        return metrics
+
     def on_startup_fail_missing_deps(self, deps):
         log.critical("Some dependencies are missing, functionality may be broken in the dashboard: %s", deps)
         # Try to continue with whatever deps we have
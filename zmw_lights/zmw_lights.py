@@ -29,7 +29,9 @@ class ZmwLights(ZmwMqttNullSvc):
         self._z2m = Z2MProxy(cfg, self, sched,
                              cb_on_z2m_network_discovery=self._on_z2m_network_discovery,
                              cb_is_device_interesting=lambda t: t.thing_type in ('light', 'switch'))
-        self._z2mw = Z2Mwebservice(www, self._z2m)
+        # Brightness sliders send a stream of sets while dragged; only send the latest one every so often
+        self._z2mw = Z2Mwebservice(www, self._z2m,
+                                   set_coalesce_window_secs=cfg.get('z2m_set_coalesce_window_secs', 0.2))
 
 
     def _on_z2m_network_discovery(self, is_first_discovery, known_things):
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+One-shot migration of a sensors db from the table-per-sensor layout to the narrow layout (see NarrowStorage).
+
+    python3 migrate_to_narrow_storage.py old_sensors.sqlite new_sensors.sqlite
+
+The old db is only read. Stop the service before migrating, or readings saved during the migration will be missing
+from the new db. Once done, point db_path to the new db and set "db_storage": "narrow".
+
+Samples without a sample_time are skipped. Samples of the same sensor in the same second keep their order.
+Rollups are copied as they are. After copying, the history of each sensor is read back from both dbs and compared.
+"""
+
+import sqlite3
+import sys
+import time
+
+from narrow_storage import NarrowStorage
+from sensor_rollups import ROLLUP_TABLES, create_rollup_tables
+from sensors import _WideTablesStorage, _get_known_sensors, _get_sensor_metrics
+
+# Readings written per transaction
+_BATCH_ROWS = 10000
+
+
+def _copy_sensor(src, dst, storage, sensor_name):
+    """ Copy all samples of a sensor, returns (samples copied, samples skipped) """
+    metrics = _get_sensor_metrics(src, sensor_name)
+    storage.update_schema(dst, sensor_name, metrics)
+    skipped = src.execute(f'SELECT count(*) FROM {sensor_name} WHERE sample_time IS NULL').fetchone()[0]
+    res = src.execute(f"SELECT CAST(strftime('%s', sample_time) AS INTEGER), {', '.join(metrics)} "
+                      f'FROM {sensor_name} WHERE sample_time IS NOT NULL ORDER BY sample_time, rowid')
+    copied = 0
+    for row in res:
+        # Readings in the same second get consecutive ms, so they keep the order they were saved in
+        storage.insert(dst, sensor_name, metrics, list(row[1:]), row[0])
+        copied += 1
+        if copied % _BATCH_ROWS == 0:
+            dst.commit()
+    dst.commit()
+    return copied, skipped
+
+
+def _copy_rollups(src, dst, storage, schema):
+    existing = {name for (name,) in src.execute("SELECT name FROM sqlite_schema WHERE type = 'table'").fetchall()}
+    if ROLLUP_TABLES.issubset(existing):
+        create_rollup_tables(dst, {})
+        for table in sorted(ROLLUP_TABLES):
+            dst.execute(f'INSERT INTO main.{table} SELECT * FROM src.{table}')
+        print('Copied rollups')
+    else:
+        # Built from the samples just copied
+        create_rollup_tables(dst, {(s, m): storage.rollup_source(s, m) for s, metrics in schema.items()
+                                   for m in metrics})
+        print('Old db has no rollups, created them from the samples')
+    dst.commit()
+
+
+def _verify(src, dst, storage, schema):
+    """ Compare the history of every sensor in both layouts, returns the sensors that differ """
+    wide = _WideTablesStorage()
+    differ = []
+    for sensor_name, metrics in schema.items():
+        old = [row for row in wide.all_metrics_history(src, sensor_name, metrics) if row[0] is not None]
+        new = storage.all_metrics_history(dst, sensor_name, metrics)
+        if old != new:
+            differ.append(sensor_name)
+    return differ
+
+
+def migrate(src_path, dst_path):
+    src = sqlite3.connect(f'file:{src_path}?mode=ro', uri=True)
+    dst = sqlite3.connect(dst_path)
+    if dst.execute("SELECT count(*) FROM sqlite_schema WHERE type = 'table'").fetchone()[0] > 0:
+        print(f'{dst_path} is not empty, refusing to migrate into it')
+        return False
+    dst.execute('PRAGMA journal_mode=WAL')
+    # Rollups are copied with plain SQL
+    dst.execute('ATTACH DATABASE ? AS src', (src_path,))
+
+    storage = NarrowStorage()
+    storage.load_schema(dst)
+    t_start = time.monotonic()
+    for sensor_name in _get_known_sensors(src):
+        copied, skipped = _copy_sensor(src, dst, storage, sensor_name)
+        skipped_msg = f', skipped {skipped} without sample_time' if skipped > 0 else ''
+        print(f'{sensor_name}: copied {copied} samples{skipped_msg}')
+
+    schema = storage.load_schema(dst)
+    _copy_rollups(src, dst, storage, schema)
+    dst.execute('DETACH DATABASE src')
+    print(f'Copied {len(schema)} sensors in {time.monotonic() - t_start:.1f} seconds')
+
+    differ = _verify(src, dst, storage, schema)
+    if len(differ) > 0:
+        print(f'History of {differ} differs between the old and the new db!')
+        return False
+    print('History of all sensors matches the old db')
+    return True
+
+
+def main():
+    if len(sys.argv) != 3:
+        print(f'Usage: {sys.argv[0]} old_sensors.sqlite new_sensors.sqlite')
+        sys.exit(1)
+    sys.exit(0 if migrate(sys.argv[1], sys.argv[2]) else 1)
+
+
+if __name__ == "__main__":
+    main()
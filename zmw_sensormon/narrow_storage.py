@@ -0,0 +1,218 @@
+""" Sensor history storage with all samples in a single narrow table, instead of a table per sensor """
+
+import logging
+import threading
+log = logging.getLogger(__name__)
+
+# Tables used by this layout. A db with any of these is in the narrow layout.
+NARROW_TABLES = frozenset(('_sensors', '_metrics', '_series', '_samples'))
+
+
+def _since_ms(conn, unit, time):
+    """ First ts (in ms) that is after `time` `unit`s ago, rounded the same way as comparing a 'YYYY-MM-DD HH:MM:SS'
+    sample_time with datetime('now', ...), so both layouts return the same samples """
+    return conn.execute("SELECT (CAST(strftime('%s', 'now', ?) AS INTEGER) + 1) * 1000",
+                        (f'-{int(time)} {unit}',)).fetchone()[0]
+
+
+def _placeholders(vals):
+    return ', '.join('?' * len(vals))
+
+
+class NarrowStorage:
+    """
+    Keeps every sample in one table keyed by (series_id, ts), clustered on that key (WITHOUT ROWID), so that reading
+    the history of a metric is a range scan. A series is a (sensor, metric) pair; sensor and metric names are interned
+    in their own tables, and ts is an integer epoch in milliseconds. New sensors or metrics are just new rows, and
+    missing values take no space.
+
+    A reading of a sensor is the set of samples of its series with the same ts. To keep readings apart, ts is unique
+    per sensor: a reading in the same millisecond as another one is moved to the next free millisecond. A reading
+    older than the previous one (eg the clock went back) keeps its own time, so it's sorted the same way as in the
+    table-per-sensor layout. Samples are returned with second resolution, in the same format (and order) as the
+    table-per-sensor layout.
+
+    Ids are cached in memory: they are only changed from the writer thread, but read from any thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sensor_ids = {}
+        self._metric_ids = {}
+        # Sensor -> {metric: series_id}, in the order its metrics were added
+        self._sensor_series = {}
+        # Sensor -> latest ts of its readings. Only used from the writer thread.
+        self._last_ts = {}
+        # Sensors whose last reading was older than a previous one. Only used from the writer thread.
+        self._clock_went_back = set()
+
+    def load_schema(self, conn):
+        """ Create the tables if needed, and return the metrics of each sensor ({sensor: [metrics]}) """
+        tables = {name for (name,) in conn.execute("SELECT name FROM sqlite_schema WHERE type = 'table'").fetchall()}
+        foreign = [t for t in tables if t not in NARROW_TABLES and not t.startswith('_rollup_')
+                   and not t.startswith('sqlite_')]
+        if len(foreign) > 0:
+            raise ValueError(f"Sensors db has tables {sorted(foreign)}, which aren't part of the narrow layout. "
+                             "Is it a table-per-sensor db? It needs to be migrated first.")
+
+        conn.execute('CREATE TABLE IF NOT EXISTS _sensors (sensor_id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)')
+        conn.execute('CREATE TABLE IF NOT EXISTS _metrics (metric_id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS _series ('
+            '  series_id INTEGER PRIMARY KEY,'
+            '  sensor_id INTEGER NOT NULL REFERENCES _sensors (sensor_id),'
+            '  metric_id INTEGER NOT NULL REFERENCES _metrics (metric_id),'
+            '  UNIQUE (sensor_id, metric_id)'
+            ')')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS _samples ('
+            '  series_id INTEGER NOT NULL,'
+            '  ts INTEGER NOT NULL,'
+            '  value REAL,'
+            '  PRIMARY KEY (series_id, ts)'
+            ') WITHOUT ROWID')
+
+        with self._lock:
+            # May be a reload, after a rollback dropped ids that were cached
+            self._sensor_ids = {}
+            self._metric_ids = {}
+            self._sensor_series = {}
+            for sensor_id, name in conn.execute('SELECT sensor_id, name FROM _sensors ORDER BY sensor_id'):
+                self._sensor_ids[name] = sensor_id
+                self._sensor_series[name] = {}
+            for metric_id, name in conn.execute('SELECT metric_id, name FROM _metrics'):
+                self._metric_ids[name] = metric_id
+            res = conn.execute(
+                'SELECT series_id, _sensors.name, _metrics.name FROM _series '
+                'JOIN _sensors USING (sensor_id) JOIN _metrics USING (metric_id) '
+                'ORDER BY series_id')
+            for series_id, sensor_name, metric in res:
+                self._sensor_series[sensor_name][metric] = series_id
+            return {sensor_name: list(series) for sensor_name, series in self._sensor_series.items()}
+
+    def update_schema(self, conn, sensor_name, metrics):
+        """ Add a sensor and/or metrics to it. Returns all the metrics of the sensor. Identifiers must be validated
+        already. """
+        with self._lock:
+            if sensor_name not in self._sensor_ids:
+                self._sensor_ids[sensor_name] = conn.execute(
+                    'INSERT INTO _sensors (name) VALUES (?)', (sensor_name,)).lastrowid
+                self._sensor_series[sensor_name] = {}
+            sensor_id = self._sensor_ids[sensor_name]
+            series = self._sensor_series[sensor_name]
+            for metric in metrics:
+                if metric in series:
+                    continue
+                if metric not in self._metric_ids:
+                    self._metric_ids[metric] = conn.execute(
+                        'INSERT INTO _metrics (name) VALUES (?)', (metric,)).lastrowid
+                log.info("Adding metric '%s' to sensor '%s'", metric, sensor_name)
+                series[metric] = conn.execute('INSERT INTO _series (sensor_id, metric_id) VALUES (?, ?)',
+                                              (sensor_id, self._metric_ids[metric])).lastrowid
+            return list(series)
+
+    def _series_id(self, sensor_name, metric):
+        with self._lock:
+            return self._sensor_series[sensor_name][metric]
+
+    def _all_series(self, sensor_name):
+        with self._lock:
+            return list(self._sensor_series[sensor_name].values())
+
+    def insert(self, conn, sensor_name, metrics, readings, ts):
+        """ Save a reading taken at ts (seconds since the epoch). Must run in the writer thread. """
+        series = [self._series_id(sensor_name, m) for m in metrics]
+        last_ts = self._last_ts.get(sensor_name)
+        if last_ts is None:
+            # Each lookup is a single seek of the (series_id, ts) key
+            last_tss = [conn.execute('SELECT max(ts) FROM _samples WHERE series_id = ?', (series_id,)).fetchone()[0]
+                        for series_id in self._all_series(sensor_name)]
+            last_tss = [t for t in last_tss if t is not None]
+            last_ts = max(last_tss) if last_tss else None
+
+        ts_ms = int(ts * 1000)
+        if last_ts is None or ts_ms > last_ts:
+            self._clock_went_back.discard(sensor_name)
+        elif ts_ms == last_ts:
+            ts_ms = last_ts + 1
+        else:
+            if sensor_name not in self._clock_went_back:
+                self._clock_went_back.add(sensor_name)
+                log.warning("Reading of sensor '%s' is %d ms older than its previous one (did the clock go back?), "
+                            "saving it with its own time", sensor_name, last_ts - ts_ms)
+            ts_ms = self._next_free_ts(conn, sensor_name, ts_ms)
+
+        rows = [(series_id, ts_ms, val) for series_id, val in zip(series, readings) if val is not None]
+        if len(rows) == 0:
+            # A reading without values still shows up in the sensor's history
+            rows = [(series_id, ts_ms, None) for series_id in series]
+        conn.executemany('INSERT INTO _samples (series_id, ts, value) VALUES (?, ?, ?)', rows)
+        self._last_ts[sensor_name] = max(ts_ms, last_ts) if last_ts is not None else ts_ms
+
+    def _next_free_ts(self, conn, sensor_name, ts_ms):
+        """ First ts from ts_ms on without a reading of this sensor. Only needed for readings older than the last
+        one, which may land on an existing reading. """
+        series = self._all_series(sensor_name)
+        while conn.execute(f'SELECT 1 FROM _samples WHERE series_id IN ({_placeholders(series)}) AND ts = ? LIMIT 1',
+                           (*series, ts_ms)).fetchone() is not None:
+            ts_ms += 1
+        return ts_ms
+
+    def retention_cutoff(self, conn, sensor_name, retention_days, retention_rows):
+        """ Samples older than the returned ts should be discarded (None if there is nothing to discard) """
+        cutoffs = []
+        if retention_days is not None:
+            cutoffs.append(conn.execute("SELECT CAST(strftime('%s', 'now', ?) AS INTEGER) * 1000",
+                                        (f'-{int(retention_days)} days',)).fetchone()[0])
+        if retention_rows is not None and retention_rows > 0:
+            series = self._all_series(sensor_name)
+            res = conn.execute(
+                f'SELECT DISTINCT ts FROM _samples WHERE series_id IN ({_placeholders(series)}) '
+                'ORDER BY ts DESC LIMIT 1 OFFSET ?', (*series, int(retention_rows) - 1)).fetchone()
+            if res is not None:
+                # Readings in the same second as the oldest one retained are kept too, like in the wide layout
+                cutoffs.append(res[0] - res[0] % 1000)
+        return max(cutoffs) if cutoffs else None
+
+    def discard_before(self, conn, sensor_name, cutoff, max_rows):
+        """ Delete up to max_rows samples older than cutoff. Returns the number of samples deleted. """
+        series = self._all_series(sensor_name)
+        return conn.execute(
+            'DELETE FROM _samples WHERE (series_id, ts) IN ('
+            f'  SELECT series_id, ts FROM _samples WHERE series_id IN ({_placeholders(series)}) AND ts < ? LIMIT ?'
+            ')', (*series, cutoff, int(max_rows))).rowcount
+
+    def rollup_source(self, sensor_name, metric):
+        """ Query (and its params) selecting the sample_time and value of every sample of a metric """
+        return ("SELECT datetime(ts / 1000, 'unixepoch') AS sample_time, value FROM _samples WHERE series_id = ?",
+                (self._series_id(sensor_name, metric),))
+
+    def metric_history(self, conn, sensor_name, metric, unit, time):
+        """ [(sample_time, value)] of every reading of a sensor in the last `time` `unit`s. Readings that didn't
+        include this metric have a None value. """
+        series = self._all_series(sensor_name)
+        return conn.execute(
+            "SELECT datetime(readings.ts / 1000, 'unixepoch'), _samples.value "
+            f'FROM (SELECT DISTINCT ts FROM _samples WHERE series_id IN ({_placeholders(series)}) AND ts >= ?) '
+            '  AS readings '
+            'LEFT JOIN _samples ON _samples.series_id = ? AND _samples.ts = readings.ts '
+            'ORDER BY readings.ts',
+            (*series, _since_ms(conn, unit, time), self._series_id(sensor_name, metric))).fetchall()
+
+    def metric_samples(self, conn, sensor_name, metric, unit, time):
+        """ Cursor over (sample_time, value) of the non-null samples of a metric in the last `time` `unit`s, in time
+        order. It's a range scan of the primary key, so rows are read as they are needed. """
+        return conn.execute(
+            "SELECT datetime(ts / 1000, 'unixepoch'), value FROM _samples "
+            'WHERE series_id = ? AND value IS NOT NULL AND ts >= ? ORDER BY ts',
+            (self._series_id(sensor_name, metric), _since_ms(conn, unit, time)))
+
+    def all_metrics_history(self, conn, sensor_name, metrics):
+        """ [(sample_time, *values)] of every reading of a sensor """
+        series = [self._series_id(sensor_name, m) for m in metrics]
+        all_series = self._all_series(sensor_name)
+        cols = ', '.join('max(CASE WHEN series_id = ? THEN value END)' for _ in series)
+        return conn.execute(
+            f"SELECT datetime(ts / 1000, 'unixepoch'), {cols} FROM _samples "
+            f'WHERE series_id IN ({_placeholders(all_series)}) GROUP BY ts ORDER BY ts',
+            (*series, *all_series)).fetchall()
@@ -0,0 +1,103 @@
+""" Min/max/avg/count of sensor readings aggregated over 1 minute, 1 hour and 1 day buckets, so that long time ranges
+can be queried without reading every raw sample """
+
+import logging
+log = logging.getLogger(__name__)
+
+# (name, seconds per bucket, sqlite strftime format of a bucket, length of the sample_time prefix kept by a bucket).
+# Sample times look like 'YYYY-MM-DD HH:MM:SS', and a bucket is the sample time truncated to the tier's resolution.
+_TIERS = (
+    ('1m', 60, '%Y-%m-%d %H:%M:00', 16),
+    ('1h', 3600, '%Y-%m-%d %H:00:00', 13),
+    ('1d', 86400, '%Y-%m-%d 00:00:00', 10),
+)
+ROLLUP_TIER_NAMES = tuple(name for name, _, _, _ in _TIERS)
+# Not sensors, even if they are tables in the sensors db
+ROLLUP_TABLES = frozenset(f'_rollup_{name}' for name in ROLLUP_TIER_NAMES)
+
+_UNIT_SECONDS = {'seconds': 1, 'minutes': 60, 'hours': 3600, 'days': 86400, 'months': 30 * 86400,
+                 'years': 365 * 86400}
+
+
+def _table(tier_name):
+    return f'_rollup_{tier_name}'
+
+
+def _bucket(sample_time, prefix_len):
+    # Equivalent to strftime with the tier's format: keep the prefix, zero the rest
+    return sample_time[:prefix_len] + '0000-00-00 00:00:00'[prefix_len:]
+
+
+def create_rollup_tables(conn, raw_samples):
+    """ Create the rollup tables if they don't exist. New tables are backfilled from raw_samples, so that existing
+    history can be queried through rollups too. raw_samples is {(sensor name, metric): (sql, params)}, where the
+    query selects the (sample_time, value) of every raw sample of that metric. """
+    existing = {name for (name,) in conn.execute("SELECT name FROM sqlite_schema WHERE type = 'table'").fetchall()}
+    for tier_name, _, fmt, _ in _TIERS:
+        table = _table(tier_name)
+        if table in existing:
+            continue
+        conn.execute(
+            f'CREATE TABLE {table} ('
+            '  sensor TEXT NOT NULL, metric TEXT NOT NULL, bucket TEXT NOT NULL,'
+            '  v_min REAL, v_max REAL, v_sum REAL, n INTEGER NOT NULL,'
+            '  PRIMARY KEY (sensor, metric, bucket)'
+            ') WITHOUT ROWID')
+        # For retention, which deletes by age across all sensors
+        conn.execute(f'CREATE INDEX {table}_bucket ON {table} (bucket)')
+        log.info('Created rollup table %s, backfilling %d metrics', table, len(raw_samples))
+        for (sensor_name, metric), (raw_sql, raw_params) in raw_samples.items():
+            conn.execute(
+                f'INSERT INTO {table} (sensor, metric, bucket, v_min, v_max, v_sum, n) '
+                f"SELECT ?, ?, strftime('{fmt}', sample_time), min(value), max(value), sum(value), count(value) "
+                f'FROM ({raw_sql}) WHERE value IS NOT NULL AND sample_time IS NOT NULL '
+                f'GROUP BY 3', (sensor_name, metric, *raw_params))
+
+
+def add_to_rollups(conn, sensor_name, metrics, readings, sample_time):
+    """ Aggregate a reading into the bucket of each tier. Non numeric values are skipped. """
+    vals = [(m, float(v)) for m, v in zip(metrics, readings) if isinstance(v, (int, float))]
+    if len(vals) == 0:
+        return
+    for tier_name, _, _, prefix_len in _TIERS:
+        bucket = _bucket(sample_time, prefix_len)
+        conn.executemany(
+            f'INSERT INTO {_table(tier_name)} (sensor, metric, bucket, v_min, v_max, v_sum, n) '
+            'VALUES (?, ?, ?, ?, ?, ?, 1) '
+            'ON CONFLICT (sensor, metric, bucket) DO UPDATE SET '
+            '  v_min = min(v_min, excluded.v_min), v_max = max(v_max, excluded.v_max), '
+            '  v_sum = v_sum + excluded.v_sum, n = n + 1',
+            [(sensor_name, metric, bucket, val, val, val) for metric, val in vals])
+
+
+def pick_rollup_tier(unit, time, points):
+    """ The coarsest tier that still has at least `points` buckets in the last `time` `unit`s, or None if even the
+    finest tier has fewer buckets than that (so raw samples should be used) """
+    range_secs = int(time) * _UNIT_SECONDS[unit]
+    for tier_name, tier_secs, _, _ in reversed(_TIERS):
+        if range_secs // tier_secs >= points:
+            return tier_name
+    return None
+
+
+def query_rollup(conn, tier_name, sensor_name, metric, unit, time):
+    """ [(bucket, avg, min, max, count)] for the buckets of the last `time` `unit`s """
+    return conn.execute(
+        f'SELECT bucket, v_sum / n, v_min, v_max, n FROM {_table(tier_name)} '
+        "WHERE sensor = ? AND metric = ? AND bucket > datetime('now', ?) "
+        'ORDER BY bucket', (sensor_name, metric, f'-{int(time)} {unit}')).fetchall()
+
+
+def rollup_retention_cutoff(conn, retention_days):
+    if retention_days is None:
+        return None
+    return conn.execute("SELECT datetime('now', ?)", (f'-{int(retention_days)} days',)).fetchone()[0]
+
+
+def discard_rollups_before(conn, tier_name, cutoff, max_rows):
+    """ Delete up to max_rows buckets older than cutoff from a tier. Returns the number of buckets deleted. """
+    table = _table(tier_name)
+    return conn.execute(
+        f'DELETE FROM {table} WHERE (sensor, metric, bucket) IN ('
+        f'  SELECT sensor, metric, bucket FROM {table} WHERE bucket < ? LIMIT ?'
+        f')', (cutoff, int(max_rows))).rowcount
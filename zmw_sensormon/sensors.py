@@ -1,11 +1,32 @@
 """ Keeps a historical database of sensor readings """
 
-from apscheduler.triggers.cron import CronTrigger
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from datetime import datetime, timezone
+from flask import Response, request
+from zzmw_lib.metrics import get_metrics_registry
+from narrow_storage import NARROW_TABLES, NarrowStorage
+from sensor_rollups import (ROLLUP_TABLES, ROLLUP_TIER_NAMES, add_to_rollups, create_rollup_tables,
+                            discard_rollups_before, pick_rollup_tier, query_rollup, rollup_retention_cutoff)
+import heapq
+import queue
 import sqlite3
 import logging
 import re
+import threading
+import time
+import zlib
 log = logging.getLogger(__name__)
 
+_metrics = get_metrics_registry()
+_samples_saved = _metrics.counter('sensors_samples_saved_total', 'Sensor readings saved to the history db', ('sensor',))
+_commit_ms = _metrics.histogram('sensors_commit_ms', 'Time to commit a batch of sensor readings to the history db')
+_commit_rows = _metrics.histogram('sensors_commit_rows', 'Sensor readings per commit to the history db',
+                                  buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+_gc_ms = _metrics.histogram('sensors_gc_ms', 'Time to discard old samples from the history db',
+                            buckets=(10, 100, 1000, 10000, 60000))
+_rows_purged = _metrics.counter('sensors_rows_purged_total', 'Rows discarded by the retention policy', ('table',))
+
 # SQL injection protection: Valid identifier pattern (alphanumeric + underscore, can't start with digit)
 _SQL_IDENTIFIER_PATTERN = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
 _MAX_IDENTIFIER_LENGTH = 128
@@ -61,6 +82,13 @@ def _validate_sql_identifier(identifier, identifier_type="identifier"):
 
     return identifier
 
+def _validate_sensor_name(sensor_name):
+    """ A valid identifier that doesn't clash with the tables used for rollups or the narrow layout """
+    _validate_sql_identifier(sensor_name, "sensor name")
+    if sensor_name in ROLLUP_TABLES or sensor_name in NARROW_TABLES:
+        raise ValueError(f"Invalid sensor name '{sensor_name}': name is reserved")
+    return sensor_name
+
 def _validate_time_unit(unit):
     """Validates time units used in SQLite datetime() function to prevent injection."""
     valid_units = {'years', 'months', 'days', 'hours', 'minutes', 'seconds'}
@@ -80,6 +108,7 @@ def _maybe_create_table(conn, sensor_name, metrics):
         '   sample_time DATETIME DEFAULT CURRENT_TIMESTAMP, '
         f'  {metric_cols} REAL'
         ')')
+    _create_sample_time_index(conn, sensor_name)
 
     # Add any missing columns to existing tables
     _add_missing_columns(conn, sensor_name, validated_metrics)
@@ -96,54 +125,43 @@ def _add_missing_columns(conn, sensor_name, metrics):
             conn.execute(f'ALTER TABLE {sensor_name} ADD COLUMN {metric} REAL')
 
 
-def _discard_old_samples_by_retention_count(conn, sensor_name, retention_rows):
-    if retention_rows is None or retention_rows <= 0:
-        return
+def _create_sample_time_index(conn, sensor_name):
+    """ Retention and time range queries look up samples by time """
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {sensor_name}_sample_time ON {sensor_name} (sample_time)')
+
 
+def _retention_cutoff(conn, sensor_name, retention_days, retention_rows):
+    """ Samples older than the returned sample_time should be discarded (None if there is nothing to discard) """
     # Validate sensor name to prevent SQL injection
     sensor_name = _validate_sql_identifier(sensor_name, "sensor name")
-    retention_rows = int(retention_rows)
-
-    conn.execute(
-        f'DELETE FROM {sensor_name} '
-        f'WHERE '
-        f'  rowid NOT IN ('
-        f'    SELECT ROWID FROM {sensor_name} '
-        f'    ORDER BY sample_time DESC '
-        f'    LIMIT {retention_rows} '
-        f'  )'
-    )
-
-
-def _discard_old_samples_by_retention_days(conn, sensor_name, retention_days):
-    if retention_days is None:
-        return
-
+    cutoffs = []
+    if retention_days is not None:
+        cutoffs.append(conn.execute("SELECT datetime('now', ?)", (f'-{int(retention_days)} days',)).fetchone()[0])
+    if retention_rows is not None and retention_rows > 0:
+        # Walks the sample_time index, instead of sorting the table. Samples with the same time as the oldest one
+        # retained are kept, too
+        res = conn.execute(f'SELECT sample_time FROM {sensor_name} ORDER BY sample_time DESC LIMIT 1 OFFSET ?',
+                           (int(retention_rows) - 1,)).fetchone()
+        if res is not None and res[0] is not None:
+            cutoffs.append(res[0])
+    return max(cutoffs) if cutoffs else None
+
+
+def _discard_samples_before(conn, sensor_name, cutoff, max_rows):
+    """ Delete up to max_rows samples older than cutoff. Returns the number of samples deleted. """
     # Validate sensor name to prevent SQL injection
     sensor_name = _validate_sql_identifier(sensor_name, "sensor name")
-    retention_days = int(retention_days)
-
-    conn.execute(
-        f"DELETE FROM {sensor_name} "
-        f"WHERE sample_time < datetime('now', '-{retention_days} days')"
-    )
+    return conn.execute(
+        f'DELETE FROM {sensor_name} WHERE rowid IN ('
+        f'  SELECT rowid FROM {sensor_name} WHERE sample_time < ? LIMIT ?'
+        f')', (cutoff, int(max_rows))).rowcount
 
 
 def _get_known_sensors(conn):
     res = conn.execute(
         "SELECT name FROM sqlite_schema WHERE type = 'table'").fetchall()
     # unpack, so we return as a vector instead of a vec of tuples
-    return [x for (x,) in res]
-
-
-def _discard_old_samples_by_retention_days_all_tables(conn, retention_days):
-    for sensor_name in _get_known_sensors(conn):
-        _discard_old_samples_by_retention_days(conn, sensor_name, retention_days)
-
-
-def _discard_old_samples_by_retention_count_all_tables(conn, retention_days):
-    for sensor_name in _get_known_sensors(conn):
-        _discard_old_samples_by_retention_count(conn, sensor_name, retention_days)
+    return [x for (x,) in res if x not in ROLLUP_TABLES]
 
 
 def _get_sensor_metrics(conn, sensor_name):
@@ -156,21 +174,345 @@ def _get_sensor_metrics(conn, sensor_name):
     return [metric for (metric,) in res.fetchall() if metric != 'sample_time']
 
 
-def _get_known_metrics(conn):
-    sensors = _get_known_sensors(conn)
-    known_metrics = set()
-    for s in sensors:
-        for m in _get_sensor_metrics(conn, s):
-            known_metrics.add(m)
-    return known_metrics
+class _WideTablesStorage:
+    """ The original layout: a table per sensor, with a sample_time column and a REAL column per metric """
+
+    def load_schema(self, conn):
+        """ Metrics of each sensor ({sensor: [metrics]}), in the order their tables were created """
+        tables = _get_known_sensors(conn)
+        if NARROW_TABLES.issubset(tables):
+            raise ValueError("Sensors db uses the narrow layout, but the table-per-sensor layout was requested")
+        schema = {}
+        for sensor_name in tables:
+            # Tables created before sample_time was indexed
+            _create_sample_time_index(conn, sensor_name)
+            schema[sensor_name] = _get_sensor_metrics(conn, sensor_name)
+        return schema
+
+    def update_schema(self, conn, sensor_name, metrics):
+        """ Create the table for a sensor, or add missing columns to it. Returns all the metrics of the sensor. """
+        _maybe_create_table(conn, sensor_name, metrics)
+        return _get_sensor_metrics(conn, sensor_name)
+
+    def insert(self, conn, sensor_name, metrics, readings, ts):
+        cols_q = ', '.join(['sample_time'] + metrics)
+        vals_placeholders = ', '.join('?' * (len(metrics) + 1))
+        conn.execute(f'INSERT INTO {sensor_name} ({cols_q}) VALUES ({vals_placeholders})',
+                     [_format_sample_time(ts)] + readings)
+
+    def retention_cutoff(self, conn, sensor_name, retention_days, retention_rows):
+        return _retention_cutoff(conn, sensor_name, retention_days, retention_rows)
+
+    def discard_before(self, conn, sensor_name, cutoff, max_rows):
+        return _discard_samples_before(conn, sensor_name, cutoff, max_rows)
+
+    def rollup_source(self, sensor_name, metric):
+        return (f'SELECT sample_time, {metric} AS value FROM {sensor_name}', ())
+
+    def metric_history(self, conn, sensor_name, metric, unit, time):
+        query = f"SELECT sample_time, {metric} " +\
+                f"FROM {sensor_name} " +\
+                f"WHERE sample_time > datetime('now', '-{time} {unit}')" +\
+                "ORDER BY sample_time"
+        return conn.execute(query).fetchall()
+
+    def metric_samples(self, conn, sensor_name, metric, unit, time):
+        # Walks the sample_time index, so rows can be read as they are needed
+        query = f"SELECT sample_time, {metric} " +\
+                f"FROM {sensor_name} " +\
+                f"WHERE {metric} IS NOT NULL AND sample_time > datetime('now', '-{time} {unit}') " +\
+                "ORDER BY sample_time"
+        return conn.execute(query)
+
+    def all_metrics_history(self, conn, sensor_name, metrics):
+        cols = ','.join(metrics)
+        query = f"SELECT sample_time, {cols} FROM {sensor_name} ORDER BY sample_time"
+        return conn.execute(query).fetchall()
+
+
+# Storage layouts, by the name used to configure them
+_STORAGES = {
+    'wide': _WideTablesStorage,
+    'narrow': NarrowStorage,
+}
+
+
+class _SensorsCatalog:
+    """ In-memory copy of the db schema: the metrics of each sensor, and the sensors measuring each metric. Loaded
+    once from the db, and updated by whoever changes the schema, so lookups don't need to query the db. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Sensor name -> its metrics, in column order. Sensors are kept in the order their tables were created
+        self._sensor_metrics = {}
+        # Metric -> set of sensors measuring it
+        self._metric_sensors = {}
+        # Sensor name -> position in self._sensor_metrics
+        self._sensor_order = {}
+
+    def load(self, schema):
+        """ Replace everything known with the metrics of each sensor, as returned by a storage's load_schema """
+        with self._lock:
+            self._sensor_metrics = {}
+            self._metric_sensors = {}
+            self._sensor_order = {}
+        for sensor_name, metrics in schema.items():
+            self.update(sensor_name, metrics)
+
+    def update(self, sensor_name, metrics):
+        """ Set the metrics of a sensor, as they are in its table """
+        with self._lock:
+            for metric in self._sensor_metrics.get(sensor_name, []):
+                self._metric_sensors[metric].discard(sensor_name)
+            self._sensor_order.setdefault(sensor_name, len(self._sensor_order))
+            self._sensor_metrics[sensor_name] = list(metrics)
+            for metric in metrics:
+                self._metric_sensors.setdefault(metric, set()).add(sensor_name)
+
+    def has_metrics(self, sensor_name, metrics):
+        with self._lock:
+            known = self._sensor_metrics.get(sensor_name)
+            return known is not None and all(m in known for m in metrics)
+
+    def sensors(self):
+        with self._lock:
+            return list(self._sensor_metrics)
+
+    def metrics(self):
+        with self._lock:
+            return [m for m, sensors in self._metric_sensors.items() if len(sensors) > 0]
 
+    def sensor_metrics(self, sensor_name):
+        """ Metrics of a sensor, or None if the sensor isn't known """
+        with self._lock:
+            metrics = self._sensor_metrics.get(sensor_name)
+            return None if metrics is None else list(metrics)
 
-def _sensors_with_metric(conn, metric):
-    all_sensors = []
-    for sensor_name in _get_known_sensors(conn):
-        if metric in _get_sensor_metrics(conn, sensor_name):
-            all_sensors.append(sensor_name)
-    return all_sensors
+    def sensors_measuring(self, metric):
+        with self._lock:
+            return sorted(self._metric_sensors.get(metric, ()), key=self._sensor_order.get)
+
+
+def _format_sample_time(ts):
+    """ Seconds since the epoch, in the same format as sqlite's CURRENT_TIMESTAMP """
+    return datetime.fromtimestamp(ts, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+# Valid values for SQLite's PRAGMA synchronous. NORMAL in WAL mode may lose the last commits on power loss, but never
+# corrupts the db. FULL also survives power loss, at the cost of an fsync per commit.
+_SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL')
+
+# Queued in the writer to stop it
+_STOP_WRITER = object()
+
+# Default time to wait for the writer to run a request, in seconds
+_RUN_TIMEOUT_SECS = 30
+
+
+class _SensorsDbWriter:
+    """
+    Owns the only connection that writes to the sensors database. Readings are queued and written by a background
+    thread, which group-commits them once commit_interval_ms passed since the first uncommitted reading, or once
+    commit_max_rows readings are pending, whichever happens first. A commit_interval_ms of 0 commits every reading.
+
+    Readings that haven't been committed yet are lost if the process dies, so commit_interval_ms trades durability for
+    fewer writes to disk. Other writes (eg schema changes) are run in the writer thread too, via run().
+
+    Schema changes are always committed on their own, never as part of a batch of readings: if a batch failed to
+    commit, rolling it back would leave the catalog with a schema the db doesn't have.
+    """
+
+    def __init__(self, dbpath, catalog, storage, commit_interval_ms=1000, commit_max_rows=100, synchronous='NORMAL',
+                 max_queued=10000):
+        if synchronous not in _SYNCHRONOUS_MODES:
+            raise ValueError(f"Invalid synchronous mode '{synchronous}': must be one of {_SYNCHRONOUS_MODES}")
+        self._commit_interval_secs = commit_interval_ms / 1000
+        self._commit_max_rows = max(1, commit_max_rows)
+        self._queue = queue.Queue(maxsize=max_queued)
+
+        # Only used from the writer thread once it starts
+        self._conn = sqlite3.connect(dbpath, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(f'PRAGMA synchronous={synchronous}')
+        self._storage = storage
+        # Kept up to date with any schema change done by the writer
+        self._catalog = catalog
+        self._catalog.load(self._storage.load_schema(self._conn))
+        create_rollup_tables(self._conn, {(s, m): self._storage.rollup_source(s, m)
+                                          for s in self._catalog.sensors() for m in self._catalog.sensor_metrics(s)})
+        self._conn.commit()
+        self._stats_lock = threading.Lock()
+        self._stats = {'commits': 0, 'rows_committed': 0, 'dropped': 0, 'errors': 0}
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run, name="SensorsDbWriter", daemon=True)
+        self._thread.start()
+
+    def _is_running(self):
+        return not self._closed and self._thread.is_alive()
+
+    def _count_error(self):
+        with self._stats_lock:
+            self._stats['errors'] += 1
+
+    def save(self, sensor_name, metrics, readings):
+        """ Queue a reading. Identifiers must be validated already. Drops the reading (and logs an error) if the
+        queue stays full for a while, or if the writer isn't running. """
+        if not self._is_running():
+            with self._stats_lock:
+                self._stats['dropped'] += 1
+            log.error("Sensors db writer isn't running, dropping reading for %s", sensor_name)
+            return
+        try:
+            self._queue.put((sensor_name, metrics, readings, time.time()), timeout=5)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats['dropped'] += 1
+            log.error("Sensors db write queue is full, dropping reading for %s", sensor_name)
+
+    def run(self, fn, timeout=_RUN_TIMEOUT_SECS):
+        """ Run fn(conn) in the writer thread, after committing all queued readings. Blocks until it's done, and
+        returns its result (or raises its exception). Raises RuntimeError if the writer isn't running, and
+        TimeoutError if fn didn't run within timeout seconds (it may still run later). """
+        if not self._is_running():
+            raise RuntimeError("Sensors db writer isn't running")
+        done = Future()
+        try:
+            self._queue.put((fn, done), timeout=timeout)
+            return done.result(timeout)
+        except (queue.Full, FutureTimeoutError) as ex:
+            raise TimeoutError(f"Sensors db writer didn't run request within {timeout} seconds") from ex
+
+    def flush(self, timeout=_RUN_TIMEOUT_SECS):
+        """ Block until all readings queued so far are committed """
+        self.run(lambda _conn: None, timeout)
+
+    def close(self, timeout=10):
+        """ Commit all queued readings and close the connection. No more work is accepted after this. """
+        self._closed = True
+        if not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP_WRITER, timeout=timeout)
+        except queue.Full:
+            log.error("Sensors db writer queue is full, can't stop it. Some readings may be lost")
+            return
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            log.error("Sensors db writer didn't stop after %s seconds, some readings may be lost", timeout)
+
+    def get_stats(self):
+        with self._stats_lock:
+            return {'queue_depth': self._queue.qsize(), **self._stats}
+
+    def update_schema(self, conn, sensor_name, metrics):
+        """ Add a sensor, or missing metrics to a sensor. Must run in the writer thread. """
+        self._catalog.update(sensor_name, self._storage.update_schema(conn, sensor_name, metrics))
+
+    def _reload_schema(self):
+        """ After a rollback, the catalog (and the storage's caches) may know of schema changes that were lost """
+        try:
+            self._catalog.load(self._storage.load_schema(self._conn))
+        except Exception:  # pylint: disable=broad-except
+            log.error("Failed to reload sensors db schema", exc_info=True)
+
+    def _apply(self, fn):
+        """ Run fn(conn) and commit it on its own. Nothing can be pending when this is called. """
+        try:
+            res = fn(self._conn)
+            self._conn.commit()
+            return res
+        except Exception:
+            self._conn.rollback()
+            self._reload_schema()
+            raise
+
+    def _insert(self, sensor_name, metrics, readings, ts):
+        # A savepoint inside the batch's transaction, so that a failed reading doesn't leave part of its rows behind
+        if not self._conn.in_transaction:
+            self._conn.execute('BEGIN')
+        self._conn.execute('SAVEPOINT reading')
+        try:
+            self._storage.insert(self._conn, sensor_name, metrics, readings, ts)
+            add_to_rollups(self._conn, sensor_name, metrics, readings, _format_sample_time(ts))
+        except Exception:
+            self._conn.execute('ROLLBACK TO reading')
+            raise
+        finally:
+            self._conn.execute('RELEASE reading')
+
+    def _save_reading(self, pending, sensor_name, metrics, readings, ts):
+        """ Add a reading to the batch. On failure only this reading is lost. """
+        try:
+            if not self._catalog.has_metrics(sensor_name, metrics):
+                self._commit(pending)
+                self._apply(lambda conn: self.update_schema(conn, sensor_name, metrics))
+            self._insert(sensor_name, metrics, readings, ts)
+            pending[sensor_name] = pending.get(sensor_name, 0) + 1
+        except Exception:  # pylint: disable=broad-except
+            log.error("Failed to write reading for sensor %s to db", sensor_name, exc_info=True)
+            self._count_error()
+
+    def _commit(self, pending):
+        """ On failure the batch is lost """
+        if len(pending) == 0:
+            return
+        t_start = time.monotonic()
+        try:
+            self._conn.commit()
+        except Exception:  # pylint: disable=broad-except
+            log.error("Failed to commit %d sensor readings to db", sum(pending.values()), exc_info=True)
+            self._count_error()
+            pending.clear()
+            try:
+                self._conn.rollback()
+            except sqlite3.Error:
+                log.error("Failed to roll back sensor readings", exc_info=True)
+            return
+        _commit_ms.observe(1000 * (time.monotonic() - t_start))
+
+        n_rows = sum(pending.values())
+        _commit_rows.observe(n_rows)
+        for sensor_name, cnt in pending.items():
+            _samples_saved.inc(cnt, sensor=sensor_name)
+        with self._stats_lock:
+            self._stats['commits'] += 1
+            self._stats['rows_committed'] += n_rows
+        pending.clear()
+
+    def _run(self):
+        # Sensor name -> number of uncommitted readings
+        pending = {}
+        commit_deadline = None
+        while True:
+            timeout = None if commit_deadline is None else max(0, commit_deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            is_reading = isinstance(item, tuple) and len(item) == 4
+            if is_reading:
+                self._save_reading(pending, *item)
+                if commit_deadline is None:
+                    commit_deadline = time.monotonic() + self._commit_interval_secs
+                n_pending = sum(pending.values())
+                if 0 < n_pending < self._commit_max_rows and time.monotonic() < commit_deadline:
+                    continue
+
+            self._commit(pending)
+            commit_deadline = None
+
+            if item is _STOP_WRITER:
+                self._conn.close()
+                return
+            if item is not None and not is_reading:
+                fn, done = item
+                try:
+                    done.set_result(self._apply(fn))
+                except Exception as ex:  # pylint: disable=broad-except
+                    self._count_error()
+                    done.set_exception(ex)
 
 
 def _csv(header, data):
@@ -180,26 +522,95 @@ def _csv(header, data):
     return csv
 
 
+# Lines of csv sent per chunk of a streamed response
+_STREAM_CHUNK_LINES = 1000
+
+
+def _chunk_lines(header, lines):
+    """ Joins csv lines into chunks of _STREAM_CHUNK_LINES, so a response is sent a chunk at a time """
+    chunk = [','.join(header) + '\n']
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= _STREAM_CHUNK_LINES:
+            yield ''.join(chunk)
+            chunk = []
+    if len(chunk) > 0:
+        yield ''.join(chunk)
+
+
+def _gzip_chunks(chunks):
+    gz = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = gz.compress(chunk.encode())
+        # Small chunks may be buffered by the compressor
+        if len(data) > 0:
+            yield data
+    yield gz.flush()
+
+
+def _streamed_csv(header, lines):
+    """ A response sending the csv as it's generated, gzipped if the client accepts it """
+    chunks = _chunk_lines(header, lines)
+    headers = {'Vary': 'Accept-Encoding'}
+    if request.accept_encodings['gzip'] > 0:
+        chunks = _gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(chunks, mimetype='text/csv', headers=headers)
+
+
+# Days to keep each rollup tier for, None to keep forever
+_DEFAULT_ROLLUP_RETENTION_DAYS = {'1m': 30, '1h': 400, '1d': None}
+
+
 class SensorsHistory:
     """ Keeps a historical database of sensor readings. This is a pure persistence
     layer - it receives sensor data and stores it, but does not manage callbacks
     or sensor objects directly. """
 
-    def __init__(self, dbpath, scheduler, retention_rows=None, retention_days=None):
+    def __init__(self, dbpath, scheduler, retention_rows=None, retention_days=None,
+                 commit_interval_ms=1000, commit_max_rows=100, synchronous='NORMAL',
+                 retention_sweep_minutes=10, retention_chunk_rows=500, rollup_retention_days=None, storage='wide'):
+        """ Readings are group-committed, see _SensorsDbWriter for the meaning of commit_interval_ms,
+        commit_max_rows and synchronous. Call close() before exiting, or the last readings may be lost.
+
+        Samples out of the retention policy are deleted every retention_sweep_minutes, at most retention_chunk_rows
+        per transaction. Readings are also aggregated in 1m, 1h and 1d rollups, which are kept for as many days as
+        rollup_retention_days says for each tier (None to keep forever). This lets raw samples have a short
+        retention, while keeping long term history.
+
+        storage selects the layout of raw samples: 'wide' (a table per sensor) or 'narrow' (a single table keyed by
+        series and time, see NarrowStorage). Both serve the same results; use migrate_to_narrow_storage.py to move
+        an existing db to the narrow layout. """
+        if storage not in _STORAGES:
+            raise ValueError(f"Unknown sensors db storage '{storage}', expected one of {tuple(_STORAGES)}")
         self._retention_rows = retention_rows
         self._retention_days = retention_days
+        self._retention_chunk_rows = retention_chunk_rows
+        self._rollup_retention_days = dict(_DEFAULT_ROLLUP_RETENTION_DAYS)
+        for tier_name, days in (rollup_retention_days or {}).items():
+            if tier_name not in ROLLUP_TIER_NAMES:
+                raise ValueError(f"Unknown rollup tier '{tier_name}', expected one of {ROLLUP_TIER_NAMES}")
+            self._rollup_retention_days[tier_name] = days
+        self._retention_stats_lock = threading.Lock()
+        self._retention_stats = {'sweeps': 0, 'rows_purged': 0, 'last_sweep_ms': None}
         self._dbpath = dbpath
+        self._storage = _STORAGES[storage]()
 
-        # try to open the db once, to verify it's usable
-        with sqlite3.connect(self._dbpath):
-            pass
+        # Sensors and metrics known to the db. The writer loads it, and keeps it up to date
+        self._catalog = _SensorsCatalog()
+        # Opening the writer also verifies the db is usable
+        self._writer = _SensorsDbWriter(dbpath, self._catalog, self._storage, commit_interval_ms=commit_interval_ms,
+                                        commit_max_rows=commit_max_rows, synchronous=synchronous)
+        _metrics.register_collector('sensors_db_writer', self._writer.get_stats)
+        _metrics.register_collector('sensors_retention', self.get_retention_stats)
 
         self._scheduler = scheduler
 
-        # Clear old sensors once a day, some time at a random hour during the night
+        # Sweep often, so that each sweep only has a few samples to delete
         self._scheduler.add_job(
             self.gc_dead_sensors,
-            trigger=CronTrigger(hour=2, minute=22, second=0),
+            trigger='interval',
+            minutes=retention_sweep_minutes,
             id='gc_sensor_history'
         )
 
@@ -214,6 +625,9 @@ class SensorsHistory:
                             None, self.get_metric_in_sensor_csv)
         server.add_url_rule('/sensors/get_metric_in_sensor_csv/<sensor_name>/<metric>/history/<unit>/<time>',
                             None, self.get_metric_in_sensor_csv_time_limit)
+        server.add_url_rule('/sensors/get_metric_in_sensor_csv/<sensor_name>/<metric>/history/<unit>/<time>'
+                            '/points/<points>',
+                            None, self.get_metric_in_sensor_csv_downsampled)
         server.add_url_rule('/sensors/get_all_metrics_in_sensor_csv/<sensor_name>',
                             None, self.get_all_metrics_in_sensor_csv)
         server.add_url_rule('/sensors/get_single_metric_in_all_sensors_csv/<metric>',
@@ -230,7 +644,7 @@ class SensorsHistory:
         or adds any missing columns to an existing table. Does not manage callbacks. """
         # Validate sensor name early to catch invalid names at registration
         try:
-            _validate_sql_identifier(sensor_name, "sensor name")
+            _validate_sensor_name(sensor_name)
         except ValueError as e:
             log.error("Cannot register sensor with invalid name: %s", e)
             raise
@@ -243,14 +657,13 @@ class SensorsHistory:
                 log.error("Cannot register sensor %s with invalid metric name: %s", sensor_name, e)
                 raise
 
-        with sqlite3.connect(self._dbpath) as conn:
-            _maybe_create_table(conn, sensor_name, metrics)
-            conn.commit()
-
+        if not self._catalog.has_metrics(sensor_name, metrics):
+            self._writer.run(lambda conn: self._writer.update_schema(conn, sensor_name, metrics))
         log.info('Registered sensor %s to sensor_history', sensor_name)
 
     def save_reading(self, sensor_name, values_dict):
-        """ Save a sensor reading to the database.
+        """ Queue a sensor reading to be saved to the database. It will be visible to queries once the writer
+        commits it.
 
         Args:
             sensor_name: Name of the sensor
@@ -260,50 +673,33 @@ class SensorsHistory:
         readings = list(values_dict.values())
 
         # Validate all identifiers to prevent SQL injection
-        sensor_name = _validate_sql_identifier(sensor_name, "sensor name")
+        sensor_name = _validate_sensor_name(sensor_name)
         validated_metrics = [_validate_sql_identifier(m, "metric name") for m in metrics]
+        self._writer.save(sensor_name, validated_metrics, readings)
 
-        with sqlite3.connect(self._dbpath) as conn:
-            _maybe_create_table(conn, sensor_name, validated_metrics)
+    def flush(self):
+        """ Block until all queued readings are committed """
+        self._writer.flush()
 
-            cols_q = ', '.join(validated_metrics)
-            vals_placeholders = ', '.join('?' * len(validated_metrics))
-            query = f'INSERT INTO {sensor_name}'\
-                    f' ({cols_q}) VALUES ({vals_placeholders})'
-            conn.execute(query, readings)
-
-            _discard_old_samples_by_retention_count(
-                conn, sensor_name, self._retention_rows)
-            _discard_old_samples_by_retention_days(
-                conn, sensor_name, self._retention_days)
-            conn.commit()
+    def close(self):
+        """ Commit all queued readings, and stop writing to the database """
+        self._writer.close()
 
     def get_known_sensors(self):
         """ Returns a list of all sensor names kept in this database """
-        with sqlite3.connect(self._dbpath) as conn:
-            return _get_known_sensors(conn)
+        return self._catalog.sensors()
 
     def get_known_metrics(self):
         """ Returns a list of all metrics being measured """
-        with sqlite3.connect(self._dbpath) as conn:
-            return list(_get_known_metrics(conn))
+        return self._catalog.metrics()
 
     def get_known_sensors_measuring(self, metric):
         """ Returns a list of all sensor that can measure $metric"""
-        with sqlite3.connect(self._dbpath) as conn:
-            sensors = _get_known_sensors(conn)
-            can_measure = []
-            for sensor in sensors:
-                if metric in _get_sensor_metrics(conn, sensor):
-                    can_measure.append(sensor)
-            return can_measure
+        return self._catalog.sensors_measuring(metric)
 
     def get_metrics_for_sensor(self, sensor_name):
         """ Returns a list of all metrics available for a specific sensor """
-        with sqlite3.connect(self._dbpath) as conn:
-            if sensor_name not in _get_known_sensors(conn):
-                return []
-            return _get_sensor_metrics(conn, sensor_name)
+        return self._catalog.sensor_metrics(sensor_name) or []
 
     def get_metric_in_sensor_csv(self, sensor_name, metric):
         """ Retrieves all measurements of $metric for $sensor """
@@ -318,106 +714,172 @@ class SensorsHistory:
         unit = _validate_time_unit(unit)
         time = int(time)
 
+        sensor_metrics = self._catalog.sensor_metrics(sensor_name)
+        if sensor_metrics is None:
+            log.error('Received request for unknown sensor %s', sensor_name)
+            return ''
+
+        if metric not in sensor_metrics:
+            log.error('Received request for unknown metric %s in sensor %s', metric, sensor_name)
+            return ''
+
         with sqlite3.connect(self._dbpath) as conn:
-            if sensor_name not in _get_known_sensors(conn):
-                log.error('Received request for unknown sensor %s', sensor_name)
-                return ''
-
-            if metric not in _get_sensor_metrics(conn, sensor_name):
-                log.error('Received request for unknown metric %s in sensor %s', metric, sensor_name)
-                return ''
-
-            query = f"SELECT sample_time, {metric} " +\
-                    f"FROM {sensor_name} " +\
-                    f"WHERE sample_time > datetime('now', '-{time} {unit}')" +\
-                    "ORDER BY sample_time"
-            res = conn.execute(query).fetchall()
+            res = self._storage.metric_history(conn, sensor_name, metric, unit, time)
             return _csv(['sample_time', metric], res)
 
+    def get_metric_in_sensor_csv_downsampled(self, sensor_name, metric, unit, time, points):
+        """ Like get_metric_in_sensor_csv_time_limit, but reads from the coarsest rollup tier that still has at least
+        $points buckets in the time range. Each row has the average, min, max and number of samples in its bucket.
+        If even the finest tier can't give that many points, raw samples are returned, in the same format. """
+        # Validate all identifiers to prevent SQL injection
+        sensor_name = _validate_sql_identifier(sensor_name, "sensor name")
+        metric = _validate_sql_identifier(metric, "metric name")
+        unit = _validate_time_unit(unit)
+        time = int(time)
+        points = int(points)
+
+        sensor_metrics = self._catalog.sensor_metrics(sensor_name)
+        if sensor_metrics is None:
+            log.error('Received request for unknown sensor %s', sensor_name)
+            return ''
+
+        if metric not in sensor_metrics:
+            log.error('Received request for unknown metric %s in sensor %s', metric, sensor_name)
+            return ''
+
+        header = ['sample_time', metric, f'{metric}_min', f'{metric}_max', 'samples']
+        tier_name = pick_rollup_tier(unit, time, points)
+        with sqlite3.connect(self._dbpath) as conn:
+            if tier_name is not None:
+                return _csv(header, query_rollup(conn, tier_name, sensor_name, metric, unit, time))
+            samples = self._storage.metric_samples(conn, sensor_name, metric, unit, time)
+            return _csv(header, ((sample_time, val, val, val, 1) for sample_time, val in samples))
+
     def get_all_metrics_in_sensor_csv(self, sensor_name):
         """ Equivalent to select * for a single sensor: retrieves all historical
         data for a single sensor, as far as the retention period allows """
         # Validate sensor name to prevent SQL injection
         sensor_name = _validate_sql_identifier(sensor_name, "sensor name")
 
+        # metrics in the catalog are already validated
+        metrics = self._catalog.sensor_metrics(sensor_name)
+        if metrics is None:
+            log.error('Received request for unknown sensor %s', sensor_name)
+            return ''
+
         with sqlite3.connect(self._dbpath) as conn:
-            if sensor_name not in _get_known_sensors(conn):
-                log.error('Received request for unknown sensor %s', sensor_name)
-                return ''
-
-            # metrics returned from _get_sensor_metrics are already validated
-            metrics = _get_sensor_metrics(conn, sensor_name)
-            cols = ','.join(metrics)
-            query = f"SELECT sample_time, {cols} FROM {sensor_name} ORDER BY sample_time"
-            res = conn.execute(query).fetchall()
+            res = self._storage.all_metrics_history(conn, sensor_name, metrics)
             return _csv(['sample_time'] + metrics, res)
 
     def get_single_metric_in_all_sensors_csv(self, metric, unit='days', time=2):
         """ Gets the same metric, as measured by different sensors. Will check
-        on all known sensors (sensors that don't know this metric will be skipped """
+        on all known sensors (sensors that don't know this metric will be skipped).
+        The response is streamed: the samples of each sensor are read in time order,
+        and merged as the csv is sent. """
         # Validate all parameters to prevent SQL injection
         metric = _validate_sql_identifier(metric, "metric name")
         unit = _validate_time_unit(unit)
         time = int(time)
 
-        with sqlite3.connect(self._dbpath) as conn:
-            # all_sensors come from _sensors_with_metric which validates them
-            all_sensors = _sensors_with_metric(conn, metric)
-            if len(all_sensors) == 0:
-                return ''
-
-            # Select a single column per sensor (=table), and enough nulls for all
-            # other columns. The query should look like
-            # SELECT * FROM (
-            #   SELECT metric AS sensor1, NULL as sensor2,   NULL as sensor3...
-            #   UNION
-            #   SELECT NULL AS sensor1,   metric as sensor2, NULL as sensor3...
-            #   UNION
-            #   SELECT NULL AS sensor1,   NULL as sensor2,   metric as sensor3...
-            #   UNION
-            #   ...
-            # )
-            sensor_qs = []
-            for sensor in all_sensors:
-                cols_mask = []
-                for other_sensor in all_sensors:
-                    if other_sensor == sensor:
-                        cols_mask.append(f"{metric} AS {sensor}")
-                    else:
-                        cols_mask.append(f"'' AS {other_sensor}")
-                cols = ", ".join(cols_mask)
-                sensor_qs.append(f"SELECT sample_time, {cols} "
-                                 f"FROM {sensor} "
-                                 f"WHERE {metric} IS NOT NULL"
-                                 f"  AND sample_time > datetime('now', '-{time} {unit}')")
-
-            query = "SELECT * FROM (" +\
-                    (" UNION ".join(sensor_qs)) +\
-                    ") ORDER BY sample_time"
-            res = conn.execute(query).fetchall()
-            return _csv(['sample_time'] + all_sensors, res)
+        # sensors in the catalog are already validated
+        all_sensors = self._catalog.sensors_measuring(metric)
+        if len(all_sensors) == 0:
+            return ''
+
+        return _streamed_csv(['sample_time'] + all_sensors,
+                             self._merge_metric_in_sensors(metric, all_sensors, unit, time))
+
+    def _merge_metric_in_sensors(self, metric, sensors, unit, time):
+        """ Csv lines with a column per sensor, and a line per sample of metric in any of the sensors, in time
+        order. Columns of the other sensors are empty. Only one line per sensor is held in memory at a time. """
+        def sensor_lines(idx, samples):
+            before = ',' * (idx + 1)
+            after = ',' * (len(sensors) - idx - 1)
+            # Repeated values of a sensor in the same second are only sent once
+            last_time = None
+            sent = set()
+            for sample_time, val in samples:
+                if sample_time != last_time:
+                    last_time = sample_time
+                    sent.clear()
+                elif val in sent:
+                    continue
+                sent.add(val)
+                yield sample_time, f'{sample_time}{before}{val}{after}\n'
+
+        # Closed when the response is done, or when the client goes away
+        conn = sqlite3.connect(self._dbpath)
+        try:
+            per_sensor = [sensor_lines(idx, self._storage.metric_samples(conn, sensor, metric, unit, time))
+                          for idx, sensor in enumerate(sensors)]
+            # Samples with the same time are sorted by sensor
+            for _, line in heapq.merge(*per_sensor, key=lambda sample: sample[0]):
+                yield line
+        finally:
+            conn.close()
 
     def gc_dead_sensors(self):
-        """Run garbage collection to discard old sensor data based on retention policy."""
-        log.info('Sensor history: run GC to discard old sensors')
-        with sqlite3.connect(self._dbpath) as conn:
-            _discard_old_samples_by_retention_days_all_tables(conn, self._retention_days)
-            _discard_old_samples_by_retention_count_all_tables(conn, self._retention_rows)
-            conn.commit()
-        return "OK"
+        """Discard old sensor data based on retention policy. Returns the number of samples purged and the time
+        spent on each table."""
+        return self._sweep_retention(self._retention_days, self._retention_rows)
+
+    def _purge_in_chunks(self, table, get_cutoff, discard_before):
+        """ Delete rows older than get_cutoff(conn) (if not None) by calling discard_before(conn, cutoff, max_rows)
+        until there is nothing left to delete. Returns the number of rows purged and the time spent. """
+        t_start = time.monotonic()
+        purged = 0
+        try:
+            cutoff = self._writer.run(get_cutoff)
+            while cutoff is not None:
+                n = self._writer.run(lambda conn: discard_before(conn, cutoff, self._retention_chunk_rows))
+                purged += n
+                if n < self._retention_chunk_rows:
+                    break
+        except (sqlite3.Error, RuntimeError, TimeoutError):
+            log.error("Failed to apply retention policy to %s", table, exc_info=True)
+        if purged > 0:
+            _rows_purged.inc(purged, table=table)
+        return {'rows_purged': purged, 'ms': round(1000 * (time.monotonic() - t_start), 1)}
+
+    def _sweep_retention(self, retention_days, retention_rows):
+        """ Deletes old samples of each table in chunks, each one in its own transaction, so that readings can be
+        committed between chunks instead of waiting for the whole sweep """
+        t_sweep_start = time.monotonic()
+        report = {}
+        for sensor_name in self._catalog.sensors():
+            report[sensor_name] = self._purge_in_chunks(
+                sensor_name,
+                lambda conn, s=sensor_name: self._storage.retention_cutoff(conn, s, retention_days, retention_rows),
+                lambda conn, cutoff, max_rows, s=sensor_name: self._storage.discard_before(conn, s, cutoff, max_rows))
+        for tier_name, tier_retention_days in self._rollup_retention_days.items():
+            report[f'_rollup_{tier_name}'] = self._purge_in_chunks(
+                f'_rollup_{tier_name}',
+                lambda conn, days=tier_retention_days: rollup_retention_cutoff(conn, days),
+                lambda conn, cutoff, max_rows, t=tier_name: discard_rollups_before(conn, t, cutoff, max_rows))
+
+        sweep_ms = 1000 * (time.monotonic() - t_sweep_start)
+        _gc_ms.observe(sweep_ms)
+        total_purged = sum(r['rows_purged'] for r in report.values())
+        with self._retention_stats_lock:
+            self._retention_stats['sweeps'] += 1
+            self._retention_stats['rows_purged'] += total_purged
+            self._retention_stats['last_sweep_ms'] = sweep_ms
+        log.info('Sensor history: retention sweep purged %d samples from %d tables in %.1f ms. %s',
+                 total_purged, len(report), sweep_ms,
+                 ', '.join(f"{name}={r['rows_purged']} ({r['ms']} ms)" for name, r in report.items()
+                           if r['rows_purged'] > 0))
+        return report
+
+    def get_retention_stats(self):
+        with self._retention_stats_lock:
+            return dict(self._retention_stats)
 
     def _force_retention_days(self, retention_n):
         retention_n = int(retention_n)
         log.info('Discarding old measurements by forcing DAYS retention to %d', retention_n)
-        with sqlite3.connect(self._dbpath) as conn:
-            _discard_old_samples_by_retention_days_all_tables(conn, retention_n)
-            conn.commit()
-        return "OK"
+        return self._sweep_retention(retention_n, None)
 
     def _force_retention_rows(self, retention_n):
         retention_n = int(retention_n)
         log.info('Discarding old measurements by forcing ROWS retention to %d', retention_n)
-        with sqlite3.connect(self._dbpath) as conn:
-            _discard_old_samples_by_retention_count_all_tables(conn, retention_n)
-            conn.commit()
-        return "OK"
+        return self._sweep_retention(None, retention_n)
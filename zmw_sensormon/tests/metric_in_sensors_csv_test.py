@@ -0,0 +1,135 @@
+import gzip
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from flask import Flask
+
+from sensors import SensorsHistory
+
+_LAYOUTS = ('wide', 'narrow')
+
+
+def _union_csv(dbpath, metric, unit, time_):
+    """ get_single_metric_in_all_sensors_csv as it used to be: a single UNION query over the tables of the wide
+    layout, with a column per sensor and '' in the columns of the other sensors """
+    with sqlite3.connect(dbpath) as conn:
+        tables = [name for (name,) in conn.execute("SELECT name FROM sqlite_schema WHERE type = 'table'")]
+        all_sensors = [name for name in tables
+                       if metric in [col for (_, col, *_) in conn.execute(f'PRAGMA table_info({name})')]]
+        sensor_qs = []
+        for sensor in all_sensors:
+            cols = ', '.join(f'{metric} AS {other}' if other == sensor else f"'' AS {other}"
+                             for other in all_sensors)
+            sensor_qs.append(f"SELECT sample_time, {cols} "
+                             f"FROM {sensor} "
+                             f"WHERE {metric} IS NOT NULL"
+                             f"  AND sample_time > datetime('now', '-{time_} {unit}')")
+        rows = conn.execute("SELECT * FROM (" + (" UNION ".join(sensor_qs)) + ") ORDER BY sample_time").fetchall()
+    csv = ','.join(['sample_time'] + all_sensors) + '\n'
+    for row in rows:
+        csv += ','.join(str(x) for x in row) + '\n'
+    return csv
+
+
+class MetricInSensorsCsvTest(unittest.TestCase):
+    """ The streamed merge of per-sensor samples sends the same lines as the UNION query it replaced """
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self._www = Flask(__name__)
+        self.histories = {
+            layout: SensorsHistory(os.path.join(self._tmpdir.name, f'{layout}.sqlite'), MagicMock(),
+                                   commit_interval_ms=0, storage=layout)
+            for layout in _LAYOUTS}
+        self.now = int(time.time()) - 60
+
+    def tearDown(self):
+        for history in self.histories.values():
+            history.close()
+        self._tmpdir.cleanup()
+
+    def _save(self, sensor_name, values, ts):
+        for history in self.histories.values():
+            with patch('sensors.time.time', return_value=ts):
+                history.save_reading(sensor_name, values)
+            history.flush()
+
+    def _get(self, layout, headers=None, unit='days', time_=1):
+        with self._www.test_request_context(headers=headers):
+            res = self.histories[layout].get_single_metric_in_all_sensors_csv('x', unit, time_)
+            return res.headers, res.get_data()
+
+    def _expected(self, unit='days', time_=1):
+        return _union_csv(self.histories['wide']._dbpath, 'x', unit, time_)
+
+    def assertSameAsUnion(self, unit='days', time_=1):
+        """ Same header and lines as the UNION query. Lines with the same time are sorted by sensor (the UNION
+        didn't define an order for them). Returns the lines, without the header. """
+        expected = self._expected(unit, time_).splitlines()
+        for layout in _LAYOUTS:
+            got = self._get(layout, unit=unit, time_=time_)[1].decode().splitlines()
+            self.assertEqual(got[0], expected[0])
+            self.assertEqual(sorted(got[1:]), sorted(expected[1:]), layout)
+            order = [(line.split(',')[0], [val != '' for val in line.split(',')[1:]].index(True))
+                     for line in got[1:]]
+            self.assertEqual(order, sorted(order), layout)
+        return got[1:]
+
+    def test_lines_are_in_time_order_across_sensors(self):
+        self._save('a', {'x': 1}, self.now - 50)
+        self._save('b', {'x': 2}, self.now - 40)
+        self._save('a', {'x': 3}, self.now - 30)
+        self._save('c', {'x': 4}, self.now - 30)
+        self._save('b', {'x': 5}, self.now - 30)
+        self._save('a', {'x': 6}, self.now - 10)
+        lines = self.assertSameAsUnion()
+        self.assertEqual([line.split(',', 1)[1] for line in lines],
+                         ['1.0,,', ',2.0,', '3.0,,', ',5.0,', ',,4.0', '6.0,,'])
+
+    def test_duplicate_timestamps(self):
+        # Same second, same sensor: repeated values are sent once, different values are all sent
+        self._save('a', {'x': 1}, self.now + 0.1)
+        self._save('a', {'x': 1}, self.now + 0.5)
+        self._save('a', {'x': 2}, self.now + 0.9)
+        # Same second and value, in another sensor
+        self._save('b', {'x': 1}, self.now + 0.5)
+        lines = self.assertSameAsUnion()
+        self.assertEqual([line.split(',', 1)[1] for line in lines], ['1.0,', '2.0,', ',1.0'])
+
+    def test_sensors_without_samples_in_range(self):
+        self._save('a', {'x': 1}, self.now - 3 * 86400)
+        self._save('b', {'x': 2}, self.now - 10)
+        self._save('c', {'y': 3}, self.now - 10)
+        self._save('d', {'x': None, 'y': 4}, self.now - 5)
+        lines = self.assertSameAsUnion()
+        self.assertEqual(self._get('wide')[1].decode().splitlines()[0], 'sample_time,a,b,d')
+        self.assertEqual([line.split(',', 1)[1] for line in lines], [',2.0,'])
+
+    def test_no_samples_in_range(self):
+        self._save('a', {'x': 1}, self.now - 3 * 86400)
+        self.assertEqual(self.assertSameAsUnion(), [])
+
+    def test_many_chunks(self):
+        for i in range(1500):
+            self._save('a' if i % 3 else 'b', {'x': i}, self.now - 1500 + i)
+        self.assertEqual(len(self.assertSameAsUnion()), 1500)
+
+    def test_gzip(self):
+        for i in range(1500):
+            self._save('a' if i % 3 else 'b', {'x': i % 7}, self.now - 1500 + i)
+        for layout in _LAYOUTS:
+            plain_headers, plain = self._get(layout)
+            self.assertNotIn('Content-Encoding', plain_headers)
+            headers, body = self._get(layout, headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(headers['Content-Encoding'], 'gzip')
+            self.assertEqual(headers['Vary'], 'Accept-Encoding')
+            self.assertEqual(gzip.decompress(body), plain)
+            self.assertEqual(sorted(plain.decode().splitlines()), sorted(self._expected().splitlines()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import sqlite3
+import unittest
+
+from sensor_rollups import add_to_rollups, create_rollup_tables, pick_rollup_tier, query_rollup
+
+
+class SensorRollupsTest(unittest.TestCase):
+    """ Aggregates known readings and checks the buckets of every tier """
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        # Readings are two days in the past, so that every tier has them in range of queries for the last 3 days
+        self.day = self.conn.execute("SELECT date('now', '-2 days')").fetchone()[0]
+        self.next_day = self.conn.execute("SELECT date('now', '-1 days')").fetchone()[0]
+        self.readings = [
+            (f'{self.day} 10:00:05', 10, 50),
+            (f'{self.day} 10:00:50', 20, 'n/a'),
+            (f'{self.day} 10:01:00', 30, 60),
+            (f'{self.day} 11:59:59', -5, None),
+            (f'{self.next_day} 00:00:00', 7, 40),
+        ]
+
+    def tearDown(self):
+        self.conn.close()
+
+    def _add_readings(self, sensor_name='Sensor'):
+        for sample_time, temperature, humidity in self.readings:
+            add_to_rollups(self.conn, sensor_name, ['temperature', 'humidity'], [temperature, humidity], sample_time)
+
+    def _query(self, tier, sensor_name='Sensor', metric='temperature'):
+        return query_rollup(self.conn, tier, sensor_name, metric, 'days', 3)
+
+    def test_minute_buckets(self):
+        create_rollup_tables(self.conn, {})
+        self._add_readings()
+        self.assertEqual(self._query('1m'), [
+            (f'{self.day} 10:00:00', 15.0, 10.0, 20.0, 2),
+            (f'{self.day} 10:01:00', 30.0, 30.0, 30.0, 1),
+            (f'{self.day} 11:59:00', -5.0, -5.0, -5.0, 1),
+            (f'{self.next_day} 00:00:00', 7.0, 7.0, 7.0, 1),
+        ])
+
+    def test_hour_buckets(self):
+        create_rollup_tables(self.conn, {})
+        self._add_readings()
+        self.assertEqual(self._query('1h'), [
+            (f'{self.day} 10:00:00', 20.0, 10.0, 30.0, 3),
+            (f'{self.day} 11:00:00', -5.0, -5.0, -5.0, 1),
+            (f'{self.next_day} 00:00:00', 7.0, 7.0, 7.0, 1),
+        ])
+
+    def test_day_buckets(self):
+        create_rollup_tables(self.conn, {})
+        self._add_readings()
+        self.assertEqual(self._query('1d'), [
+            (f'{self.day} 00:00:00', 13.75, -5.0, 30.0, 4),
+            (f'{self.next_day} 00:00:00', 7.0, 7.0, 7.0, 1),
+        ])
+
+    def test_non_numeric_values_are_skipped(self):
+        create_rollup_tables(self.conn, {})
+        self._add_readings()
+        self.assertEqual(self._query('1h', metric='humidity'), [
+            (f'{self.day} 10:00:00', 55.0, 50.0, 60.0, 2),
+            (f'{self.next_day} 00:00:00', 40.0, 40.0, 40.0, 1),
+        ])
+
+    def test_sensors_are_aggregated_separately(self):
+        create_rollup_tables(self.conn, {})
+        self._add_readings('Sensor')
+        add_to_rollups(self.conn, 'Other', ['temperature'], [100], f'{self.day} 10:00:30')
+        self.assertEqual(self._query('1m')[0], (f'{self.day} 10:00:00', 15.0, 10.0, 20.0, 2))
+        self.assertEqual(self._query('1m', sensor_name='Other'), [(f'{self.day} 10:00:00', 100.0, 100.0, 100.0, 1)])
+
+    def test_old_buckets_are_out_of_range(self):
+        create_rollup_tables(self.conn, {})
+        self._add_readings()
+        self.assertEqual(query_rollup(self.conn, '1d', 'Sensor', 'temperature', 'hours', 36),
+                         [(f'{self.next_day} 00:00:00', 7.0, 7.0, 7.0, 1)])
+
+    def test_backfill_matches_incremental_rollups(self):
+        self.conn.execute('CREATE TABLE Sensor (sample_time TEXT, temperature REAL, humidity REAL)')
+        self.conn.executemany('INSERT INTO Sensor VALUES (?, ?, ?)', self.readings)
+        create_rollup_tables(self.conn, {
+            ('Sensor', 'temperature'): ('SELECT sample_time, temperature AS value FROM Sensor', ()),
+        })
+        backfilled = {tier: self._query(tier) for tier in ('1m', '1h', '1d')}
+
+        self.conn.execute('DELETE FROM _rollup_1m')
+        self.conn.execute('DELETE FROM _rollup_1h')
+        self.conn.execute('DELETE FROM _rollup_1d')
+        self._add_readings()
+        self.assertEqual(backfilled, {tier: self._query(tier) for tier in ('1m', '1h', '1d')})
+
+
+class PickRollupTierTest(unittest.TestCase):
+    def test_day_tier(self):
+        self.assertEqual(pick_rollup_tier('days', 100, 100), '1d')
+        self.assertEqual(pick_rollup_tier('days', 99, 100), '1h')
+
+    def test_hour_tier(self):
+        self.assertEqual(pick_rollup_tier('hours', 100, 100), '1h')
+        self.assertEqual(pick_rollup_tier('hours', 99, 100), '1m')
+        self.assertEqual(pick_rollup_tier('days', 4, 96), '1h')
+        self.assertEqual(pick_rollup_tier('days', 4, 97), '1m')
+
+    def test_minute_tier(self):
+        self.assertEqual(pick_rollup_tier('minutes', 100, 100), '1m')
+        self.assertEqual(pick_rollup_tier('minutes', 99, 100), None)
+        self.assertEqual(pick_rollup_tier('seconds', 6000, 100), '1m')
+        self.assertEqual(pick_rollup_tier('seconds', 5999, 100), None)
+
+    def test_long_units(self):
+        self.assertEqual(pick_rollup_tier('months', 1, 30), '1d')
+        self.assertEqual(pick_rollup_tier('months', 1, 31), '1h')
+        self.assertEqual(pick_rollup_tier('years', 1, 365), '1d')
+        self.assertEqual(pick_rollup_tier('years', 1, 366), '1h')
+
+    def test_time_from_a_url(self):
+        self.assertEqual(pick_rollup_tier('days', '100', 100), '1d')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from sensors import SensorsHistory
+
+
+class _FlakyConn:
+    """ Wraps the writer's connection, failing its Nth commit """
+    def __init__(self, conn, fail_on_commit):
+        self._conn = conn
+        self._commits = 0
+        self._fail_on_commit = fail_on_commit
+
+    def commit(self):
+        self._commits += 1
+        if self._commits == self._fail_on_commit:
+            raise sqlite3.OperationalError('disk I/O error')
+        self._conn.commit()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def _rows(history, sensor_name):
+    return history.get_all_metrics_in_sensor_csv(sensor_name).splitlines()[1:]
+
+
+class SensorsDbWriterTestBase:
+    storage = None
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.history = self._open()
+
+    def _open(self):
+        return SensorsHistory(os.path.join(self._tmpdir.name, 'sensors.sqlite'), MagicMock(),
+                              retention_days=30, commit_interval_ms=60000, commit_max_rows=1000,
+                              storage=self.storage)
+
+    def _assert_same_after_restart(self):
+        """ What the service knows matches what's in the db """
+        known = (self.history.get_known_sensors(), self.history.get_all_metrics_in_sensor_csv('a'))
+        self.history.close()
+        self.history = self._open()
+        self.assertEqual(known, (self.history.get_known_sensors(), self.history.get_all_metrics_in_sensor_csv('a')))
+
+    def tearDown(self):
+        self.history.close()
+        self._tmpdir.cleanup()
+
+    def _fail_commit(self, n):
+        writer = self.history._writer
+        writer._conn = _FlakyConn(writer._conn, n)
+
+    def test_readings_are_group_committed(self):
+        self.history.save_reading('a', {'x': 1})
+        self.history.save_reading('a', {'x': 2})
+        time.sleep(0.1)
+        self.assertEqual(_rows(self.history, 'a'), [])
+        self.history.flush()
+        self.assertEqual([r.split(',')[1:] for r in _rows(self.history, 'a')], [['1.0'], ['2.0']])
+
+    def test_unwritable_reading_only_loses_that_reading(self):
+        self.history.save_reading('a', {'x': 1, 'y': 2})
+        self.history.save_reading('a', {'x': 2**64, 'y': 3})
+        self.history.save_reading('a', {'x': 4, 'y': 5})
+        self.history.flush()
+        self.assertEqual([r.split(',')[1:] for r in _rows(self.history, 'a')], [['1.0', '2.0'], ['4.0', '5.0']])
+        self.assertEqual(self.history._writer.get_stats()['errors'], 1)
+        # The writer is still alive
+        self.history.register_sensor('b', ['z'])
+        self.assertEqual(self.history.get_metrics_for_sensor('b'), ['z'])
+
+    def test_failed_schema_change_keeps_catalog_in_sync(self):
+        self.history.save_reading('a', {'x': 1})
+        self.history.flush()
+        # Adding 'y' is the next commit
+        self._fail_commit(1)
+        self.history.save_reading('a', {'x': 2, 'y': 3})
+        self.history.save_reading('a', {'x': 4, 'y': 5})
+        self.history.flush()
+        self.assertEqual(self.history.get_metrics_for_sensor('a'), ['x', 'y'])
+        self.assertEqual([r.split(',')[1:] for r in _rows(self.history, 'a')][-1], ['4.0', '5.0'])
+        self._assert_same_after_restart()
+
+    def test_failed_batch_commit_doesnt_lose_schema_changes(self):
+        self.history.save_reading('a', {'x': 1})
+        self.history.flush()
+        # Readings pending before a schema change are committed, then the schema change, and the batch with the
+        # new metric is the third commit
+        self.history.save_reading('a', {'x': 2})
+        self._fail_commit(3)
+        self.history.save_reading('a', {'x': 3, 'y': 4})
+        self.history.flush()
+        self.assertEqual([r.split(',')[1:] for r in _rows(self.history, 'a')], [['1.0', 'None'], ['2.0', 'None']])
+
+        self.history.save_reading('a', {'x': 5, 'y': 6})
+        self.history.flush()
+        self.assertEqual([r.split(',')[1:] for r in _rows(self.history, 'a')][-1], ['5.0', '6.0'])
+        self.assertEqual(self.history._writer.get_stats()['errors'], 1)
+        self._assert_same_after_restart()
+
+    def test_run_times_out(self):
+        self.assertRaises(TimeoutError, self.history._writer.run, lambda _conn: time.sleep(0.5), 0.1)
+        # Still works once the slow request is done
+        self.history.flush()
+
+    def test_closed_writer_refuses_work(self):
+        self.history.save_reading('a', {'x': 1})
+        self.history.close()
+        self.assertIn('1.0', self.history.get_all_metrics_in_sensor_csv('a'))
+        self.history.save_reading('a', {'x': 2})
+        self.assertEqual(self.history._writer.get_stats()['dropped'], 1)
+        self.assertRaises(RuntimeError, self.history.flush)
+        self.assertRaises(RuntimeError, self.history.register_sensor, 'b', ['z'])
+
+
+class TestWideSensorsDbWriter(SensorsDbWriterTestBase, unittest.TestCase):
+    storage = 'wide'
+
+
+class TestNarrowSensorsDbWriter(SensorsDbWriterTestBase, unittest.TestCase):
+    storage = 'narrow'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from flask import Flask
+
+from sensors import SensorsHistory
+
+_LAYOUTS = ('wide', 'narrow')
+
+
+class StorageLayoutsTest(unittest.TestCase):
+    """ Saves the same readings with every storage layout, and checks every /sensors/* method returns the same """
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self._www = Flask(__name__)
+        self.histories = {}
+
+    def tearDown(self):
+        for history in self.histories.values():
+            history.close()
+        self._tmpdir.cleanup()
+
+    def _open(self, **kwargs):
+        for layout in _LAYOUTS:
+            self.histories[layout] = SensorsHistory(
+                os.path.join(self._tmpdir.name, f'{layout}.sqlite'), MagicMock(), commit_interval_ms=0,
+                storage=layout, **kwargs)
+
+    def _save(self, sensor_name, values, ts):
+        """ Save a reading as if taken at ts """
+        for history in self.histories.values():
+            with patch('sensors.time.time', return_value=ts):
+                history.save_reading(sensor_name, values)
+        for history in self.histories.values():
+            history.flush()
+
+    def _call(self, method, *args):
+        """ {layout: result of method(*args)} """
+        results = {}
+        # Queries are relative to 'now': don't let them straddle a second
+        if time.time() % 1 > 0.8:
+            time.sleep(0.25)
+        for layout, history in self.histories.items():
+            with self._www.test_request_context():
+                res = getattr(history, method)(*args)
+                if hasattr(res, 'get_data'):
+                    res = res.get_data(as_text=True)
+            results[layout] = res
+        return results
+
+    def assertSameInLayouts(self, method, *args):
+        results = self._call(method, *args)
+        self.assertEqual(results['wide'], results['narrow'], f'{method}{args} differs between layouts')
+        return results['wide']
+
+    def _assert_all_methods_match(self):
+        self.assertSameInLayouts('get_known_sensors')
+        self.assertSameInLayouts('get_known_metrics')
+        for sensor_name in self.histories['wide'].get_known_sensors():
+            self.assertSameInLayouts('get_all_metrics_in_sensor_csv', sensor_name)
+            for metric in self.histories['wide'].get_metrics_for_sensor(sensor_name):
+                self.assertSameInLayouts('get_metrics_for_sensor', sensor_name)
+                self.assertSameInLayouts('get_known_sensors_measuring', metric)
+                self.assertSameInLayouts('get_metric_in_sensor_csv', sensor_name, metric)
+                for unit, amount in (('hours', 1), ('days', 1)):
+                    self.assertSameInLayouts('get_metric_in_sensor_csv_time_limit', sensor_name, metric, unit, amount)
+                # Raw samples, and from a rollup
+                self.assertSameInLayouts('get_metric_in_sensor_csv_downsampled', sensor_name, metric, 'hours', 1,
+                                         3600)
+                self.assertSameInLayouts('get_metric_in_sensor_csv_downsampled', sensor_name, metric, 'days', 1, 10)
+                self.assertSameInLayouts('get_single_metric_in_all_sensors_csv', metric, 'days', 1)
+
+    def test_readings(self):
+        self._open(retention_days=30)
+        now = int(time.time()) - 60
+        self._save('a', {'x': 1, 'y': 2}, now - 120)
+        self._save('a', {'x': 3}, now - 60)
+        self._save('a', {'y': 4}, now - 30)
+        self._save('b', {'x': 5}, now - 30)
+        self._assert_all_methods_match()
+        self.assertEqual(self.histories['wide'].get_all_metrics_in_sensor_csv('a').splitlines()[1:],
+                         [f'{t},{x},{y}' for t, x, y in ((now - 120, 1.0, 2.0), (now - 60, 3.0, None),
+                                                         (now - 30, None, 4.0))
+                          for t in [time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(t))]])
+
+    def test_readings_in_the_same_second(self):
+        self._open(retention_days=30)
+        now = int(time.time()) - 60
+        self._save('a', {'x': 1, 'y': 1}, now + 0.1)
+        self._save('a', {'x': 2, 'y': 1}, now + 0.5)
+        # Same millisecond
+        self._save('a', {'x': 3, 'y': 1}, now + 0.5)
+        self._save('a', {'x': 3, 'y': 1}, now + 0.9)
+        self._save('b', {'x': 1}, now + 0.5)
+        self._assert_all_methods_match()
+        self.assertEqual([row.split(',')[1] for row in
+                          self.histories['narrow'].get_all_metrics_in_sensor_csv('a').splitlines()[1:]],
+                         ['1.0', '2.0', '3.0', '3.0'])
+
+    def test_null_only_readings(self):
+        self._open(retention_days=30)
+        now = int(time.time()) - 60
+        self._save('a', {'x': 1, 'y': 2}, now - 20)
+        self._save('a', {'x': None, 'y': None}, now - 10)
+        self._save('a', {'x': None}, now - 5)
+        self._assert_all_methods_match()
+        self.assertEqual(len(self.histories['narrow'].get_all_metrics_in_sensor_csv('a').splitlines()), 4)
+
+    def test_retention_by_rows(self):
+        self._open(retention_days=30, retention_rows=3)
+        now = int(time.time()) - 60
+        for i in range(6):
+            self._save('a', {'x': i, 'y': None if i % 2 else i}, now + i)
+        # Same second as the oldest retained reading
+        self._save('a', {'x': 10}, now + 3.5)
+        self._save('b', {'x': 1}, now)
+        # The narrow layout counts purged samples (one per metric), not readings
+        purged = self._call('gc_dead_sensors')
+        self.assertEqual(purged['wide'].keys(), purged['narrow'].keys())
+        self._assert_all_methods_match()
+        self.assertEqual([row.split(',')[1] for row in
+                          self.histories['narrow'].get_all_metrics_in_sensor_csv('a').splitlines()[1:]],
+                         ['3.0', '10.0', '4.0', '5.0'])
+
+    def test_metric_history_range_boundaries(self):
+        self._open(retention_days=30)
+        now = int(time.time())
+        for secs_ago in (3602, 3601, 3600, 3599, 3598, 1):
+            self._save('a', {'x': secs_ago}, now - secs_ago)
+        # A second that doesn't start a reading, then one on the limit of 'days'
+        self._save('a', {'x': 86401}, now - 86401)
+        self._save('a', {'x': 86399}, now - 86399)
+        self._assert_all_methods_match()
+        hour = self.assertSameInLayouts('get_metric_in_sensor_csv_time_limit', 'a', 'x', 'hours', 1)
+        self.assertNotIn('3601.0', hour)
+        self.assertIn('3598.0', hour)
+
+    def test_clock_going_back(self):
+        self._open(retention_days=30)
+        now = int(time.time()) - 60
+        self._save('a', {'x': 1}, now + 0.5)
+        self._save('a', {'x': 2}, now + 10)
+        # Clock went back: the reading keeps its time, even if there's a reading there already
+        self._save('a', {'x': 3}, now + 0.5)
+        self._save('a', {'x': 4}, now + 5)
+        self._save('a', {'x': 5}, now + 11)
+        self._assert_all_methods_match()
+        self.assertEqual([row.split(',')[1] for row in
+                          self.histories['narrow'].get_all_metrics_in_sensor_csv('a').splitlines()[1:]],
+                         ['1.0', '3.0', '4.0', '2.0', '5.0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -105,7 +105,13 @@ class ZmwSensormon(ZmwMqttNullSvc):
         www_path = os.path.join(pathlib.Path(__file__).parent.resolve(), 'www')
         self._public_url_base = www.register_www_dir(www_path)
 
-        self._sensors = SensorsHistory(dbpath=cfg['db_path'], scheduler=sched, retention_days=cfg['retention_days'])
+        self._sensors = SensorsHistory(dbpath=cfg['db_path'], scheduler=sched, retention_days=cfg['retention_days'],
+                                       commit_interval_ms=cfg.get('db_commit_interval_ms', 1000),
+                                       commit_max_rows=cfg.get('db_commit_max_rows', 100),
+                                       synchronous=cfg.get('db_synchronous', 'NORMAL'),
+                                       retention_sweep_minutes=cfg.get('retention_sweep_minutes', 10),
+                                       rollup_retention_days=cfg.get('rollup_retention_days'),
+                                       storage=cfg.get('db_storage', 'wide'))
         self._sensors.register_to_webserver(www)
 
         self._z2m = Z2MProxy(cfg, self, sched,
@@ -124,6 +130,11 @@ class ZmwSensormon(ZmwMqttNullSvc):
         www.serve_url('/sensors/get/<name>', self._get_sensor_values)
         www.serve_url('/sensors/get_all/<metric>', self._get_all_sensor_values)
 
+    def stop(self):
+        # Stop receiving readings first, then commit the ones still waiting
+        super().stop()
+        self._sensors.close()
+
     def _get_sensor_values(self, name):
         """Unified endpoint to get current sensor values from any backend."""
         # Check Shelly devices first (they're not in z2m)
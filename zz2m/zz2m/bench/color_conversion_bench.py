@@ -0,0 +1,52 @@
+""" Conversions per second between RGB strings and CIE xy, with and without the caches in light_helpers.
+
+Run from zz2m/zz2m with `python bench/color_conversion_bench.py`
+"""
+
+from pathlib import Path
+import random
+import sys
+import timeit
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / 'zzmw_lib'))
+
+# pylint: disable=wrong-import-position,protected-access
+from zz2m import light_helpers
+
+N_CONVERSIONS = 20000
+# A UI only ever shows a handful of colors, so most conversions are repeats
+N_DISTINCT_COLORS = 50
+
+
+def _uncached_rgb_str_to_cie_xy(rgb):
+    rgb = rgb.lstrip('#')
+    rgb_color = (int(rgb[0:2], 16), int(rgb[2:4], 16), int(rgb[4:6], 16))
+    # Same as light_helpers._rgb_to_cie_xy, without the gamma lookup table
+    r, g, b = (light_helpers._gamma_correct(c / 255.0) for c in rgb_color)
+    x = r * 0.649926 + g * 0.103455 + b * 0.197109
+    y = r * 0.234327 + g * 0.743075 + b * 0.022598
+    z = r * 0.000000 + g * 0.053077 + b * 1.035763
+    return {'x': x / (x + y + z), 'y': y / (x + y + z)}
+
+
+def _report(name, func, inputs):
+    secs = timeit.timeit(lambda: [func(i) for i in inputs], number=1)
+    print(f'{name:40} {len(inputs) / secs:12.0f} conversions/sec')
+
+
+def main():
+    rnd = random.Random(42)
+    colors = [f'#{rnd.randrange(1, 0xFFFFFF):06X}' for _ in range(N_DISTINCT_COLORS)]
+    rgbs = [rnd.choice(colors) for _ in range(N_CONVERSIONS)]
+    xys = [light_helpers._rgb_str_to_cie_xy(rgb) for rgb in rgbs]
+
+    _report('rgb->xy, no LUT, no cache', _uncached_rgb_str_to_cie_xy, rgbs)
+    _report('rgb->xy, LUT, no cache', light_helpers._rgb_str_to_cie_xy_cached.__wrapped__, rgbs)
+    _report('rgb->xy, LUT + cache', light_helpers._rgb_str_to_cie_xy, rgbs)
+    _report('xy->rgb, no cache', lambda xy: light_helpers._cie_xy_to_rgb_str_cached.__wrapped__(xy['x'], xy['y']), xys)
+    _report('xy->rgb, cache', light_helpers._cie_xy_to_rgb_str, xys)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+""" Memory used by the local replica of a synthetic 200 devices Zigbee network.
+
+Run from zz2m/zz2m with `python bench/thing_memory_bench.py`
+"""
+
+from pathlib import Path
+import gc
+import sys
+import tracemalloc
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / 'zzmw_lib'))
+sys.path.insert(0, str(Path(__file__).parent.parent / 'tests'))
+
+# pylint: disable=wrong-import-position
+from setup import get_a_lamp, get_contact_sensor, get_lamp_with_composite_action, get_motion_sensor
+from zz2m.thing import parse_from_zigbee2mqtt
+
+N_DEVICES = 200
+_DEVICE_MODELS = [get_a_lamp, get_contact_sensor, get_motion_sensor, get_lamp_with_composite_action]
+
+
+def _synthetic_network(n_devices):
+    devs = []
+    for i in range(n_devices):
+        dev = _DEVICE_MODELS[i % len(_DEVICE_MODELS)]()
+        dev['ieee_address'] = f'0x{i:016x}'
+        dev['friendly_name'] = f'Device{i}'
+        devs.append(dev)
+    return devs
+
+
+def main():
+    devs = _synthetic_network(N_DEVICES)
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    things = [parse_from_zigbee2mqtt(i, dev) for i, dev in enumerate(devs)]
+    after, peak = tracemalloc.get_traced_memory()
+    # What's left once the things are gone is the memory used by their actions
+    actions = [t.actions for t in things]
+    n_things = len(things)
+    del things
+    gc.collect()
+    actions_only, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    total = after - before
+    actions_total = actions_only - before
+    n_actions = sum(len(a) for a in actions)
+    print(f'{n_things} things, {n_actions} actions')
+    print(f'Total: {total / 1024:.1f} KiB (peak while parsing {(peak - before) / 1024:.1f} KiB)')
+    print(f'Per thing, including its actions: {total / n_things:.0f} bytes')
+    print(f'Per action: {actions_total / n_actions:.0f} bytes')
+
+
+if __name__ == '__main__':
+    main()
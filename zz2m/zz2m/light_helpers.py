@@ -1,11 +1,28 @@
 from .thing import Zigbee2MqttAction
 from .thing import Zigbee2MqttActionValue
 
+from functools import lru_cache
 import time
 
 from zzmw_lib.logs import build_logger
 log = build_logger("Z2M")
 
+# Conversions are cached on their input; xy coordinates are rounded to this many decimals (Z2M reports 4) to
+# build the cache key
+_XY_CACHE_DECIMALS = 4
+_COLOR_CACHE_SIZE = 512
+
+
+def _gamma_correct(color_elm):
+    if color_elm > 0.04045:
+        return pow((color_elm + 0.055) / (1.0 + 0.055), 2.4)
+    return color_elm / 12.92
+
+
+# Gamma correction of each 8 bit color channel value
+_GAMMA_LUT = tuple(_gamma_correct(i / 255.0) for i in range(256))
+
+
 def _rgb_to_cie_xy(rgb_color):
     """
 https://github.com/PhilipsHue/PhilipsHueSDK-iOS-OSX/commit/f41091cf671e13fe8c32fcced12604cd31cceaf3
@@ -142,11 +159,6 @@ The following links provide further useful related information
 * A Review of RGB Color Spaces:
     http://www.babelcolor.com/download/A%20review%20of%20RGB%20color%20spaces.pdf
 """
-    def gamma_correct(color_elm):
-        if color_elm > 0.04045:
-            return pow((color_elm + 0.055) / (1.0 + 0.055), 2.4)
-        return color_elm / 12.92
-
     # Normalize RGB to max brightness for consistent round-trips
     # This ensures that e.g. (128, 0, 0) and (255, 0, 0) produce the same xy
     #max_val = max(rgb_color)
@@ -154,7 +166,8 @@ The following links provide further useful related information
     #    rgb_color = tuple(c * 255.0 / max_val for c in rgb_color)
 
     # Convert RGB to %, then gamma correct
-    rgb_gamma_pct = tuple(gamma_correct(color_elm / 255.0)
+    rgb_gamma_pct = tuple(_GAMMA_LUT[color_elm] if isinstance(color_elm, int) and 0 <= color_elm <= 255
+                          else _gamma_correct(color_elm / 255.0)
                           for color_elm in rgb_color)
 
     # Do magic to get XYZ (aka "Wide RGB D65 conversion formula")
@@ -175,7 +188,12 @@ The following links provide further useful related information
 def _rgb_str_to_cie_xy(rgb):
     if not isinstance(rgb, str):
         raise ValueError('_rgb_str_to_cie_xy only works with strings')
+    # Callers get their own copy of the cached value
+    return dict(_rgb_str_to_cie_xy_cached(rgb))
 
+
+@lru_cache(maxsize=_COLOR_CACHE_SIZE)
+def _rgb_str_to_cie_xy_cached(rgb):
     if rgb[0] == '#':
         rgb = rgb[1:]
 
@@ -204,9 +222,12 @@ def _cie_xy_to_rgb_str(xy):
     if xy is None:
         return None
 
-    x = xy.get('x', 0)
-    y = xy.get('y', 0)
+    return _cie_xy_to_rgb_str_cached(round(xy.get('x', 0), _XY_CACHE_DECIMALS),
+                                     round(xy.get('y', 0), _XY_CACHE_DECIMALS))
+
 
+@lru_cache(maxsize=_COLOR_CACHE_SIZE)
+def _cie_xy_to_rgb_str_cached(x, y):
     # Avoid division by zero
     if y == 0:
         return '#000000'
@@ -350,9 +371,11 @@ def _monkeypatch_light(light):
                 _current=None,
             ))
 
-def monkeypatch_lights(z2m):
-    """ Look for all lights in an instance of z2m and apply useful monkeypatches """
-    for light in z2m.get_things_if(lambda t: t.thing_type == 'light'):
+def monkeypatch_lights(z2m, things=None):
+    """ Look for all lights in an instance of z2m (or only in things, if set) and apply useful monkeypatches """
+    if things is None:
+        things = z2m.get_all_registered_things()
+    for light in [t for t in things if t.thing_type == 'light']:
         log.debug("Thing %s is a light, will monkeypatch", light.name)
         _monkeypatch_light(light)
 
@@ -385,7 +408,8 @@ def light_group_toggle_brightness_pct(z2m, light_group):
     return turned_on
 
 def turn_all_lights_off(z2m, transition_secs=None):
-    """ Turns ALL lights off (even lights that are already off, just in case) """
+    """ Turns ALL lights off (even lights that are already off, just in case). Lights that are members of a
+    Zigbee2MQTT group get a single group command, see Z2MProxy.broadcast_things """
     lights = z2m.get_things_if(lambda t: t.thing_type == 'light')
     for light in lights:
         light.set('state', False)
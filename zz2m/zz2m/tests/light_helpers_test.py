@@ -0,0 +1,36 @@
+import unittest
+from zz2m.light_helpers import _GAMMA_LUT
+from zz2m.light_helpers import _cie_xy_to_rgb_str
+from zz2m.light_helpers import _gamma_correct
+from zz2m.light_helpers import _rgb_str_to_cie_xy
+from zz2m.light_helpers import _rgb_to_cie_xy
+
+
+class TestColorConversions(unittest.TestCase):
+    def test_lut_matches_gamma_formula(self):
+        for c in range(256):
+            self.assertEqual(_GAMMA_LUT[c], _gamma_correct(c / 255.0))
+        # Non 8 bit values still work
+        self.assertEqual(_rgb_to_cie_xy((255, 10, 0)), _rgb_to_cie_xy((255.0, 10.0, 0.0)))
+
+    def test_rgb_str_formats(self):
+        self.assertEqual(_rgb_str_to_cie_xy('#FF0000'), _rgb_str_to_cie_xy('FF0000'))
+        self.assertEqual(_rgb_str_to_cie_xy('#FF0000'), _rgb_str_to_cie_xy('FF0000AA'))
+        self.assertRaises(ValueError, _rgb_str_to_cie_xy, 'FF000')
+        self.assertRaises(ValueError, _rgb_str_to_cie_xy, 0xFF0000)
+
+    def test_cached_results_cant_be_modified(self):
+        xy = _rgb_str_to_cie_xy('#00FF00')
+        xy['x'] = 42
+        self.assertNotEqual(_rgb_str_to_cie_xy('#00FF00')['x'], 42)
+
+    def test_xy_to_rgb(self):
+        self.assertEqual(_cie_xy_to_rgb_str(None), None)
+        self.assertEqual(_cie_xy_to_rgb_str({'x': 0.5, 'y': 0}), '#000000')
+        self.assertEqual(_cie_xy_to_rgb_str(_rgb_str_to_cie_xy('FFFFFF')), 'F4FFFF')
+        # Cache key is rounded to the precision Z2M reports
+        self.assertEqual(_cie_xy_to_rgb_str({'x': 0.3, 'y': 0.3}), _cie_xy_to_rgb_str({'x': 0.300001, 'y': 0.3}))
+
+
+if __name__ == '__main__':
+    unittest.main()
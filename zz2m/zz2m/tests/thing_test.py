@@ -333,6 +333,27 @@ class TestThings(unittest.TestCase):
         with self.assertRaises(ValueError):
             t.set('effect', 'FOO')
 
+    def test_validate_rejects_like_set(self):
+        t = parse_from_zigbee2mqtt(0, get_a_lamp())
+        with self.assertRaises(ValueError):
+            t.validate('brightness', 12345)
+        with self.assertRaises(ValueError):
+            t.validate('effect', 'FOO')
+        with self.assertRaises(ValueError):
+            t.validate('linkquality', 123)
+        with self.assertRaises(AttributeError):
+            t.validate('foo', 1)
+
+    def test_validate_doesnt_change_values(self):
+        t = parse_from_zigbee2mqtt(0, get_a_lamp())
+        version = t.get_version()
+        t.validate('brightness', 123)
+        t.validate('state', 'ON')
+        t.validate('color_temp', 'warm')
+        self.assertEqual(t.get_version(), version)
+        self.assertEqual(t.get('brightness'), None)
+        self.assertEqual(t.make_mqtt_status_update(), {})
+
     def test_propagates_user_changes(self):
         t = parse_from_zigbee2mqtt(0, get_a_lamp())
 
@@ -436,6 +457,82 @@ class TestThings(unittest.TestCase):
         self.assertEqual(t.get_json_state()['occupancy'], False)
         self.assertEqual(t.get_json_state()['linkquality'], 65)
 
+    def test_out_of_schema_field_from_mqtt_adds_action(self):
+        t = parse_from_zigbee2mqtt(0, get_a_lamp())
+        t.on_mqtt_update('topic', {'brightness': 42, 'not_in_schema': 7})
+        self.assertEqual(t.get('brightness'), 42)
+        self.assertEqual(t.get('not_in_schema'), 7)
+        t.on_mqtt_update('topic', {'not_in_schema': 8})
+        self.assertEqual(t.get('not_in_schema'), 8)
+
+    def test_action_lookup_sees_new_actions(self):
+        t = parse_from_zigbee2mqtt(0, get_a_lamp())
+        self.assertRaises(AttributeError, t.set, 'not_in_schema', 1)
+        t.on_mqtt_update('topic', {'not_in_schema': 7})
+        t.set('not_in_schema', 1)
+        self.assertEqual(t.get('not_in_schema'), 1)
+        del t.actions['not_in_schema']
+        self.assertRaises(AttributeError, t.set, 'not_in_schema', 1)
+
+    def test_same_model_things_share_metadata(self):
+        t1 = parse_from_zigbee2mqtt(0, get_a_lamp())
+        t2 = parse_from_zigbee2mqtt(1, get_a_lamp())
+        self.assertIs(t1.actions['brightness'].value.meta, t2.actions['brightness'].value.meta)
+        t1.set('brightness', 42)
+        self.assertEqual(t1.get('brightness'), 42)
+        self.assertIsNone(t2.get('brightness'))
+
+    def test_version_increases_on_changes(self):
+        t = parse_from_zigbee2mqtt(0, get_a_lamp())
+        v = t.get_version()
+        t.on_mqtt_update('topic', {'brightness': 42})
+        self.assertGreater(t.get_version(), v)
+        v = t.get_version()
+        t.set('brightness', 43)
+        self.assertGreater(t.get_version(), v)
+        v = t.get_version()
+        t.extras.set('foo', 1)
+        self.assertGreater(t.get_version(), v)
+        v = t.get_version()
+        t.on_mqtt_update('topic', {'not_in_schema': 7})
+        self.assertGreater(t.get_version(), v)
+
+    def test_action_dict_tracks_every_schema_change(self):
+        t = parse_from_zigbee2mqtt(0, get_a_lamp())
+        changes = []
+        t.actions.on_schema_change = lambda: changes.append(t.actions.version)
+        brightness = t.actions['brightness']
+
+        self.assertIs(t.actions.setdefault('brightness', None), brightness)
+        self.assertIsNone(t.actions.pop('not_an_action', None))
+        self.assertRaises(KeyError, t.actions.pop, 'not_an_action')
+        self.assertEqual(changes, [])
+
+        self.assertIs(t.actions.pop('brightness'), brightness)
+        self.assertIsNone(t.actions.find_accepting('brightness', 1))
+        self.assertIs(t.actions.setdefault('brightness', brightness), brightness)
+        self.assertIs(t.actions.find_accepting('brightness', 1), brightness)
+        t.actions |= {'brightness': brightness}
+        name, _ = t.actions.popitem()
+        self.assertNotIn(name, t.actions)
+        t.actions.clear()
+        self.assertIsNone(t.actions.find_accepting('brightness', 1))
+        t.actions.clear()
+        self.assertEqual(changes, [1, 2, 3, 4, 5])
+
+    def test_json_state_is_cached_until_thing_changes(self):
+        t = parse_from_zigbee2mqtt(0, get_a_lamp())
+        t.on_mqtt_update('topic', {'brightness': 42})
+        state = t.get_json_state()
+        self.assertEqual(state['brightness'], 42)
+        # Callers get their own copy of the state
+        state['brightness'] = 1
+        state['extras']['foo'] = 1
+        self.assertEqual(t.get_json_state()['brightness'], 42)
+        self.assertEqual(t.get_json_state()['extras'], {})
+        t.actions['brightness'].set_value(43)
+        self.assertEqual(t.get_json_state()['brightness'], 43)
+
     def test_composite_action_parses_ok(self):
         t = parse_from_zigbee2mqtt(0, get_lamp_with_composite_action())
         self.assertEqual(t.actions['color_hs'].name, 'color_hs')
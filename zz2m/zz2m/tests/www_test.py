@@ -0,0 +1,74 @@
+from setup import get_a_lamp
+
+import time
+import unittest
+from unittest.mock import MagicMock
+from flask import Flask
+from zz2m.www import _SetCoalescer, _thing_put
+from zz2m.z2mproxy import Z2MProxy
+
+
+def _make_coalescer(window_secs=0.05):
+    mqtt = MagicMock()
+    z2m = Z2MProxy({}, mqtt, MagicMock())
+    z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp()])
+    return _SetCoalescer(z2m, window_secs), mqtt
+
+
+def _sets(mqtt):
+    return [c.args[1] for c in mqtt.broadcast.call_args_list if c.args[0] == 'zigbee2mqtt/Oficina/set']
+
+
+class TestSetCoalescer(unittest.TestCase):
+    def test_first_set_is_sent_right_away(self):
+        coalescer, mqtt = _make_coalescer()
+        coalescer.set('Oficina', {'brightness': 10})
+        self.assertEqual(_sets(mqtt), [{'brightness': 10}])
+
+    def test_only_latest_value_is_sent_when_window_ends(self):
+        coalescer, mqtt = _make_coalescer()
+        coalescer.set('Oficina', {'brightness': 10})
+        coalescer.set('Oficina', {'brightness': 20})
+        coalescer.set('Oficina', {'brightness': 30, 'state': 'ON'})
+        self.assertEqual(_sets(mqtt), [{'brightness': 10}])
+        time.sleep(0.2)
+        self.assertEqual(_sets(mqtt), [{'brightness': 10}, {'brightness': 30, 'state': 'ON'}])
+
+    def test_set_after_window_is_sent_right_away(self):
+        coalescer, mqtt = _make_coalescer()
+        coalescer.set('Oficina', {'brightness': 10})
+        time.sleep(0.2)
+        coalescer.set('Oficina', {'brightness': 20})
+        self.assertEqual(_sets(mqtt), [{'brightness': 10}, {'brightness': 20}])
+
+    def test_invalid_sets_fail_within_window(self):
+        coalescer, _ = _make_coalescer()
+        coalescer.set('Oficina', {'brightness': 10})
+        self.assertRaises(AttributeError, coalescer.set, 'Oficina', {'not_an_action': 1})
+        self.assertRaises(KeyError, coalescer.set, 'NotAThing', {'brightness': 1})
+
+    def test_invalid_values_fail_within_window(self):
+        coalescer, mqtt = _make_coalescer()
+        coalescer.set('Oficina', {'brightness': 10})
+        self.assertRaises(ValueError, coalescer.set, 'Oficina', {'brightness': 12345})
+        self.assertRaises(ValueError, coalescer.set, 'Oficina', {'linkquality': 1})
+        # A set is applied completely or not at all
+        self.assertRaises(ValueError, coalescer.set, 'Oficina', {'state': 'ON', 'effect': 'FOO'})
+        coalescer.set('Oficina', {'brightness': 20})
+        time.sleep(0.2)
+        self.assertEqual(_sets(mqtt), [{'brightness': 10}, {'brightness': 20}])
+
+    def test_http_set_within_window_reports_invalid_values(self):
+        coalescer, mqtt = _make_coalescer()
+        www = Flask(__name__)
+        with www.test_request_context(method='PUT', json={'brightness': 10}):
+            self.assertEqual(_thing_put(coalescer._z2m, 'Oficina', coalescer), 'null')
+        with www.test_request_context(method='PUT', json={'brightness': 12345}):
+            _, status = _thing_put(coalescer._z2m, 'Oficina', coalescer)
+            self.assertEqual(status, 422)
+        time.sleep(0.2)
+        self.assertEqual(_sets(mqtt), [{'brightness': 10}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,452 @@
+from setup import get_a_lamp
+from setup import get_contact_sensor
+
+import copy
+import json
+import time
+import unittest
+from unittest.mock import MagicMock
+from zz2m.z2mproxy import Z2MProxy
+from zzmw_lib.mqtt_trace import MqttTrace, activate_trace
+
+
+def _make_proxy(cb_is_device_interesting=None, selective_subscriptions=None):
+    mqtt = MagicMock()
+    z2m = Z2MProxy({}, mqtt, MagicMock(), cb_is_device_interesting=cb_is_device_interesting,
+                   selective_subscriptions=selective_subscriptions)
+    return z2m, mqtt
+
+
+def _lamp(n):
+    lamp = get_a_lamp()
+    lamp['ieee_address'] = f'0x{n:016x}'
+    lamp['friendly_name'] = f'Lamp{n}'
+    return lamp
+
+
+def _group(gid, name, lamp_ids):
+    return {'id': gid, 'friendly_name': name, 'members': [{'ieee_address': f'0x{n:016x}', 'endpoint': 1}
+                                                        for n in lamp_ids]}
+
+
+def _broadcasts(mqtt):
+    return [(c.args[0], c.args[1]) for c in mqtt.broadcast.call_args_list]
+
+
+def _exact_subscriptions(mqtt):
+    subscribed = {c.args[0]: c.args[1] for c in mqtt.subscribe_with_cb.call_args_list if c.kwargs.get('exact')}
+    for c in mqtt.unsubscribe_cb.call_args_list:
+        if c.kwargs.get('exact'):
+            subscribed.pop(c.args[0])
+    return subscribed
+
+
+def _redefined_lamp():
+    """ The lamp of get_a_lamp, with a new brightness range """
+    lamp = get_a_lamp()
+    lamp['definition']['exposes'][0]['features'][1]['value_max'] = 100
+    return lamp
+
+
+class TestZ2MProxyRouting(unittest.TestCase):
+    def test_device_list_registers_things(self):
+        z2m, _ = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp(), get_contact_sensor()])
+        self.assertEqual(set(z2m.get_thing_names()), {'Oficina', 'SensorPuertaEntrada'})
+
+    def test_messages_routed_to_thing(self):
+        z2m, _ = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp()])
+        z2m._on_z2m_json_msg('Oficina', {'brightness': 42})
+        self.assertEqual(z2m.get_thing('Oficina').get('brightness'), 42)
+        z2m._on_z2m_json_msg('0x847127fffecda276', {'brightness': 43})
+        self.assertEqual(z2m.get_thing('Oficina').get('brightness'), 43)
+
+    def test_republished_device_list_doesnt_grow_routes(self):
+        z2m, _ = _make_proxy()
+        devs = [get_a_lamp(), get_contact_sensor()]
+        groups = [{'id': 1}, {'id': 2}]
+        z2m._on_z2m_json_msg('bridge/devices', devs)
+        z2m._on_z2m_json_msg('bridge/groups', groups)
+        stats = z2m.get_routing_stats()
+        for _ in range(5):
+            z2m._on_z2m_json_msg('bridge/devices', copy.deepcopy(devs))
+            z2m._on_z2m_json_msg('bridge/groups', groups)
+        new_stats = z2m.get_routing_stats()
+        self.assertEqual(stats['subtopics'], new_stats['subtopics'])
+        self.assertEqual(stats['callbacks'], new_stats['callbacks'])
+
+    def test_removed_group_removes_routes(self):
+        z2m, _ = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/groups', [{'id': 1}, {'id': 2}])
+        z2m._on_z2m_json_msg('bridge/groups', [{'id': 1}])
+        z2m._on_z2m_json_msg('2/availability', {})
+        self.assertEqual(z2m.get_routing_stats()['unhandled_msgs'], 1)
+
+    def test_thing_leaving_network_is_unregistered(self):
+        z2m, mqtt = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp(), get_contact_sensor()])
+        z2m._on_z2m_json_msg('bridge/devices', [get_contact_sensor()])
+        self.assertEqual(z2m.get_thing_names(), ['SensorPuertaEntrada'])
+        mqtt.unsubscribe_cb.assert_called_once()
+        z2m._on_z2m_json_msg('Oficina', {'brightness': 42})
+        self.assertEqual(z2m.get_routing_stats()['unhandled_msgs'], 1)
+
+    def test_unchanged_devices_are_not_reparsed(self):
+        z2m, _ = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp(), get_contact_sensor()])
+        lamp = z2m.get_thing('Oficina')
+        lamp_id = lamp.thing_id
+        z2m._on_z2m_json_msg('bridge/devices', [get_contact_sensor(), get_a_lamp()])
+        self.assertIs(z2m.get_thing('Oficina'), lamp)
+        self.assertEqual(z2m.get_thing('Oficina').thing_id, lamp_id)
+
+    def test_changed_device_is_reparsed_with_same_id(self):
+        z2m, _ = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp(), get_contact_sensor()])
+        lamp = z2m.get_thing('Oficina')
+        renamed_lamp = get_a_lamp()
+        renamed_lamp['friendly_name'] = 'Cocina'
+        z2m._on_z2m_json_msg('bridge/devices', [renamed_lamp, get_contact_sensor()])
+        self.assertEqual(set(z2m.get_thing_names()), {'Cocina', 'SensorPuertaEntrada'})
+        self.assertEqual(z2m.get_thing('Cocina').thing_id, lamp.thing_id)
+        z2m._on_z2m_json_msg('Cocina', {'brightness': 42})
+        self.assertEqual(z2m.get_thing('Cocina').get('brightness'), 42)
+        z2m._on_z2m_json_msg('Oficina', {'brightness': 42})
+        self.assertEqual(z2m.get_routing_stats()['unhandled_msgs'], 1)
+
+    def test_redefined_device_is_updated_in_place(self):
+        z2m, _ = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp(), get_contact_sensor()])
+        lamp = z2m.get_thing('Oficina')
+        on_brightness = MagicMock()
+        on_any_change = MagicMock()
+        lamp.actions['brightness'].value.on_change_from_mqtt = on_brightness
+        lamp.on_any_change_from_mqtt = on_any_change
+        z2m._on_z2m_json_msg('Oficina', {'state': 'ON', 'brightness': 42})
+        state_action = lamp.actions['state']
+
+        redefined_lamp = get_a_lamp()
+        redefined_lamp['definition']['exposes'][0]['features'][1]['value_max'] = 100
+        z2m._on_z2m_json_msg('bridge/devices', [redefined_lamp, get_contact_sensor()])
+
+        self.assertIs(z2m.get_thing('Oficina'), lamp)
+        self.assertIs(lamp.actions['state'], state_action)
+        self.assertEqual(lamp.actions['brightness'].value.meta['value_max'], 100)
+        self.assertEqual(lamp.get('brightness'), 42)
+        self.assertTrue(lamp.is_light_on())
+        self.assertIn('level_config', lamp.actions)
+        z2m._on_z2m_json_msg('Oficina', {'brightness': 50})
+        on_brightness.assert_called_with(50)
+        on_any_change.assert_called_with(lamp)
+
+    def test_redefined_device_drops_actions_not_in_its_definition(self):
+        z2m, _ = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp()])
+        lamp = z2m.get_thing('Oficina')
+        net_hash = z2m.get_known_things_hash()
+        redefined_lamp = get_a_lamp()
+        features = redefined_lamp['definition']['exposes'][0]['features']
+        redefined_lamp['definition']['exposes'][0]['features'] = [f for f in features if f['name'] != 'color_temp']
+        z2m._on_z2m_json_msg('bridge/devices', [redefined_lamp])
+        self.assertIs(z2m.get_thing('Oficina'), lamp)
+        self.assertNotIn('color_temp', lamp.actions)
+        self.assertNotEqual(z2m.get_known_things_hash(), net_hash)
+
+    def test_uninteresting_things_are_ignored(self):
+        z2m, _ = _make_proxy(cb_is_device_interesting=lambda t: t.thing_type == 'light')
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp(), get_contact_sensor()])
+        self.assertEqual(z2m.get_thing_names(), ['Oficina'])
+        z2m._on_z2m_json_msg('SensorPuertaEntrada', {'contact': False})
+        stats = z2m.get_routing_stats()
+        self.assertEqual(stats['unhandled_msgs'], 0)
+        self.assertEqual(stats['hits']['SensorPuertaEntrada'], 1)
+
+
+class TestZ2MProxyWorldState(unittest.TestCase):
+    def test_world_state_json(self):
+        z2m, _ = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp(), get_contact_sensor()])
+        z2m._on_z2m_json_msg('Oficina', {'brightness': 42})
+        _, body = z2m.get_world_state_json()
+        self.assertEqual(json.loads(body), z2m.get_world_state())
+
+    def test_etag_changes_only_when_world_changes(self):
+        z2m, _ = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp(), get_contact_sensor()])
+        etag, body = z2m.get_world_state_json()
+        self.assertEqual(z2m.get_world_state_json(), (etag, body))
+
+        z2m._on_z2m_json_msg('Oficina', {'brightness': 42})
+        etag2, body2 = z2m.get_world_state_json()
+        self.assertNotEqual(etag, etag2)
+        self.assertNotEqual(body, body2)
+
+        z2m.get_thing('SensorPuertaEntrada').extras.set('foo', 1)
+        etag3, _ = z2m.get_world_state_json()
+        self.assertNotEqual(etag2, etag3)
+
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp()])
+        etag4, body4 = z2m.get_world_state_json()
+        self.assertNotEqual(etag3, etag4)
+        self.assertEqual([list(t.keys()) for t in json.loads(body4)], [['Oficina']])
+
+    def test_redefined_thing_never_repeats_an_etag(self):
+        z2m, _ = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp()])
+        lamp = z2m.get_thing('Oficina')
+        etags = set()
+        versions = []
+        for i in range(10):
+            z2m._on_z2m_json_msg('Oficina', {'brightness': 100 + i})
+            etags.add(z2m.get_world_state_json()[0])
+            versions.append(lamp.get_version())
+
+        # The brightness action is replaced, and with it the count of its updates
+        z2m._on_z2m_json_msg('bridge/devices', [_redefined_lamp()])
+        for i in range(15):
+            z2m._on_z2m_json_msg('Oficina', {'brightness': i})
+            self.assertGreater(lamp.get_version(), versions[-1])
+            versions.append(lamp.get_version())
+            etag, body = z2m.get_world_state_json()
+            self.assertNotIn(etag, etags)
+            etags.add(etag)
+            self.assertEqual(lamp.get_json_state()['brightness'], i)
+            self.assertEqual(json.loads(body)[0]['Oficina']['brightness'], i)
+
+
+class TestZ2MProxyNetworkHash(unittest.TestCase):
+    def test_hash_depends_on_known_things_only(self):
+        z2m, _ = _make_proxy()
+        empty_hash = z2m.get_known_things_hash()
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp(), get_contact_sensor()])
+        net_hash = z2m.get_known_things_hash()
+        self.assertNotEqual(empty_hash, net_hash)
+        z2m._on_z2m_json_msg('Oficina', {'brightness': 42})
+        self.assertEqual(net_hash, z2m.get_known_things_hash())
+
+        other_z2m, _ = _make_proxy()
+        other_z2m._on_z2m_json_msg('bridge/devices', [get_contact_sensor(), get_a_lamp()])
+        self.assertEqual(net_hash, other_z2m.get_known_things_hash())
+
+    def test_hash_changes_when_things_leave(self):
+        z2m, _ = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/devices', [get_contact_sensor()])
+        sensor_hash = z2m.get_known_things_hash()
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp(), get_contact_sensor()])
+        self.assertNotEqual(sensor_hash, z2m.get_known_things_hash())
+        z2m._on_z2m_json_msg('bridge/devices', [get_contact_sensor()])
+        self.assertEqual(sensor_hash, z2m.get_known_things_hash())
+
+    def test_hash_changes_with_actions(self):
+        z2m, _ = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp(), get_contact_sensor()])
+        net_hash = z2m.get_known_things_hash()
+        z2m._on_z2m_json_msg('Oficina', {'not_in_schema': 42})
+        self.assertNotEqual(net_hash, z2m.get_known_things_hash())
+
+
+class TestZ2MProxyChanges(unittest.TestCase):
+    def test_no_cursor_returns_full_state(self):
+        z2m, _ = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp(), get_contact_sensor()])
+        changes = z2m.get_changes()
+        self.assertTrue(changes['full'])
+        self.assertEqual(changes['changed']['Oficina'], z2m.get_thing('Oficina').get_json_state())
+        self.assertEqual(set(changes['changed'].keys()), {'Oficina', 'SensorPuertaEntrada'})
+
+    def test_returns_only_changed_fields(self):
+        z2m, _ = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp(), get_contact_sensor()])
+        cursor = z2m.get_changes()['cursor']
+        changes = z2m.get_changes(cursor)
+        self.assertFalse(changes['full'])
+        self.assertEqual(changes['changed'], {})
+
+        z2m._on_z2m_json_msg('Oficina', {'brightness': 42})
+        z2m._on_z2m_json_msg('Oficina', {'brightness': 43, 'state': 'ON'})
+        changes = z2m.get_changes(cursor)
+        self.assertFalse(changes['full'])
+        self.assertEqual(changes['changed'], {'Oficina': {'brightness': 43, 'state': True}})
+        self.assertEqual(z2m.get_changes(changes['cursor'])['changed'], {})
+
+    def test_reports_changes_after_a_redefinition(self):
+        z2m, _ = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp()])
+        for i in range(10):
+            z2m._on_z2m_json_msg('Oficina', {'brightness': 100 + i})
+        cursor = z2m.get_changes()['cursor']
+        version = z2m.get_thing('Oficina').get_version()
+
+        z2m._on_z2m_json_msg('bridge/devices', [_redefined_lamp()])
+        # Look for changes once the thing is back at (or past) the version last seen by the change feed
+        for i in range(20):
+            z2m._on_z2m_json_msg('Oficina', {'brightness': i})
+            if z2m.get_thing('Oficina').get_version() >= version:
+                break
+        changes = z2m.get_changes(cursor)
+        self.assertFalse(changes['full'])
+        self.assertEqual(changes['changed']['Oficina'].get('brightness'), i)
+
+    def test_reports_things_leaving(self):
+        z2m, _ = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp(), get_contact_sensor()])
+        cursor = z2m.get_changes()['cursor']
+        z2m._on_z2m_json_msg('bridge/devices', [get_contact_sensor()])
+        changes = z2m.get_changes(cursor)
+        self.assertEqual(changes['removed'], ['Oficina'])
+        self.assertEqual(changes['changed'], {})
+
+    def test_expired_cursor_returns_full_state(self):
+        z2m = Z2MProxy({'z2m_change_log_size': 2}, MagicMock(), MagicMock())
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp()])
+        cursor = z2m.get_changes()['cursor']
+        for i in range(3):
+            z2m._on_z2m_json_msg('Oficina', {'brightness': i})
+            z2m.get_changes(cursor)
+        self.assertTrue(z2m.get_changes(cursor)['full'])
+        self.assertTrue(z2m.get_changes('bad-cursor')['full'])
+
+
+class TestZ2MProxyGroupBroadcasts(unittest.TestCase):
+    def _make_proxy_with_groups(self):
+        z2m, mqtt = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/devices', [_lamp(1), _lamp(2), _lamp(3), _lamp(4)])
+        z2m._on_z2m_json_msg('bridge/groups', [_group(1, 'Living', [1, 2]), _group(2, 'All', [1, 2, 3, 4])])
+        return z2m, mqtt
+
+    def test_same_update_for_whole_group_sends_group_command(self):
+        z2m, mqtt = self._make_proxy_with_groups()
+        names = ['Lamp1', 'Lamp2', 'Lamp3', 'Lamp4']
+        for name in names:
+            z2m.get_thing(name).turn_off()
+        z2m.broadcast_things(names)
+        self.assertEqual(_broadcasts(mqtt), [('zigbee2mqtt/All/set', {'state': 'OFF'})])
+
+    def test_partial_group_uses_smaller_group_and_unicasts(self):
+        z2m, mqtt = self._make_proxy_with_groups()
+        names = ['Lamp1', 'Lamp2', 'Lamp3']
+        for name in names:
+            z2m.get_thing(name).turn_on()
+        z2m.broadcast_things(names)
+        self.assertEqual(_broadcasts(mqtt), [('zigbee2mqtt/Living/set', {'state': 'ON'}),
+                                             ('zigbee2mqtt/Lamp3/set', {'state': 'ON'})])
+
+    def test_different_updates_are_sent_per_thing(self):
+        z2m, mqtt = self._make_proxy_with_groups()
+        z2m.get_thing('Lamp1').turn_on()
+        z2m.get_thing('Lamp2').turn_off()
+        z2m.broadcast_things(['Lamp1', 'Lamp2'])
+        self.assertEqual(_broadcasts(mqtt), [('zigbee2mqtt/Lamp1/set', {'state': 'ON'}),
+                                             ('zigbee2mqtt/Lamp2/set', {'state': 'OFF'})])
+
+    def test_removed_group_is_not_used(self):
+        z2m, mqtt = self._make_proxy_with_groups()
+        z2m._on_z2m_json_msg('bridge/groups', [])
+        for name in ['Lamp1', 'Lamp2']:
+            z2m.get_thing(name).turn_off()
+        z2m.broadcast_things(['Lamp1', 'Lamp2'])
+        self.assertEqual(len(_broadcasts(mqtt)), 2)
+
+    def test_group_messages_are_ignored(self):
+        z2m, _ = self._make_proxy_with_groups()
+        z2m._on_z2m_json_msg('Living', {'state': 'ON'})
+        self.assertEqual(z2m.get_routing_stats()['unhandled_msgs'], 0)
+
+
+class TestZ2MProxyBatch(unittest.TestCase):
+    def test_batch_merges_updates_per_thing(self):
+        z2m, mqtt = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/devices', [_lamp(1), _lamp(2)])
+        with z2m.batch() as batch:
+            z2m.get_thing('Lamp1').set('transition', 2)
+            z2m.broadcast_thing('Lamp1')
+            z2m.get_thing('Lamp1').set('brightness', 42)
+            z2m.broadcast_thing('Lamp1')
+            z2m.get_thing('Lamp2').turn_on()
+            z2m.broadcast_things(['Lamp2'])
+            self.assertEqual(_broadcasts(mqtt), [])
+        self.assertEqual(_broadcasts(mqtt), [('zigbee2mqtt/Lamp1/set', {'transition': 2, 'brightness': 42}),
+                                             ('zigbee2mqtt/Lamp2/set', {'state': 'ON'})])
+        self.assertEqual(batch.msgs_sent, 2)
+        self.assertEqual(batch.msgs_saved, 1)
+        self.assertEqual(z2m.get_broadcast_stats()['batch_msgs_saved'], 1)
+
+    def test_nested_batches_send_once(self):
+        z2m, mqtt = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/devices', [_lamp(1)])
+        with z2m.batch():
+            with z2m.batch():
+                z2m.get_thing('Lamp1').turn_on()
+                z2m.broadcast_thing('Lamp1')
+            self.assertEqual(_broadcasts(mqtt), [])
+        self.assertEqual(_broadcasts(mqtt), [('zigbee2mqtt/Lamp1/set', {'state': 'ON'})])
+
+    def test_batch_uses_groups(self):
+        z2m, mqtt = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/devices', [_lamp(1), _lamp(2)])
+        z2m._on_z2m_json_msg('bridge/groups', [_group(1, 'Living', [1, 2])])
+        with z2m.batch() as batch:
+            for name in ['Lamp1', 'Lamp2']:
+                z2m.get_thing(name).turn_off()
+                z2m.broadcast_thing(name)
+        self.assertEqual(_broadcasts(mqtt), [('zigbee2mqtt/Living/set', {'state': 'OFF'})])
+        self.assertEqual(batch.msgs_saved, 1)
+        self.assertEqual(z2m.get_broadcast_stats(), {'batches': 1, 'batch_msgs_saved': 0, 'group_msgs_saved': 1})
+
+
+class TestZ2MProxySelectiveSubscriptions(unittest.TestCase):
+    def test_default_subscribes_to_everything(self):
+        _, mqtt = _make_proxy()
+        mqtt.subscribe_with_cb.assert_called_once()
+        self.assertEqual(mqtt.subscribe_with_cb.call_args.args[0], 'zigbee2mqtt')
+
+    def test_subscribes_to_bridge_and_interesting_things(self):
+        z2m, mqtt = _make_proxy(cb_is_device_interesting=lambda t: t.thing_type == 'light',
+                                selective_subscriptions=True)
+        self.assertEqual(mqtt.subscribe_with_cb.call_args_list[0].args[0], 'zigbee2mqtt/bridge')
+        bridge_cb = mqtt.subscribe_with_cb.call_args_list[0].args[1]
+        bridge_cb('devices', [get_a_lamp(), get_contact_sensor()])
+        self.assertEqual(z2m.get_thing_names(), ['Oficina'])
+
+        subs = _exact_subscriptions(mqtt)
+        self.assertEqual(set(subs.keys()), {'zigbee2mqtt/Oficina', 'zigbee2mqtt/Oficina/set'})
+        subs['zigbee2mqtt/Oficina']('', {'brightness': 42})
+        self.assertEqual(z2m.get_thing('Oficina').get('brightness'), 42)
+
+    def test_unsubscribes_things_that_leave(self):
+        z2m, mqtt = _make_proxy(selective_subscriptions=True)
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp(), get_contact_sensor()])
+        self.assertEqual(len(_exact_subscriptions(mqtt)), 4)
+        z2m._on_z2m_json_msg('bridge/devices', [get_contact_sensor()])
+        self.assertEqual(set(_exact_subscriptions(mqtt).keys()),
+                         {'zigbee2mqtt/SensorPuertaEntrada', 'zigbee2mqtt/SensorPuertaEntrada/set'})
+
+
+class TestZ2MProxyTracing(unittest.TestCase):
+    def test_trace_is_labeled_with_thing_and_action(self):
+        z2m, _ = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp()])
+        seen = []
+        z2m.get_thing('Oficina').actions['brightness'].value.on_change_from_mqtt = \
+                lambda _val: seen.append((trace.thing, trace.action))
+
+        trace = MqttTrace('zigbee2mqtt/Oficina', time.monotonic())
+        activate_trace(trace)
+        try:
+            z2m._on_z2m_json_msg('Oficina', {'brightness': 5})
+        finally:
+            activate_trace(None)
+
+        self.assertEqual(seen, [('Oficina', 'brightness')])
+        self.assertEqual(set(trace.stages), {'routing', 'update'})
+
+    def test_untraced_messages_still_work(self):
+        z2m, _ = _make_proxy()
+        z2m._on_z2m_json_msg('bridge/devices', [get_a_lamp()])
+        z2m._on_z2m_json_msg('Oficina', {'brightness': 5})
+        self.assertEqual(z2m.get_thing('Oficina').get('brightness'), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
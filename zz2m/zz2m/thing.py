@@ -1,17 +1,25 @@
 """ Global representation of Zigbee things """
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Callable
 import json
+import sys
 from json import JSONDecodeError
 
 from zzmw_lib.logs import build_logger
+from zzmw_lib.mqtt_trace import label_trace, mark_trace
 from zz2m.thing_extras import ThingExtras
 
 log = build_logger("Z2M")
 
 _Z2M_IGNORE_ACTIONS = ['update']
 
+# Action metadata is the same for every device of the same model, so things share one (read only) copy of it.
+# Only the metadata of simple types is shared: composites hold per-thing values, and user defined actions hold
+# per-thing callbacks.
+_SHAREABLE_META_TYPES = ('binary', 'numeric', 'enum')
+_shared_metas = {}
+
 
 class ActionDict(dict):
     """
@@ -19,14 +27,107 @@ class ActionDict(dict):
     instead of a KeyError if an action is missing. This is to make it
     easier to describe when a thing doesn't exist (KeyError) from when
     a thing is valid but doesn't support an action (AttributeError)
+
+    Every method that adds or removes actions bumps the version of the
+    dict, and notifies on_schema_change. The version also absorbs the
+    versions of the values of removed (or replaced) actions, so that the
+    version of a thing (which adds up the versions of its values) never
+    goes down.
+
+    It also keeps an index of property name -> actions that may accept
+    that property, rebuilt only when actions are added or removed, so that
+    finding the action for a field of an MQTT message doesn't need to scan
+    all actions.
     """
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._index = None
+        # Bumped whenever actions are added or removed
+        self.version = 0
+        # Called (with no args) whenever actions are added or removed
+        self.on_schema_change = None
+
+    def _on_schema_change(self, dropped=()):
+        self._index = None
+        self.version += 1 + sum(getattr(action.value, '_version', 0) for action in dropped)
+        if self.on_schema_change is not None:
+            self.on_schema_change()
+
     def __getitem__(self, key):
         try:
             return super().__getitem__(key)
         except KeyError as exc:
             raise AttributeError(f'{key} is not a known action') from exc
 
+    def _replaced_by(self, new_actions):
+        return [old for key, old in self.items() if key in new_actions and new_actions[key] is not old]
+
+    def __setitem__(self, key, val):
+        dropped = self._replaced_by({key: val})
+        super().__setitem__(key, val)
+        self._on_schema_change(dropped)
+
+    def __delitem__(self, key):
+        dropped = [super().__getitem__(key)] if key in self else []
+        super().__delitem__(key)
+        self._on_schema_change(dropped)
+
+    def update(self, *args, **kwargs):
+        new_actions = dict(*args, **kwargs)
+        dropped = self._replaced_by(new_actions)
+        super().update(new_actions)
+        self._on_schema_change(dropped)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super().pop(key, *default)
+        val = super().pop(key)
+        self._on_schema_change([val])
+        return val
+
+    def popitem(self):
+        item = super().popitem()
+        self._on_schema_change([item[1]])
+        return item
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return super().__getitem__(key)
+        self[key] = default
+        return default
+
+    def clear(self):
+        if len(self) == 0:
+            return
+        dropped = list(self.values())
+        super().clear()
+        self._on_schema_change(dropped)
+
+    def _build_index(self):
+        index = {}
+        for action in self.values():
+            index.setdefault(action.name, []).append(action)
+            # Composites are set through their property, which may be different from their name
+            if action.value.meta['type'] == 'composite':
+                prop = action.value.meta.get('property')
+                if prop is not None and prop != action.name:
+                    index.setdefault(prop, []).append(action)
+        return index
+
+    def find_accepting(self, key, val):
+        """ Returns the action that accepts a value for key, or None if no action does """
+        if self._index is None:
+            self._index = self._build_index()
+        for action in self._index.get(key, ()):
+            if action.accepts_value(key, val):
+                return action
+        return None
+
     def dictify(self):
         """ Get metadata on supported actions """
         return {k: v.dictify() for k, v in self.items()}
@@ -63,6 +164,14 @@ class Zigbee2MqttThing:
     """
     Describes a zigbee2mqtt object. Holds a map of actions (the features/variables/
     actions/reports/etc that a zigbee2mqtt object supports)
+
+    Unlike actions, things aren't slotted: helpers (eg monkeypatch_lights) add
+    methods to them.
+
+    Each thing has a version, which increases whenever one of its action values
+    or extras is set, or when actions are added or removed. Code changing the
+    state of a thing in other ways (eg a user defined action reading external
+    state) should call bump_version.
     """
     thing_id: int
     address: str
@@ -81,6 +190,9 @@ class Zigbee2MqttThing:
     # Callback whenever any action is updated from MQTT
     on_any_change_from_mqtt: Callable = None
     user_defined: map = None
+    _version: int = field(default=0, repr=False)
+    # (version, state) of the last get_json_state
+    _json_state_cache: tuple = field(default=None, repr=False)
 
     def dictify(self):
         """ Get metadata on this thing """
@@ -122,49 +234,28 @@ class Zigbee2MqttThing:
         object, the callback will be invoked only if the change was accepted.
         Note the topic may either be the name, addr or alias of this thing
         """
+        label_trace(thing=self.name)
         changes = []
         thing_updated = False
-        # Signals that iterating over this message failed, and it needs to be retried
-        needs_retry = False
-        for mqtt_msg_field in msg:
-            try:
-                val = msg[mqtt_msg_field]
-                changed_action = self._set(mqtt_msg_field, val, set_by_user=False)
-                # Keep a list of all changes' callbacks
-                if changed_action is not None:
-                    thing_updated = True
-                    changes.append((changed_action.value.on_change_from_mqtt, val))
-            except AttributeError:
+        for mqtt_msg_field, val in msg.items():
+            action = self.actions.find_accepting(mqtt_msg_field, val)
+            if action is None:
+                if mqtt_msg_field in _Z2M_IGNORE_ACTIONS:
+                    continue
                 # Some battery powered devices don't seem to respect their
                 # schema?
                 if mqtt_msg_field == 'battery':
                     self.battery = val
-                elif mqtt_msg_field == 'voltage':
+                    continue
+                if mqtt_msg_field == 'voltage':
                     self.voltage = val
-                else:
-                    log.warning(
-                        'Unsupported action in mqtt message: thing %s ID %d has no %s, will add it',
-                        self.name,
-                        self.thing_id,
-                        mqtt_msg_field)
-                    log.debug('Exception in MQTT message %s', msg)
-                    # A thing triggered an action that wasn't declared in its schema. Add it to the schema and retry.
-                    def act_set(x):
-                        self.actions[mqtt_msg_field].value._current = x
-                    self.actions[mqtt_msg_field] = make_user_defined_zigbee2mqttaction(
-                                thing_name=self.name,
-                                name=mqtt_msg_field,
-                                description=f"Out-of-schema action '{mqtt_msg_field}'",
-                                setter=act_set,
-                                getter=lambda: self.actions[mqtt_msg_field].value._current)
-                    # We added an action, but a message may contain multiple missing actions. When this happens,
-                    # exit the for loop and retry the entire message. Alternatively, we can try exiting the catch
-                    # so that a new missing attribute will be processed, but retrying the entire message seems simpler
-                    needs_retry = True
-                    break
+                    continue
+                action = self._add_out_of_schema_action(mqtt_msg_field, msg)
 
-        if needs_retry:
-            self.on_mqtt_update(topic, msg)
+            action.set_value_from_mqtt_update(val)
+            # Keep a list of all changes' callbacks
+            thing_updated = True
+            changes.append((action.name, action.value.on_change_from_mqtt, val))
 
         if self.debug_mqtt_actions:
             if len(changes) != 0:
@@ -183,13 +274,81 @@ class Zigbee2MqttThing:
         # Once the update is done, invoke user callbacks. At this point
         # * The update is fully complete
         # * If the callback throws, we can let the exception propagate safely
-        for cb_mqtt_chg, val in changes:
+        mark_trace('update')
+        for action_name, cb_mqtt_chg, val in changes:
             if cb_mqtt_chg is not None:
+                label_trace(action=action_name)
                 cb_mqtt_chg(val)
 
         if thing_updated and self.on_any_change_from_mqtt is not None:
+            label_trace(action=changes[0][0] if len(changes) == 1 else '*')
             self.on_any_change_from_mqtt(self)
 
+    def update_definition(self, other):
+        """
+        The device behind this thing was redefined (eg re-interviewed, or its firmware was updated) without being
+        renamed. Take the definition from other, a freshly parsed copy of the same device, but keep this object: users
+        of the thing hold references to it, and to its callbacks. Actions that didn't change are kept as they are;
+        actions that changed keep their current value and callbacks. User defined actions (added by helpers, or seen
+        in messages but not in the schema) aren't part of the definition, so they are kept too.
+        """
+        self.real_name = other.real_name
+        self.broken = other.broken
+        self.manufacturer = other.manufacturer
+        self.model = other.model
+        self.description = other.description
+        self.thing_type = other.thing_type
+
+        actions = {}
+        for name, action in other.actions.items():
+            old = dict.get(self.actions, name)
+            if old is not None and _action_definition(old) == _action_definition(action):
+                actions[name] = old
+                continue
+            if old is not None:
+                action.value.on_change_from_mqtt = old.value.on_change_from_mqtt
+                if old.value.meta['type'] == action.value.meta['type'] != 'composite':
+                    action.value._current = old.value._current
+            actions[name] = action
+        for name, action in self.actions.items():
+            if name not in actions and action.value.meta['type'] == 'user_defined':
+                actions[name] = action
+
+        removed = [name for name in self.actions if name not in actions]
+        changed = {name: action for name, action in actions.items() if dict.get(self.actions, name) is not action}
+        for name in removed:
+            del self.actions[name]
+        if len(changed) > 0:
+            self.actions.update(changed)
+        self.bump_version()
+
+    def _add_out_of_schema_action(self, field, msg):
+        """ A thing triggered an action that wasn't declared in its schema. Add it to the schema. """
+        log.warning(
+            'Unsupported action in mqtt message: thing %s ID %d has no %s, will add it',
+            self.name,
+            self.thing_id,
+            field)
+        log.debug('Exception in MQTT message %s', msg)
+        def act_set(x):
+            self.actions[field].value._current = x
+        self.actions[field] = make_user_defined_zigbee2mqttaction(
+                    thing_name=self.name,
+                    name=field,
+                    description=f"Out-of-schema action '{field}'",
+                    setter=act_set,
+                    getter=lambda: self.actions[field].value._current)
+        return self.actions[field]
+
+    def validate(self, key, val):
+        """ Raises the same error as set(key, val) would, without changing any value """
+        action = self.actions.find_accepting(key, val)
+        if action is not None:
+            action.validate_value(val)
+        elif key not in _Z2M_IGNORE_ACTIONS:
+            raise AttributeError(
+                f'{self.name}[{self.thing_id}] has no action {key} {self.debug_str()}')
+
     def set(self, key, val):
         """ Set value (by user). Propagates to value object, applies metadata-validation """
         if self.debug_mqtt_actions:
@@ -197,16 +356,16 @@ class Zigbee2MqttThing:
         self._set(key, val, set_by_user=True)
 
     def _set(self, key, val, set_by_user=True):
-        for _act_name, action in self.actions.items():
-            if action.accepts_value(key, val):
-                # log.debug('Action %s[%d].%s accepts set %s = %s from %s',
-                #             self.name, self.thing_id, _act_name, key, val,
-                #             'user' if set_by_user else 'MQTT')
-                if set_by_user:
-                    action.set_value(val)
-                else:
-                    action.set_value_from_mqtt_update(val)
-                return action
+        action = self.actions.find_accepting(key, val)
+        if action is not None:
+            # log.debug('Action %s[%d].%s accepts set %s = %s from %s',
+            #             self.name, self.thing_id, action.name, key, val,
+            #             'user' if set_by_user else 'MQTT')
+            if set_by_user:
+                action.set_value(val)
+            else:
+                action.set_value_from_mqtt_update(val)
+            return action
 
         if key in _Z2M_IGNORE_ACTIONS:
             # Signal no action has been changed
@@ -219,17 +378,46 @@ class Zigbee2MqttThing:
         """ Gets current state of an action (throws if action doesn't exist) """
         return self.actions[key].value.get_value()
 
+    def bump_version(self):
+        """ Mark the state of this thing as changed """
+        self._version += 1
+
+    def get_version(self):
+        """ Monotonically increasing version of the state and schema of this thing. Every part of it only goes up:
+        versions of removed or replaced actions are kept by the action dict. """
+        version = self._version + self.actions.version
+        if self.extras is not None:
+            version += self.extras.get_version()
+        for action in self.actions.values():
+            version += action.value._version
+        return version
+
     def get_json_state(self):
-        """ Gets known state of all actions (if state isn't null) """
-        state = {}
-        for action_name in self.actions:
-            val = self.actions[action_name].get_value()
-            if val is not None:
-                state.update(val)
-        state['thing_name'] = self.name
-        state['extras'] = self.extras.get_all()
+        """ Gets known state of all actions (if state isn't null). The state is
+        cached until this thing's version changes, callers get their own copy of it. """
+        # Read the version before building the state: if the thing changes
+        # while building it, the cached state will be rebuilt on the next call
+        version = self.get_version()
+        cached = self._json_state_cache
+        if cached is None or cached[0] != version:
+            state = {}
+            for action_name in self.actions:
+                val = self.actions[action_name].get_value()
+                if val is not None:
+                    state.update(val)
+            state['thing_name'] = self.name
+            state['extras'] = self.extras.get_all()
+            cached = (version, state)
+            self._json_state_cache = cached
+
+        state = dict(cached[1])
+        state['extras'] = dict(state['extras'])
         return state
 
+    def has_pending_mqtt_update(self):
+        """ True if make_mqtt_status_update would (probably) return a non empty update """
+        return any(action.value._needs_mqtt_propagation for action in self.actions.values())
+
     def make_mqtt_status_update(self):
         """ Prepares a map with actions that need their state propagated to MQTT """
         state = {}
@@ -238,7 +426,7 @@ class Zigbee2MqttThing:
         return state
 
 
-@dataclass(frozen=False)
+@dataclass(frozen=False, slots=True)
 class Zigbee2MqttActionValue:
     """
     Holds metadata and current value for an action. The metadata describes
@@ -249,11 +437,15 @@ class Zigbee2MqttActionValue:
     If a data race happens between an incoming MQTT update and a user update,
     the user update wins: the "needs propagation" flag won't be cleared, and
     the user changes will be retained.
+
+    meta may be shared with other things of the same model: don't modify it.
     """
     thing_name: str  # Only needed to print error messages
     meta: dict
     _current: object = None
     _needs_mqtt_propagation: bool = False
+    # Bumped whenever the value is set
+    _version: int = 0
     # Triggered whenever this action is updated from MQTT
     on_change_from_mqtt: Callable = None
 
@@ -310,6 +502,21 @@ class Zigbee2MqttActionValue:
         # log.debug('User set %s.action = %s', self.thing_name, val)
         self._needs_mqtt_propagation = True
 
+        return self._set_value(self._parse_composite(val))
+
+    def validate_value(self, val):
+        """ Raises ValueError if val can't be set, without changing the current value """
+        val = self._parse_composite(val)
+        if self.meta['type'] != 'composite':
+            self._checked_value(val)
+            return
+        for key in val:
+            sub_action = self.meta['composite_actions'].get(key)
+            # Unknown keys are ignored when set
+            if sub_action is not None and not isinstance(sub_action, IgnoredAction):
+                sub_action.value.validate_value(val[key])
+
+    def _parse_composite(self, val):
         # Values for composites may come as a string (eg from Flask) instead of
         # a dict
         if self.meta['type'] == 'composite' and isinstance(val, str):
@@ -319,8 +526,7 @@ class Zigbee2MqttActionValue:
             except JSONDecodeError:
                 # This wasn't a JSON after all
                 pass
-
-        return self._set_value(val)
+        return val
 
     def set_value_from_mqtt_update(self, val):
         """
@@ -338,7 +544,9 @@ class Zigbee2MqttActionValue:
         except ValueError as ex:
             log.error(ex)
 
-    def _set_value(self, val):
+    def _checked_value(self, val):
+        """ The value to store for a set to val (eg with presets replaced). Raises ValueError if val isn't valid
+        for this action. Composite and user defined values are returned as they are. """
         def log_bad_set():
             raise ValueError(
                 f'{self.thing_name} received invalid value {val} - {self.debug_str()}')
@@ -355,18 +563,16 @@ class Zigbee2MqttActionValue:
         # Binaries need some extra magic
         if self.meta['type'] == 'binary':
             if isinstance(val, bool):
-                self._current = val
-            elif val == self.meta['value_on']:
-                self._current = True
-            elif val == self.meta['value_off']:
-                self._current = False
-            elif isinstance(val, str) and val.lower() in ['true', '1']:
-                self._current = True
-            elif isinstance(val, str) and val.lower() in ['false', '0']:
-                self._current = False
-            else:
-                log_bad_set()
-            return
+                return val
+            if val == self.meta['value_on']:
+                return True
+            if val == self.meta['value_off']:
+                return False
+            if isinstance(val, str) and val.lower() in ['true', '1']:
+                return True
+            if isinstance(val, str) and val.lower() in ['false', '0']:
+                return False
+            log_bad_set()
 
         if self.meta['type'] == 'numeric':
             if (self.meta['value_min'] is not None) and (
@@ -375,19 +581,40 @@ class Zigbee2MqttActionValue:
             if (self.meta['value_max'] is not None) and (
                     int(val) > self.meta['value_max']):
                 log_bad_set()
+            return val
+
+        if self.meta['type'] == 'enum':
+            if val not in self.meta['values'] and len(self.meta['values']) != 0:
+                log_bad_set()
+            return val
+
+        if self.meta['type'] == 'list':
+            if not isinstance(val, list):
+                log_bad_set()
+            # Validate length constraints if specified
+            if self.meta.get('length_min') is not None and len(val) < self.meta['length_min']:
+                log_bad_set()
+            if self.meta.get('length_max') is not None and len(val) > self.meta['length_max']:
+                log_bad_set()
+            return val
+
+        return val
+
+    def _set_value(self, val):
+        self._version += 1
+        val = self._checked_value(val)
+
+        if self.meta['type'] in ('binary', 'numeric', 'list'):
+            # Lists are stored directly - zigbee2mqtt will validate item contents
             self._current = val
             return
 
         if self.meta['type'] == 'enum':
-            if val in self.meta['values']:
-                self._current = val
-            elif len(self.meta['values']) == 0:
+            if len(self.meta['values']) == 0:
                 # Some things seem to have no metadata for enums, so don't raise an error
                 log.warning(
                     'Thing "%s" received enum val "%s", but valid values set is empty', self.thing_name, val)
-                self._current = val
-            else:
-                log_bad_set()
+            self._current = val
             return
 
         if self.meta['type'] == 'composite':
@@ -411,18 +638,6 @@ class Zigbee2MqttActionValue:
             self.meta["on_set"](val)
             return
 
-        if self.meta['type'] == 'list':
-            if not isinstance(val, list):
-                log_bad_set()
-            # Validate length constraints if specified
-            if self.meta.get('length_min') is not None and len(val) < self.meta['length_min']:
-                log_bad_set()
-            if self.meta.get('length_max') is not None and len(val) > self.meta['length_max']:
-                log_bad_set()
-            # Store the list directly - zigbee2mqtt will validate item contents
-            self._current = val
-            return
-
         log.error('Thing %s has an unsuported action: %s',
                      self.thing_name, self.meta["type"])
         self._current = val
@@ -490,7 +705,7 @@ def make_user_defined_zigbee2mqttaction(
         ))
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Zigbee2MqttAction:
     """
     Holds the immutable bits of Zigbee2MqttActionValue.
@@ -555,10 +770,18 @@ class Zigbee2MqttAction:
         Updates state from user, will set needs-propagation flag.
         Will throw if this action is read-only.
         """
+        self._check_can_set(val)
+        self.value.set_value(val)
+
+    def validate_value(self, val):
+        """ Throws like set_value would, without changing the value """
+        self._check_can_set(val)
+        self.value.validate_value(val)
+
+    def _check_can_set(self, val):
         if not self.can_set and (self.value.meta['type'] != 'composite'):
             raise ValueError(
                 f'Tried to set {self.name} to {val}, but action is read only')
-        self.value.set_value(val)
 
     def get_value(self):
         """ Returns currently known value (which may be out of sync with MQTT) """
@@ -652,10 +875,27 @@ def _get_action_metadata(thing_name, action):
     return meta
 
 
+def _action_definition(action):
+    """ Everything that describes an action, but not its state """
+    meta = action.value.meta
+    if meta['type'] == 'composite':
+        meta = {**meta, 'composite_actions': {k: _action_definition(sub) for k, sub in meta['composite_actions'].items()
+                                              if not isinstance(sub, IgnoredAction)}}
+    return (action.description, action.can_set, action.can_get, meta)
+
+
+def _share_action_metadata(meta):
+    """ Returns an already known, identical, copy of meta if there is one """
+    if meta['type'] not in _SHAREABLE_META_TYPES:
+        return meta
+    key = json.dumps(meta, sort_keys=True)
+    return _shared_metas.setdefault(key, meta)
+
+
 def _build_zigbee2mqtt_action_value(thing_name, action):
     return Zigbee2MqttActionValue(
         thing_name=thing_name,
-        meta=_get_action_metadata(thing_name, action),
+        meta=_share_action_metadata(_get_action_metadata(thing_name, action)),
     )
 
 
@@ -668,14 +908,18 @@ def _parse_zigbee2mqtt_action(thing_name, action):
         name = action['property']
 
     return Zigbee2MqttAction(
-        name=name,
-        description=action.get('description', ''),
+        name=sys.intern(name),
+        description=sys.intern(action.get('description', '')),
         can_set=(int(action.get('access', 0)) & 0b010 != 0),
         can_get=(int(action.get('access', 0)) & 0b100 != 0),
         value=_build_zigbee2mqtt_action_value(thing_name, action),
     )
 
 
+def _intern_or_none(val):
+    return sys.intern(val) if isinstance(val, str) else val
+
+
 def _parse_zigbee2mqtt_actions(thing_name, definition):
     thing_type = None
     actions = {}
@@ -727,10 +971,10 @@ def parse_from_zigbee2mqtt(thing_id, thing, known_aliases=None):
         name=name,
         real_name=real_name,
         broken=(not thing['interview_completed']) and (not thing['interviewing']),
-        manufacturer=thing.get('manufacturer', None),
-        model=model,
-        description=definition.get('description', None),
-        thing_type=thing_type,
+        manufacturer=_intern_or_none(thing.get('manufacturer', None)),
+        model=_intern_or_none(model),
+        description=_intern_or_none(definition.get('description', None)),
+        thing_type=_intern_or_none(thing_type),
         actions=actions,
         extras=ThingExtras(name),
     )
@@ -36,6 +36,8 @@ class ThingExtras:
         self._lock = threading.Lock()
         self._values = {}
         self._needs_broadcast = False
+        # Bumped whenever a value changes
+        self._version = 0
 
     def get_mqtt_topic(self):
         return f"{THING_EXTRAS_TOPIC}/{self._thing_name}"
@@ -45,6 +47,7 @@ class ThingExtras:
         with self._lock:
             self._values[metric] = value
             self._needs_broadcast = True
+            self._version += 1
 
     def get(self, metric):
         """Get a specific metric value. Unlike non-extra things, there is no schema for extra values, so
@@ -52,11 +55,21 @@ class ThingExtras:
         with self._lock:
             return self._values.get(metric)
 
+    def get_version(self):
+        """ Monotonically increasing version of these values """
+        with self._lock:
+            return self._version
+
     def get_all(self):
         """ Get all metric values. """
         with self._lock:
             return self._values.copy()
 
+    def has_pending_broadcast(self):
+        """ True if there are values set locally that haven't been broadcast yet """
+        with self._lock:
+            return self._needs_broadcast
+
     def make_mqtt_status_update(self):
         """ Get values to broadcast (if any) and clear the needs_broadcast flag. """
         with self._lock:
@@ -73,6 +86,7 @@ class ThingExtras:
 
         with self._lock:
             self._values.update(payload)
+            self._version += 1
         # log.debug("Updated extras for %s: %s", self._thing_name, payload)
 
     def __contains__(self, metric):
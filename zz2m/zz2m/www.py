@@ -1,13 +1,17 @@
 from flask import Flask
+from flask import Response
 from flask import redirect
 from flask import request as FlaskRequest
 from flask import send_from_directory
 from flask import url_for
 from flask import jsonify
+import threading
+import time
 import types
 import json
 
 from zzmw_lib.logs import build_logger
+from zzmw_lib.www_events import EventStream
 log = build_logger("Z2Mwww")
 
 def _make_serializable(obj):
@@ -46,7 +50,61 @@ def _set_props_of_thing(z2m, thing_name, data):
 
     z2m.broadcast_thing(thing_name)
 
-def _thing_put(z2m, thing_name):
+class _SetCoalescer:
+    """ Coalesces bursts of set requests for a thing (eg from a slider being dragged). The first set is applied and
+    broadcast right away. Sets received in the next window_secs are merged, with later values replacing earlier ones
+    for the same property, and only the latest state is broadcast when the window ends. """
+
+    def __init__(self, z2m, window_secs):
+        self._z2m = z2m
+        self._window_secs = window_secs
+        self._lock = threading.Lock()
+        # Thing name -> values received during its current window (None if there are none yet). Things without an
+        # open window aren't in this map
+        self._windows = {}
+
+    def set(self, thing_name, data):
+        with self._lock:
+            if thing_name in self._windows:
+                # Validate now (action and value), so the user gets an error, but apply when the window ends
+                thing = self._z2m.get_thing(thing_name)
+                for key, val in data.items():
+                    thing.validate(key, val)
+                pending = self._windows[thing_name] or {}
+                pending.update(data)
+                self._windows[thing_name] = pending
+                return
+            self._windows[thing_name] = None
+
+        try:
+            _set_props_of_thing(self._z2m, thing_name, data)
+        except Exception:
+            with self._lock:
+                self._windows.pop(thing_name, None)
+            raise
+        self._start_window(thing_name)
+
+    def _start_window(self, thing_name):
+        timer = threading.Timer(self._window_secs, self._on_window_end, args=(thing_name,))
+        timer.daemon = True
+        timer.start()
+
+    def _on_window_end(self, thing_name):
+        with self._lock:
+            pending = self._windows.get(thing_name)
+            if pending is None:
+                self._windows.pop(thing_name, None)
+                return
+            self._windows[thing_name] = None
+
+        try:
+            _set_props_of_thing(self._z2m, thing_name, pending)
+        except (KeyError, AttributeError, ValueError) as ex:
+            log.warning('Failed to apply coalesced set for %s: %s', thing_name, ex)
+        # Keep coalescing while sets keep arriving, so a long drag sends one update per window
+        self._start_window(thing_name)
+
+def _thing_put(z2m, thing_name, coalescer=None):
     data = _get_request_data()
     if data is None or len(data) == 0:
         raise RuntimeError('Set prop requires at least one PUT/POST value')
@@ -57,7 +115,10 @@ def _thing_put(z2m, thing_name):
             raise RuntimeError(f'Invalid set of PUT/POST values f{key}:f{val}')
 
     try:
-        res = _set_props_of_thing(z2m, thing_name, data)
+        if coalescer is not None:
+            res = coalescer.set(thing_name, data)
+        else:
+            res = _set_props_of_thing(z2m, thing_name, data)
         return json.dumps(res, default=_make_serializable)
     except KeyError as ex:
         log.warn('User requested non-existing thing. %s', ex, exc_info=True)
@@ -85,11 +146,54 @@ def _thing_get(z2m, thing_name):
         log.warn('User request error %s', ex, exc_info=True)
         return str(ex), 400
 
+def _world_get(z2m):
+    etag, body = z2m.get_world_state_json()
+    resp = Response(body, mimetype='application/json')
+    resp.set_etag(etag)
+    # Replies 304 if the client already has this version of the world
+    return resp.make_conditional(FlaskRequest)
+
+def _changes_get(z2m):
+    return z2m.get_changes(FlaskRequest.args.get('since'))
+
 class Z2Mwebservice:
-    def __init__(self, www, z2m):
+    """ Serves the z2m world over http. If the www server supports events, changes to things are also pushed as
+    'z2m_changes' events, with the same format as /z2m/changes.
+
+    If set_coalesce_window_secs is set, bursts of sets to the same thing are coalesced: the first one is sent right
+    away, and then at most one update (with the latest values) is sent per window. """
+
+    def __init__(self, www, z2m, push_period_secs=0.25, set_coalesce_window_secs=None):
+        coalescer = _SetCoalescer(z2m, set_coalesce_window_secs) if set_coalesce_window_secs else None
         www.serve_url('/z2m/get_known_things_hash', z2m.get_known_things_hash)
         www.serve_url('/z2m/ls', z2m.get_thing_names)
-        www.serve_url('/z2m/get_world', z2m.get_world_state)
+        www.serve_url('/z2m/get_world', lambda: _world_get(z2m))
+        www.serve_url('/z2m/changes', lambda: _changes_get(z2m))
+        www.serve_url('/z2m/routing_stats', z2m.get_routing_stats)
         www.serve_url('/z2m/meta/<thing_name>', _safe_jsonify(z2m.get_thing_meta))
-        www.serve_url('/z2m/set/<thing_name>', lambda thing_name: _thing_put(z2m, thing_name), ['PUT', 'POST'])
+        www.serve_url('/z2m/set/<thing_name>', lambda thing_name: _thing_put(z2m, thing_name, coalescer),
+                      ['PUT', 'POST'])
         www.serve_url('/z2m/get/<thing_name>', lambda thing_name: _thing_get(z2m, thing_name))
+
+        self._z2m = z2m
+        self._push_period_secs = push_period_secs
+        self._events = getattr(www, 'events', None)
+        if isinstance(self._events, EventStream):
+            threading.Thread(target=self._push_changes, name="Z2MwwwEvents", daemon=True).start()
+
+    def _push_changes(self):
+        cursor = None
+        while True:
+            time.sleep(self._push_period_secs)
+            # Only look for changes while someone is listening. Changes made while nobody listened are still
+            # reported on the next call (or a full snapshot, if the cursor expired)
+            if self._events.subscriber_count() == 0:
+                continue
+            try:
+                changes = self._z2m.get_changes(cursor)
+            except Exception:  # pylint: disable=broad-except
+                log.error('Failed to get z2m changes for event stream', exc_info=True)
+                continue
+            cursor = changes['cursor']
+            if changes['full'] or len(changes['changed']) != 0 or len(changes['removed']) != 0:
+                self._events.publish('z2m_changes', changes)
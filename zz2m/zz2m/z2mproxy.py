@@ -1,17 +1,68 @@
 from zzmw_lib.logs import build_logger
+from zzmw_lib.metrics import get_metrics_registry
+from zzmw_lib.mqtt_dispatcher import OVERLOAD_COALESCE
+from zzmw_lib.mqtt_trace import mark_trace
 log = build_logger("Z2M")
 
 from zz2m.light_helpers import monkeypatch_lights
 
-from ctypes import c_int32
 from datetime import datetime, timedelta
 
+import collections
+import contextlib
 import dataclasses
+import hashlib
+import json
 import os
 import signal
+import threading
+import time
 
 from .thing import parse_from_zigbee2mqtt
 
+# Fields of a bridge/devices entry that affect how a thing is parsed
+_DEVICE_DEFINITION_KEYS = ('friendly_name', 'definition', 'interview_completed', 'interviewing', 'manufacturer',
+                           'model_id')
+
+
+class BroadcastBatch:
+    """ Things touched within a Z2MProxy.batch() block. Once the block exits, msgs_sent holds the number of messages
+    actually published, and msgs_saved how many less than without batching. """
+
+    def __init__(self):
+        # id(thing) -> thing, in the order they were first broadcast
+        self.things = {}
+        # Messages that would have been sent without batching
+        self.msgs_requested = 0
+        self.msgs_sent = 0
+
+    def add(self, things):
+        for thing in things:
+            # Count what an immediate broadcast would have sent
+            if thing.has_pending_mqtt_update():
+                self.msgs_requested += 1
+            if thing.extras.has_pending_broadcast():
+                self.msgs_requested += 1
+            self.things.setdefault(id(thing), thing)
+
+    @property
+    def msgs_saved(self):
+        return max(0, self.msgs_requested - self.msgs_sent)
+
+
+def _thing_schema_fingerprint(thing):
+    """ Stable (across runs) 64 bit hash of the name and actions of a thing """
+    schema = [thing.name]
+    for name in sorted(thing.actions.keys()):
+        action = thing.actions[name]
+        schema.append(f'{name}:{action.value.meta["type"]}:{action.can_set}:{action.can_get}')
+    return int.from_bytes(hashlib.blake2b('\n'.join(schema).encode(), digest_size=8).digest(), 'big')
+
+
+def _device_definition_hash(jsonthing):
+    return hash(json.dumps({k: jsonthing.get(k) for k in _DEVICE_DEFINITION_KEYS}, sort_keys=True))
+
+
 class Z2MProxy:
     """
     Proxy for interacting with Zigbee2MQTT devices.
@@ -24,16 +75,55 @@ class Z2MProxy:
         cfg: Configuration dict
         mqtt: MqttProxy instance for MQTT communication
         topic: MQTT topic prefix for Zigbee2MQTT (default: 'zigbee2mqtt')
+        selective_subscriptions: If set, only subscribe to the bridge topics and to the topics of things that
+            passed cb_is_device_interesting, instead of to every message published by Zigbee2MQTT. If None,
+            read from cfg['z2m_selective_subscriptions'] (default off).
     """
     def __init__(self, cfg, mqtt, scheduler, topic='zigbee2mqtt',
-                 cb_on_z2m_network_discovery=None, cb_is_device_interesting=None):
+                 cb_on_z2m_network_discovery=None, cb_is_device_interesting=None, selective_subscriptions=None):
         self._z2m_topic = topic
         self._known_things = {}
-        self._z2m_subtopic_cbs = []
+        # Routing table for z2m messages: exact subtopic -> [callbacks]
+        self._z2m_subtopic_cbs = {}
+        self._z2m_subtopic_cbs_lock = threading.Lock()
+        self._z2m_subtopic_hits = {}
+        self._z2m_unhandled_msgs = 0
+        # Routes added on behalf of each thing (or group), so they can be removed
+        self._thing_routes = {}
+        self._group_routes = {}
+        # [(group name, ieee addresses of its members)], for groups with more than one member
+        self._groups = []
+        # Batch of deferred broadcasts of each thread, see batch()
+        self._batch_local = threading.local()
+        self._broadcast_stats = {'batches': 0, 'batch_msgs_saved': 0, 'group_msgs_saved': 0}
+        self._broadcast_stats_lock = threading.Lock()
         self._init_subtopics()
 
         self._aliases = {} # Can be used to set up aliases to things if needed
+        # Xor of the schema fingerprints of all known things (name -> fingerprint), kept up to date as things come
+        # and go or change their actions
+        self._thing_fingerprints = {}
+        self._network_hash = 0
+        self._network_hash_lock = threading.Lock()
+        # Thing name -> (thing, version, serialized state), used to build the world state
+        self._world_fragments = {}
+        self._world_generation = 0
+        self._world_lock = threading.Lock()
+        # Makes etags from different runs of the service different
+        self._world_etag_salt = f'{time.time_ns():x}'
+        # Log of (seq, thing name, changed fields or None if the thing left) used to serve deltas of the world. Its
+        # baseline is the state of each thing when changes were last captured: name -> (thing, version, state)
+        self._change_log = collections.deque(maxlen=cfg.get('z2m_change_log_size', 1000))
+        self._change_seq = 0
+        # Highest seq dropped from the log; cursors older than this have expired
+        self._change_log_trimmed_seq = 0
+        self._change_baseline = {}
+        self._change_lock = threading.Lock()
         self._last_device_id = 0
+        # ieee address -> thing id, so ids are stable across network publishes
+        self._device_ids = {}
+        # ieee address -> (hash of its definition, name it was registered with)
+        self._known_devices = {}
         self._z2m_devices_discovered = False
         self._cb_on_z2m_network_discovery = cb_on_z2m_network_discovery
         self._cb_is_device_interesting = cb_is_device_interesting or (lambda x: True)
@@ -47,37 +137,80 @@ class Z2MProxy:
         )
 
         self._mqtt = mqtt
-        self._mqtt.subscribe_with_cb(self._z2m_topic, self._on_z2m_json_msg)
+        if selective_subscriptions is None:
+            selective_subscriptions = cfg.get('z2m_selective_subscriptions', False)
+        self._selective_subscriptions = selective_subscriptions
+        # Exact MQTT topic -> callback, for each thing topic we're subscribed to in selective mode
+        self._thing_subscriptions = {}
+        if self._selective_subscriptions:
+            self._mqtt.subscribe_with_cb(f'{self._z2m_topic}/bridge',
+                                         lambda subtopic, payload: self._on_z2m_json_msg(f'bridge/{subtopic}', payload))
+        else:
+            self._mqtt.subscribe_with_cb(self._z2m_topic, self._on_z2m_json_msg)
 
-    def _init_subtopics(self):
-        """ Register a callback for an MQTT topic. Multiple callbacks can be active
-        for the same topic (eg one to update a thing, another to forward the
-        exact same message to a websocket).
-        Register default rules before starting mqtt loop, so that the first handled
-        message already has some rules """
-        def _ignore_msg(_topic, _payload):
-            self._z2m_last_msg_t = datetime.now()
-        def ignore_group_messages(_topic, payload):
-            for group in payload:
-                try:
-                    gid = group['id']
-                    self._z2m_subtopic_cbs.append((f'{gid}/', _ignore_msg))
-                    self._z2m_subtopic_cbs.append((f'{gid}/availability', _ignore_msg))
-                except:
-                    log.error("Malformed group message has no group id, payload '%s'", str(payload))
-        self._z2m_subtopic_cbs.append(('bridge/devices', self._on_msg_device_list_published))
-        self._z2m_subtopic_cbs.append(('bridge/groups', ignore_group_messages))
-        self._z2m_subtopic_cbs.append(('bridge/state', _ignore_msg))
-        self._z2m_subtopic_cbs.append(('bridge/extensions', _ignore_msg))
-        self._z2m_subtopic_cbs.append(('bridge/logging', _ignore_msg))
-        self._z2m_subtopic_cbs.append(('bridge/info', _ignore_msg))
-        self._z2m_subtopic_cbs.append(('bridge/config', _ignore_msg))
-        self._z2m_subtopic_cbs.append(('bridge/converters', _ignore_msg))
-        self._z2m_subtopic_cbs.append(('bridge/definitions', _ignore_msg))
-        self._z2m_subtopic_cbs.append(('bridge/event', _ignore_msg))
-        self._z2m_subtopic_cbs.append(('bridge/response/device/rename', _ignore_msg))
-        self._z2m_subtopic_cbs.append(('bridge/response/health_check', _ignore_msg))
+        get_metrics_registry().register_collector('z2m', self._get_metrics)
 
+    def _init_subtopics(self):
+        """ Register default rules before starting mqtt loop, so that the first handled message already has some
+        rules """
+        self._add_route('bridge/devices', self._on_msg_device_list_published)
+        self._add_route('bridge/groups', self._on_msg_group_list_published)
+        for subtopic in ['bridge/state', 'bridge/extensions', 'bridge/logging', 'bridge/info', 'bridge/config',
+                         'bridge/converters', 'bridge/definitions', 'bridge/event',
+                         'bridge/response/device/rename', 'bridge/response/health_check']:
+            self._add_route(subtopic, self._ignore_msg)
+
+    def _ignore_msg(self, _topic, _payload):
+        pass
+
+    def _add_route(self, subtopic, cb):
+        """ Register a callback for an MQTT subtopic. Multiple callbacks can be active for the same topic (eg one to
+        update a thing, another to forward the exact same message to a websocket). Adding the same callback twice
+        for the same subtopic is a no-op. """
+        with self._z2m_subtopic_cbs_lock:
+            cbs = self._z2m_subtopic_cbs.setdefault(subtopic, [])
+            if cb not in cbs:
+                cbs.append(cb)
+
+    def _remove_route(self, subtopic, cb):
+        with self._z2m_subtopic_cbs_lock:
+            cbs = self._z2m_subtopic_cbs.get(subtopic, [])
+            if cb in cbs:
+                cbs.remove(cb)
+            if len(cbs) == 0:
+                self._z2m_subtopic_cbs.pop(subtopic, None)
+                self._z2m_subtopic_hits.pop(subtopic, None)
+
+    def _set_routes_for(self, routes_owner, owner_id, routes):
+        """ Replace the routes registered for a thing or group with a new set of (subtopic, cb) """
+        for subtopic, cb in routes_owner.pop(owner_id, []):
+            self._remove_route(subtopic, cb)
+        if len(routes) == 0:
+            return
+        routes_owner[owner_id] = routes
+        for subtopic, cb in routes:
+            self._add_route(subtopic, cb)
+
+    def get_routing_stats(self):
+        """ Size of the routing table, and number of messages routed to each subtopic """
+        with self._z2m_subtopic_cbs_lock:
+            return {
+                "subtopics": len(self._z2m_subtopic_cbs),
+                "callbacks": sum(len(cbs) for cbs in self._z2m_subtopic_cbs.values()),
+                "unhandled_msgs": self._z2m_unhandled_msgs,
+                "hits": dict(self._z2m_subtopic_hits),
+            }
+
+    def _get_metrics(self):
+        """ Stats exposed in the service metrics. Per subtopic hits are left out, there is one per thing topic """
+        routing = self.get_routing_stats()
+        routing.pop('hits')
+        return {
+            "things": len(self._known_things),
+            "groups": len(self._groups),
+            "routing": routing,
+            "broadcast": self.get_broadcast_stats(),
+        }
 
     def _z2m_connect_check(self):
         if not self._z2m_devices_discovered:
@@ -103,13 +236,15 @@ class Z2MProxy:
 
     def _on_z2m_json_msg(self, topic, payload):
         self._z2m_last_msg_t = datetime.now()
-        # Filter CBs so we can apply them without worrying about a callback
+        # Copy CBs so we can apply them without worrying about a callback
         # changing the rules
-        matching_cbs = []
-        for rule, cb_for_topic in self._z2m_subtopic_cbs:
-            if topic == rule:
-                # log.debug('Applying rule %s for topic %s', rule, topic)
-                matching_cbs.append(cb_for_topic)
+        with self._z2m_subtopic_cbs_lock:
+            matching_cbs = list(self._z2m_subtopic_cbs.get(topic, []))
+            if len(matching_cbs) == 0:
+                self._z2m_unhandled_msgs += 1
+            else:
+                self._z2m_subtopic_hits[topic] = self._z2m_subtopic_hits.get(topic, 0) + 1
+        mark_trace('routing')
 
         for cb_for_topic in matching_cbs:
             cb_for_topic(topic, payload)
@@ -117,27 +252,87 @@ class Z2MProxy:
         if len(matching_cbs) == 0:
             log.warning('Unhandled MQTT message on topic %s', topic)
 
+    def _on_msg_group_list_published(self, _topic, payload):
+        """ Messages for groups are ignored, but groups are remembered so that bulk updates can use them """
+        known_groups = set()
+        groups = {}
+        for group in payload:
+            try:
+                gid = group['id']
+            except (KeyError, TypeError):
+                log.error("Malformed group message has no group id, payload '%s'", str(payload))
+                continue
+            known_groups.add(gid)
+            routes = [
+                (f'{gid}/', self._ignore_msg),
+                (f'{gid}/availability', self._ignore_msg),
+            ]
+            name = group.get('friendly_name')
+            members = frozenset(m.get('ieee_address') for m in group.get('members', []))
+            if name is not None:
+                routes.append((name, self._ignore_msg))
+                if len(members) > 1:
+                    groups[name] = members
+            self._set_routes_for(self._group_routes, gid, routes)
+        for gid in set(self._group_routes.keys()) - known_groups:
+            self._set_routes_for(self._group_routes, gid, [])
+        # Biggest groups first, so bulk updates use as few messages as possible
+        self._groups = sorted(groups.items(), key=lambda g: len(g[1]), reverse=True)
 
     def _on_msg_device_list_published(self, _topic, payload):
+        """ Z2M republishes the full list of devices on renames, interviews, restarts... Only parse devices that
+        are new or that changed since the last publish, and forget the devices that are gone. """
         log.info('Zigbee2Mqtt bridge published list of devices')
-        device_added = False
+        new_things = []
+        devices_in_network = set(jsonthing.get('ieee_address') for jsonthing in payload)
+        for addr in set(self._known_devices.keys()) - devices_in_network:
+            log.info('Thing %s is no longer part of the Zigbee2Mqtt network', self._known_devices[addr][1] or addr)
+            self._forget_device(addr)
+
+        updated_things = []
         for jsonthing in payload:
-            self._last_device_id += 1
-            thing = parse_from_zigbee2mqtt(self._last_device_id, jsonthing, known_aliases=self._aliases)
+            addr = jsonthing.get('ieee_address')
+            dev_hash = _device_definition_hash(jsonthing)
+            known_dev = self._known_devices.get(addr)
+            if known_dev is not None and known_dev[0] == dev_hash:
+                continue
+
+            if addr not in self._device_ids:
+                self._last_device_id += 1
+                self._device_ids[addr] = self._last_device_id
+            thing = parse_from_zigbee2mqtt(self._device_ids[addr], jsonthing, known_aliases=self._aliases)
+            if known_dev is not None:
+                known_thing = self._known_things.get(known_dev[1])
+                if known_thing is not None and known_thing.name == thing.name:
+                    # Users of the thing hold references to it (and its callbacks): update it instead of replacing it
+                    log.info('Zigbee2Mqtt device %s changed, will update its definition', thing.name)
+                    known_thing.update_definition(thing)
+                    self._set_routes_for(self._thing_routes, known_thing.name,
+                                         self._thing_subtopics(known_thing, known_thing.on_mqtt_update))
+                    self._known_devices[addr] = (dev_hash, known_dev[1])
+                    updated_things.append(known_thing)
+                    continue
+                log.info('Zigbee2Mqtt device %s changed, will replace it', addr)
+                self._forget_device(addr)
+
+            registered_name = None
             if self._is_thing_unknown(thing):
+                registered_name = thing.name
                 if self._cb_is_device_interesting(thing):
                     self._register(thing)
-                    device_added = True
+                    new_things.append(thing)
                 else:
                     self._reg_to_ignore(thing)
+            self._known_devices[addr] = (dev_hash, registered_name)
+        self._update_thing_subscriptions()
+
+        if len(new_things) == 0:
+            log.info('Bridge published network definition. No new devices were found.')
+        monkeypatch_lights(self, new_things + updated_things)
 
         is_first_discovery = not self._z2m_devices_discovered
         self._z2m_devices_discovered = True
 
-        if not device_added:
-            log.info('Bridge published network definition. No new devices were found.')
-
-        monkeypatch_lights(self)
         if not self._cb_on_z2m_network_discovery:
             log.info('Zigbee2Mqtt network,%s device definition published. Discovered %d things.',
                      " first" if is_first_discovery else "", len(self._known_things.keys()))
@@ -177,35 +372,77 @@ class Z2MProxy:
 
     def _register_or_replace(self, thing):
         """ Add or replace a thing to the MQTT registry """
+        old_thing = self._known_things.get(thing.name)
+        if old_thing is not None and old_thing is not thing:
+            old_thing.actions.on_schema_change = None
+            self._mqtt.unsubscribe_cb(old_thing.extras.get_mqtt_topic(), old_thing.extras.on_mqtt_update)
         self._known_things[thing.name] = thing
-        self._z2m_subtopic_cbs.append((thing.name, thing.on_mqtt_update))
-        if thing.real_name != thing.name:
-            # Add a second callback for aliases
-            self._z2m_subtopic_cbs.append((thing.real_name, thing.on_mqtt_update))
-        self._z2m_subtopic_cbs.append((thing.address, thing.on_mqtt_update))
-        self._z2m_subtopic_cbs.append((f'{thing.real_name}/set', thing.on_mqtt_update))
-        self._z2m_subtopic_cbs.append((f'{thing.name}/set', thing.on_mqtt_update))
-        self._z2m_subtopic_cbs.append((f'{thing.address}/set', thing.on_mqtt_update))
-
-        # We're never unsubscribing if the thing goes away, but the entire service will never forget unreg'ed things either
-        # so it's fine. It'd require a bit of refactoring to properly track registered objects, and since this should very
-        # rarely happen, we can ask the user to reboot the services when the network changes.
-        self._mqtt.subscribe_with_cb(thing.extras.get_mqtt_topic(), thing.extras.on_mqtt_update)
+        self._track_thing_schema(thing.name, thing)
+        self._set_routes_for(self._thing_routes, thing.name, self._thing_subtopics(thing, thing.on_mqtt_update))
+        self._mqtt.subscribe_with_cb(thing.extras.get_mqtt_topic(), thing.extras.on_mqtt_update,
+                                     overload_policy=OVERLOAD_COALESCE)
 
     def _reg_to_ignore(self, thing):
         """ Messages for this thing will be explicitlly ignored. This is needed because we register for the root mqtt
-        topic, so we get all of the messages that z2m sends, but we want to ignore some of them. Some day, we can
-        register only to interesting messages. """
-        def _ignore_msg(_topic, _payload):
-            pass
-        self._z2m_subtopic_cbs.append((thing.name, _ignore_msg))
-        if thing.real_name != thing.name:
-            # Add a second callback for aliases
-            self._z2m_subtopic_cbs.append((thing.real_name, _ignore_msg))
-        self._z2m_subtopic_cbs.append((thing.address, _ignore_msg))
-        self._z2m_subtopic_cbs.append((f'{thing.real_name}/set', _ignore_msg))
-        self._z2m_subtopic_cbs.append((f'{thing.name}/set', _ignore_msg))
-        self._z2m_subtopic_cbs.append((f'{thing.address}/set', _ignore_msg))
+        topic, so we get all of the messages that z2m sends, but we want to ignore some of them. In selective
+        subscriptions mode, we never subscribe to this thing's messages. """
+        self._set_routes_for(self._thing_routes, thing.name, self._thing_subtopics(thing, self._ignore_msg))
+
+    def _forget_device(self, addr):
+        _dev_hash, thing_name = self._known_devices.pop(addr)
+        if thing_name is not None:
+            self._unregister(thing_name)
+
+    def _unregister(self, thing_name):
+        """ Forget a thing (or an ignored thing) and remove all of its routes """
+        self._set_routes_for(self._thing_routes, thing_name, [])
+        thing = self._known_things.pop(thing_name, None)
+        if thing is not None:
+            thing.actions.on_schema_change = None
+            self._track_thing_schema(thing_name, None)
+            self._mqtt.unsubscribe_cb(thing.extras.get_mqtt_topic(), thing.extras.on_mqtt_update)
+
+    def _track_thing_schema(self, thing_name, thing):
+        """ Update the network hash for a thing that joined (or changed its actions) or, if thing is None, left """
+        if thing is not None:
+            thing.actions.on_schema_change = lambda: self._track_thing_schema(thing_name, thing)
+            fingerprint = _thing_schema_fingerprint(thing)
+        with self._network_hash_lock:
+            self._network_hash ^= self._thing_fingerprints.pop(thing_name, 0)
+            if thing is not None:
+                self._thing_fingerprints[thing_name] = fingerprint
+                self._network_hash ^= fingerprint
+
+    def _update_thing_subscriptions(self):
+        """ In selective mode, subscribe only to the topics of known things. Things we ignore, or that left the
+        network, are unsubscribed. """
+        if not self._selective_subscriptions:
+            return
+
+        wanted = set()
+        for thing in self._known_things.values():
+            if thing.is_zigbee_mqtt:
+                wanted.add(thing.real_name)
+                wanted.add(f'{thing.real_name}/set')
+
+        for subtopic in set(self._thing_subscriptions.keys()) - wanted:
+            cb = self._thing_subscriptions.pop(subtopic)
+            self._mqtt.unsubscribe_cb(f'{self._z2m_topic}/{subtopic}', cb, exact=True)
+
+        for subtopic in wanted - set(self._thing_subscriptions.keys()):
+            def _on_thing_msg(_subtopic, payload, subtopic=subtopic):
+                self._on_z2m_json_msg(subtopic, payload)
+            self._thing_subscriptions[subtopic] = _on_thing_msg
+            self._mqtt.subscribe_with_cb(f'{self._z2m_topic}/{subtopic}', _on_thing_msg, exact=True)
+
+    @staticmethod
+    def _thing_subtopics(thing, cb):
+        # A thing may be referred to by its name, its unaliased name or its address
+        subtopics = []
+        for thing_id in dict.fromkeys([thing.name, thing.real_name, thing.address]):
+            subtopics.append((thing_id, cb))
+            subtopics.append((f'{thing_id}/set', cb))
+        return subtopics
 
     def register_virtual_thing(self, thing):
         """Register a virtual (non-zigbee) thing.
@@ -221,21 +458,16 @@ class Z2MProxy:
             return
 
         self._known_things[thing.name] = thing
+        self._track_thing_schema(thing.name, thing)
         # Subscribe to extras topic so other services' broadcasts update our local state
-        self._mqtt.subscribe_with_cb(thing.extras.get_mqtt_topic(), thing.extras.on_mqtt_update)
+        self._mqtt.subscribe_with_cb(thing.extras.get_mqtt_topic(), thing.extras.on_mqtt_update,
+                                     overload_policy=OVERLOAD_COALESCE)
         log.info("Registered virtual thing: %s", thing.name)
 
     def get_known_things_hash(self):
-        """ Returns a 32 bit hash of the names of all known things, to let clients determine if the
-        network of known devices has changed. Note this doesn't update on actions change, and is not
-        guaranteed to be colision free. """
-        sorted_names = sorted(self.get_thing_names())
-        nethash = 0
-        for name in sorted_names:
-            chr_list = list(name)
-            for chr_as_int in list(map(ord, chr_list)):
-                nethash = c_int32((nethash << 2) - nethash + chr_as_int).value
-        return str(nethash)
+        """ Returns a hash of the names and action schemas of all known things, to let clients determine if the
+        network of known devices has changed. Not guaranteed to be colision free. """
+        return str(self._network_hash)
 
     def get_thing_names(self):
         """ Get names of all known things """
@@ -245,6 +477,105 @@ class Z2MProxy:
         """ Get the state of all the world """
         return [{name: thing.get_json_state()} for name,thing in self._known_things.items()]
 
+    def get_world_state_json(self):
+        """ Get the state of all the world, serialized as json, and an etag for it. The state of each thing is
+        only serialized again if the thing changed since the last call. """
+        with self._world_lock:
+            fragments = []
+            versions_sum = 0
+            new_cache = {}
+            for name, thing in list(self._known_things.items()):
+                version = thing.get_version()
+                versions_sum += version
+                cached = self._world_fragments.get(name)
+                if cached is None or cached[0] is not thing:
+                    # Versions are only comparable for the same thing: if things joined, left, or were replaced, the
+                    # world changed even if the sum of versions didn't
+                    self._world_generation += 1
+                    cached = None
+                if cached is None or cached[1] != version:
+                    cached = (thing, version, json.dumps({name: thing.get_json_state()}, default=str))
+                new_cache[name] = cached
+                fragments.append(cached[2])
+            if len(new_cache) != len(self._world_fragments):
+                self._world_generation += 1
+            self._world_fragments = new_cache
+            etag = f'{self._world_etag_salt}-{self._world_generation}-{versions_sum}'
+        return etag, '[' + ','.join(fragments) + ']'
+
+    def _log_change(self, thing_name, fields):
+        # Must hold self._change_lock
+        if len(self._change_log) == self._change_log.maxlen:
+            self._change_log_trimmed_seq = self._change_log[0][0]
+        self._change_seq += 1
+        self._change_log.append((self._change_seq, thing_name, fields))
+
+    def _capture_changes(self):
+        """ Diff things that changed since the last capture against the baseline, and log their changed fields """
+        # Must hold self._change_lock
+        new_baseline = {}
+        for name, thing in list(self._known_things.items()):
+            version = thing.get_version()
+            known = self._change_baseline.get(name)
+            if known is not None and known[0] is thing and known[1] == version:
+                new_baseline[name] = known
+                continue
+
+            state = thing.get_json_state()
+            new_baseline[name] = (thing, version, state)
+            if known is None or known[0] is not thing:
+                self._log_change(name, state)
+                continue
+            old_state = known[2]
+            fields = {k: v for k, v in state.items() if k not in old_state or old_state[k] != v}
+            fields.update({k: None for k in old_state if k not in state})
+            if len(fields) != 0:
+                self._log_change(name, fields)
+
+        for name in self._change_baseline:
+            if name not in new_baseline:
+                self._log_change(name, None)
+        self._change_baseline = new_baseline
+
+    def get_changes(self, since=None):
+        """ Get the things (and only the fields) that changed since a cursor. Returns a new cursor, a map of thing
+        name to changed fields, and a list of things that left the network. If the cursor is missing or expired,
+        the full state of every thing is returned instead (with 'full' set). """
+        with self._change_lock:
+            self._capture_changes()
+            cursor = f'{self._world_etag_salt}-{self._change_seq}'
+
+            since_seq = None
+            if since is not None:
+                salt, _, seq = since.rpartition('-')
+                if salt == self._world_etag_salt and seq.isdigit() and int(seq) <= self._change_seq:
+                    since_seq = int(seq)
+            if since_seq is None or since_seq < self._change_log_trimmed_seq:
+                return {
+                    'cursor': cursor,
+                    'full': True,
+                    'changed': {name: known[2] for name, known in self._change_baseline.items()},
+                    'removed': [],
+                }
+
+            changed = {}
+            removed = set()
+            for seq, name, fields in self._change_log:
+                if seq <= since_seq:
+                    continue
+                if fields is None:
+                    changed.pop(name, None)
+                    removed.add(name)
+                else:
+                    removed.discard(name)
+                    changed.setdefault(name, {}).update(fields)
+            return {
+                'cursor': cursor,
+                'full': False,
+                'changed': changed,
+                'removed': sorted(removed),
+            }
+
     def get_thing(self, thing_name):
         return self._known_things[thing_name]
 
@@ -268,9 +599,88 @@ class Z2MProxy:
             # copying
             return dataclasses.asdict(thing)
 
+    @contextlib.contextmanager
+    def batch(self):
+        """ Within this context, broadcasts from this thread are deferred until the context exits. All updates to the
+        same thing are then merged into a single message. Yields a BroadcastBatch, which reports how many messages
+        were saved once the context exits. Nested batches are merged into the outermost one. """
+        outer = getattr(self._batch_local, 'batch', None)
+        if outer is not None:
+            yield outer
+            return
+
+        batch = BroadcastBatch()
+        self._batch_local.batch = batch
+        try:
+            yield batch
+        finally:
+            self._batch_local.batch = None
+            batch.msgs_sent, saved_by_groups = self._broadcast_now(batch.things.values())
+            with self._broadcast_stats_lock:
+                self._broadcast_stats['batches'] += 1
+                self._broadcast_stats['batch_msgs_saved'] += max(0, batch.msgs_saved - saved_by_groups)
+            log.debug('Broadcast batch for %d things sent %d messages, saved %d',
+                      len(batch.things), batch.msgs_sent, batch.msgs_saved)
+
+    def get_broadcast_stats(self):
+        """ Number of batches sent, and messages saved by merging updates in batches and by group commands """
+        with self._broadcast_stats_lock:
+            return dict(self._broadcast_stats)
+
     def broadcast_things(self, things_or_names):
-        for t in things_or_names:
-            self.broadcast_thing(t)
+        """ Broadcast the pending updates of a set of things. If some things have the same update, and all the members
+        of a Zigbee2MQTT group are among them, a single group command is sent for these things, instead of a message
+        per thing. """
+        things = [self.get_thing(t) if isinstance(t, str) else t for t in things_or_names]
+        batch = getattr(self._batch_local, 'batch', None)
+        if batch is not None:
+            batch.add(things)
+        else:
+            self._broadcast_now(things)
+
+    def _broadcast_now(self, things):
+        """ Sends the pending updates of things. Returns the number of messages sent, and how many messages group
+        commands saved """
+        msgs_sent = 0
+        saved_by_groups = 0
+        # Things with the same update: json of the update -> (update, [things])
+        same_updates = {}
+        for thing in things:
+            status = thing.make_mqtt_status_update()
+            if len(status.keys()) != 0:
+                key = json.dumps(status, sort_keys=True, default=str)
+                same_updates.setdefault(key, (status, []))[1].append(thing)
+            if self._broadcast_extras(thing):
+                msgs_sent += 1
+
+        for status, same_update_things in same_updates.values():
+            remaining, group_msgs = self._broadcast_to_groups(same_update_things, status)
+            msgs_sent += group_msgs
+            saved_by_groups += len(same_update_things) - len(remaining) - group_msgs
+            for thing in remaining:
+                self._broadcast_status(thing, status)
+                msgs_sent += 1
+
+        if saved_by_groups != 0:
+            with self._broadcast_stats_lock:
+                self._broadcast_stats['group_msgs_saved'] += saved_by_groups
+        return msgs_sent, saved_by_groups
+
+    def _broadcast_to_groups(self, things, status):
+        """ Sends status to each group whose members are all in things. Returns the things not covered by a group,
+        and the number of group messages sent. """
+        if len(things) < 2:
+            return things, 0
+        addrs = {thing.address for thing in things}
+        covered = set()
+        group_msgs = 0
+        for group_name, members in self._groups:
+            if members <= addrs and covered.isdisjoint(members):
+                self._mqtt.broadcast(f'{self._z2m_topic}/{group_name}/set', status)
+                log.debug('Group %s is bcasting update for %d things:"%s"', group_name, len(members), status)
+                covered |= members
+                group_msgs += 1
+        return [thing for thing in things if thing.address not in covered], group_msgs
 
     def broadcast_thing(self, thing_or_name):
         """
@@ -284,21 +694,33 @@ class Z2MProxy:
         else:
             thing = thing_or_name
 
-        # Broadcast regular zigbee2mqtt values
-        topic = f'{self._z2m_topic}/{thing.real_name}/set'
+        batch = getattr(self._batch_local, 'batch', None)
+        if batch is not None:
+            batch.add([thing])
+            return
+
         status = thing.make_mqtt_status_update()
         if len(status.keys()) != 0:
-            self._mqtt.broadcast(topic, status)
-            log.debug(
-                'Thing %s%s is bcasting update topic[%s]:"%s"',
-                thing.name,
-                f'(an alias for {thing.real_name})' if thing.real_name != thing.name else '',
-                topic,
-                status)
+            self._broadcast_status(thing, status)
+        self._broadcast_extras(thing)
 
-        # Broadcast extras (virtual metrics)
+    def _broadcast_status(self, thing, status):
+        """ Broadcast regular zigbee2mqtt values """
+        topic = f'{self._z2m_topic}/{thing.real_name}/set'
+        self._mqtt.broadcast(topic, status)
+        log.debug(
+            'Thing %s%s is bcasting update topic[%s]:"%s"',
+            thing.name,
+            f'(an alias for {thing.real_name})' if thing.real_name != thing.name else '',
+            topic,
+            status)
+
+    def _broadcast_extras(self, thing):
+        """ Broadcast extras (virtual metrics). Returns True if there was anything to broadcast. """
         extras_status = thing.extras.make_mqtt_status_update()
-        if len(extras_status.keys()) != 0:
-            self._mqtt.broadcast(thing.extras.get_mqtt_topic(), extras_status)
-            # Some sensors can be quite spammy, so this will be a very spammy log too
-            # log.debug('Thing bcasting extras: %s %s', thing.extras.get_mqtt_topic(), extras_status)
+        if len(extras_status.keys()) == 0:
+            return False
+        self._mqtt.broadcast(thing.extras.get_mqtt_topic(), extras_status)
+        # Some sensors can be quite spammy, so this will be a very spammy log too
+        # log.debug('Thing bcasting extras: %s %s', thing.extras.get_mqtt_topic(), extras_status)
+        return True
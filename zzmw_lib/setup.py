@@ -11,6 +11,10 @@ setup(
         "paho-mqtt",
         "systemd-python",
     ],
+    extras_require={
+        # Faster decoding of incoming mqtt messages
+        "fast_json": ["orjson"],
+    },
 )
 
 
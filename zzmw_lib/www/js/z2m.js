@@ -100,6 +100,44 @@ function mJsonPut(url, val, success_cb, error_cb) {
   });
 }
 
+// Subscribe to events pushed by a service (its /svc_events endpoint). handlers maps event name to a callback,
+// which receives the parsed event data. The browser reconnects automatically if the connection drops; a
+// 'resync' event means some events were missed, and the app should reload its state. Returns a function
+// to unsubscribe.
+function mSubscribe(handlers, apiBasePath='') {
+  const source = new EventSource(`${apiBasePath}/svc_events`);
+  for (const [event, cb] of Object.entries(handlers)) {
+    source.addEventListener(event, (msg) => cb(JSON.parse(msg.data)));
+  }
+  return () => source.close();
+}
+
+// Keep a local copy of the state of all z2m things, updated as changes are pushed by the service. cb is
+// called with a map of thing name to state every time any thing changes. Returns a function to unsubscribe.
+function z2mSubscribeThings(cb, apiBasePath='') {
+  let things = {};
+  const applyChanges = (changes) => {
+    if (changes.full) {
+      things = {};
+    }
+    for (const [name, fields] of Object.entries(changes.changed)) {
+      things[name] = { ...(things[name] || {}), ...fields };
+    }
+    for (const name of changes.removed) {
+      delete things[name];
+    }
+    cb({ ...things });
+  };
+  const reload = () => mJsonGet(`${apiBasePath}/z2m/changes`, applyChanges);
+
+  const unsubscribe = mSubscribe({
+    z2m_changes: applyChanges,
+    resync: reload,
+  }, apiBasePath);
+  reload();
+  return unsubscribe;
+}
+
 function z2mStartReactApp(appRootSelector, appClass, apiBasePath='') {
   const appRef = React.createRef();
   ReactDOM.createRoot(document.querySelector(appRootSelector)).render(
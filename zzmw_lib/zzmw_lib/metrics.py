@@ -0,0 +1,273 @@
+""" Process wide metrics registry, exposed by service_runner as /svc_metrics (Prometheus text format, or JSON) """
+
+import bisect
+import math
+import re
+import threading
+
+# Default histogram buckets, in milliseconds
+DEFAULT_LATENCY_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_METRIC_NAME_PATTERN = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
+_INVALID_NAME_CHARS = re.compile(r'[^a-zA-Z0-9_]')
+
+
+def _validate_name(name, what):
+    if not _METRIC_NAME_PATTERN.match(name):
+        raise ValueError(f"Invalid {what} '{name}': must contain only alphanumeric characters and underscores")
+    return name
+
+
+def _escape_label_value(val):
+    return str(val).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _fmt_labels(label_names, label_vals, extra=None):
+    pairs = [f'{k}="{_escape_label_value(v)}"' for k, v in zip(label_names, label_vals)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _fmt_value(val):
+    if val is None or (isinstance(val, float) and math.isnan(val)):
+        return 'NaN'
+    if val == math.inf:
+        return '+Inf'
+    if isinstance(val, bool):
+        return str(int(val))
+    return repr(val) if isinstance(val, float) else str(val)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_txt, labels):
+        self.name = _validate_name(name, "metric name")
+        self.help = help_txt
+        self.label_names = tuple(_validate_name(l, "label name") for l in labels)
+        self._lock = threading.Lock()
+        # Tuple of label values -> value. Protected by self._lock
+        self._values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.label_names):
+            raise ValueError(f"Metric {self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        try:
+            return tuple(str(labels[l]) for l in self.label_names)
+        except KeyError as ex:
+            raise ValueError(f"Metric {self.name} expects labels {self.label_names}, got {tuple(labels)}") from ex
+
+    def _samples(self):
+        """ [(suffix, label values, extra label or None, value)] """
+        with self._lock:
+            return [('', k, None, v) for k, v in self._values.items()]
+
+    def render_prometheus(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for suffix, label_vals, extra, val in self._samples():
+            lines.append(f'{self.name}{suffix}{_fmt_labels(self.label_names, label_vals, extra)} {_fmt_value(val)}')
+        return lines
+
+    def as_json(self):
+        with self._lock:
+            return {
+                'type': self.kind,
+                'help': self.help,
+                'values': [{'labels': dict(zip(self.label_names, k)), 'value': v} for k, v in self._values.items()],
+            }
+
+
+class Counter(_Metric):
+    """ Monotonically increasing value, eg number of messages received """
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """ A value that can go up and down. If value_fn is set, it's called to read the (unlabeled) value when the
+    metrics are collected, instead of storing a value. """
+    kind = 'gauge'
+
+    def __init__(self, name, help_txt, labels, value_fn=None):
+        super().__init__(name, help_txt, labels)
+        if value_fn is not None and len(self.label_names) != 0:
+            raise ValueError(f"Gauge {name} with a value callback can't have labels")
+        self._value_fn = value_fn
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _read_fn(self):
+        if self._value_fn is not None:
+            try:
+                val = self._value_fn()
+            except Exception:  # pylint: disable=broad-except
+                val = None
+            with self._lock:
+                self._values[()] = val
+
+    def _samples(self):
+        self._read_fn()
+        return super()._samples()
+
+    def as_json(self):
+        self._read_fn()
+        return super().as_json()
+
+
+class Histogram(_Metric):
+    """ Distribution of values (eg latencies) over a fixed set of buckets """
+    kind = 'histogram'
+
+    def __init__(self, name, help_txt, labels, buckets=DEFAULT_LATENCY_BUCKETS_MS):
+        super().__init__(name, help_txt, labels)
+        if 'le' in self.label_names:
+            raise ValueError(f"Histogram {name} can't use 'le' as a label")
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            # [per-bucket count, including +Inf, sum, max]
+            hist = self._values.get(key)
+            if hist is None:
+                hist = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, value]
+            hist[0][idx] += 1
+            hist[1] += value
+            hist[2] = max(hist[2], value)
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, _) in self._values.items():
+                cumulative = 0
+                for bound, cnt in zip(self.buckets + (math.inf,), counts):
+                    cumulative += cnt
+                    samples.append(('_bucket', key, ('le', _fmt_value(float(bound))), cumulative))
+                samples.append(('_sum', key, None, total))
+                samples.append(('_count', key, None, cumulative))
+        return samples
+
+    def as_json(self):
+        with self._lock:
+            values = []
+            for key, (counts, total, max_val) in self._values.items():
+                n = sum(counts)
+                values.append({
+                    'labels': dict(zip(self.label_names, key)),
+                    'count': n,
+                    'sum': total,
+                    'avg': total / n,
+                    'max': max_val,
+                    'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], counts)),
+                })
+            return {'type': self.kind, 'help': self.help, 'values': values}
+
+
+def _flatten_stats(prefix, stats, out):
+    """ Flattens a nested stats dict to [(metric name, numeric value)], skipping anything that isn't a number """
+    if isinstance(stats, bool):
+        out.append((prefix, int(stats)))
+    elif isinstance(stats, (int, float)):
+        out.append((prefix, stats))
+    elif isinstance(stats, dict):
+        for key, val in stats.items():
+            _flatten_stats(f'{prefix}_{_INVALID_NAME_CHARS.sub("_", str(key))}', val, out)
+    elif isinstance(stats, (list, tuple)):
+        for i, val in enumerate(stats):
+            _flatten_stats(f'{prefix}_{i}', val, out)
+    return out
+
+
+class MetricsRegistry:
+    """
+    Holds all the metrics of a service. Metrics are created on first use, and asking for an existing metric returns
+    the same object, so that library code can declare its metrics wherever it needs them.
+
+    Existing stats getters (functions returning a dict) can be registered as collectors: they are called when metrics
+    are read, and their numeric values are exposed as gauges.
+    """
+
+    def __init__(self, prefix='zmw_'):
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = {}
+
+    def _get_or_create(self, cls, name, help_txt, labels, **kwargs):
+        name = self._prefix + name
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_txt, labels, **kwargs)
+            elif not isinstance(metric, cls) or metric.label_names != tuple(labels):
+                raise ValueError(f"Metric {name} already registered as a {metric.kind} "
+                                 f"with labels {metric.label_names}")
+            return metric
+
+    def counter(self, name, help_txt, labels=()):
+        return self._get_or_create(Counter, name, help_txt, labels)
+
+    def gauge(self, name, help_txt, labels=(), value_fn=None):
+        return self._get_or_create(Gauge, name, help_txt, labels, value_fn=value_fn)
+
+    def histogram(self, name, help_txt, labels=(), buckets=DEFAULT_LATENCY_BUCKETS_MS):
+        return self._get_or_create(Histogram, name, help_txt, labels, buckets=buckets)
+
+    def register_collector(self, name, stats_fn):
+        """ Expose the dict returned by stats_fn. Registering a collector with an existing name replaces it. """
+        _validate_name(name, "collector name")
+        with self._lock:
+            self._collectors[name] = stats_fn
+
+    def unregister_collector(self, name):
+        with self._lock:
+            self._collectors.pop(name, None)
+
+    def _collect(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors.items())
+        stats = {}
+        for name, stats_fn in collectors:
+            try:
+                stats[name] = stats_fn()
+            except Exception as ex:  # pylint: disable=broad-except
+                stats[name] = {'error': str(ex)}
+        return metrics, stats
+
+    def render_prometheus(self):
+        """ All metrics in the Prometheus text exposition format """
+        metrics, stats = self._collect()
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render_prometheus())
+        for name, vals in stats.items():
+            for stat_name, val in _flatten_stats(self._prefix + name, vals, []):
+                lines.append(f'# TYPE {stat_name} gauge')
+                lines.append(f'{stat_name} {_fmt_value(val)}')
+        return '\n'.join(lines) + '\n'
+
+    def as_json(self):
+        """ All metrics as a json-serializable dict """
+        metrics, stats = self._collect()
+        return {
+            'metrics': {metric.name: metric.as_json() for metric in metrics},
+            'stats': stats,
+        }
+
+
+_registry = MetricsRegistry()
+
+
+def get_metrics_registry():
+    """ The metrics registry for this process """
+    return _registry
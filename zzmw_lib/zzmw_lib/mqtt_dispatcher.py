@@ -0,0 +1,160 @@
+""" Worker pool to run MQTT callbacks outside of the mqtt network thread """
+
+import logging
+import queue
+import threading
+import time
+
+from .logs import build_logger
+from .metrics import get_metrics_registry
+from .mqtt_trace import activate_trace
+
+log = build_logger("MqttDispatcher", logging.INFO)
+
+_cb_run_ms = get_metrics_registry().histogram('mqtt_callback_ms', 'Time spent running MQTT callbacks', ('callback',))
+
+# What to do with a message when the worker queue is full
+OVERLOAD_BLOCK = 'block'
+# Drop the message
+OVERLOAD_DROP = 'drop'
+# Once the worker queue is above its high-water mark, keep only the most recent pending message for the same topic
+# and callback. Use for state topics, where only the latest value matters
+OVERLOAD_COALESCE = 'coalesce'
+_OVERLOAD_POLICIES = (OVERLOAD_BLOCK, OVERLOAD_DROP, OVERLOAD_COALESCE)
+
+
+def validate_overload_policy(policy):
+    if policy not in _OVERLOAD_POLICIES:
+        raise ValueError(f"Unknown overload policy '{policy}', expected one of {_OVERLOAD_POLICIES}")
+    return policy
+
+
+def _cb_name(cb):
+    return getattr(cb, '__qualname__', None) or repr(cb)
+
+
+def record_callback_run(cb, run_ms):
+    """ Add a run of an MQTT callback to the service metrics """
+    _cb_run_ms.observe(run_ms, callback=_cb_name(cb))
+
+
+class MqttCallbackDispatcher:
+    """
+    Runs callbacks in a bounded pool of worker threads, so that a slow callback doesn't stall the mqtt network loop
+    (and its keepalives).
+
+    Each ordering key (eg a topic) is always handled by the same worker, so callbacks for the same key run in the
+    order their messages arrived. Callbacks for different keys may run concurrently.
+
+    Messages with the coalesce policy are queued like any other until the worker queue holds coalesce_above
+    messages (by default, half of max_queued). Above that, a message replaces the pending one for the same ordering
+    key and callback, if there is one, and runs in its place. A coalesced message may then run before messages for
+    the same key (but another callback) that arrived before it.
+    """
+
+    def __init__(self, n_workers=4, max_queued=1000, coalesce_above=None):
+        self._lock = threading.Lock()
+        self._queues = [queue.Queue(maxsize=max_queued) for _ in range(n_workers)]
+        self._coalesce_above = coalesce_above if coalesce_above is not None else max_queued // 2
+        # (ordering key, cb) -> [args, t_queued, trace] of the latest message, for queued messages that newer ones
+        # may still replace. Protected by self._lock
+        self._coalesced_pending = {}
+        self._dropped = 0
+        self._coalesced = 0
+        # Callback name -> [calls, total ms, max ms, total ms waiting in queue]. Protected by self._lock
+        self._cb_stats = {}
+
+        for i, cb_queue in enumerate(self._queues):
+            threading.Thread(target=self._run, args=(cb_queue,), name=f"MqttCbWorker{i}", daemon=True).start()
+
+    def submit(self, ordering_key, cb, args, overload_policy=OVERLOAD_BLOCK, trace=None):
+        """ Schedule cb(*args) to run in a worker. Returns False if the message was dropped. If a trace is given, it
+        will be the current trace while cb runs. """
+        cb_queue = self._queues[hash(ordering_key) % len(self._queues)]
+        t_queued = time.monotonic()
+
+        if overload_policy == OVERLOAD_COALESCE:
+            coalesce_key = (ordering_key, cb)
+            with self._lock:
+                if cb_queue.qsize() < self._coalesce_above:
+                    # Not overloaded: queue it as any other message. A message queued earlier can't be replaced
+                    # anymore, or it would run after this one.
+                    self._coalesced_pending.pop(coalesce_key, None)
+                    pending = None
+                else:
+                    pending = self._coalesced_pending.get(coalesce_key)
+                    if pending is not None:
+                        # The worker will pick the latest args when it runs this callback
+                        pending[:] = [args, t_queued, trace]
+                        self._coalesced += 1
+                        return True
+                    pending = [args, t_queued, trace]
+                    self._coalesced_pending[coalesce_key] = pending
+            if pending is None:
+                cb_queue.put((cb, args, None, t_queued, trace))
+            else:
+                # There is at most one replaceable item per coalesce key, so blocking here is bounded
+                cb_queue.put((cb, None, (coalesce_key, pending), t_queued, None))
+            return True
+
+        if overload_policy == OVERLOAD_DROP:
+            try:
+                cb_queue.put_nowait((cb, args, None, t_queued, trace))
+            except queue.Full:
+                with self._lock:
+                    self._dropped += 1
+                log.warning("MQTT callback queue full, dropping message for %s", _cb_name(cb))
+                return False
+            return True
+
+        cb_queue.put((cb, args, None, t_queued, trace))
+        return True
+
+    def _run(self, cb_queue):
+        while True:
+            cb, args, coalesced, t_queued, trace = cb_queue.get()
+            if coalesced is not None:
+                coalesce_key, pending = coalesced
+                with self._lock:
+                    if self._coalesced_pending.get(coalesce_key) is pending:
+                        del self._coalesced_pending[coalesce_key]
+                    args, t_queued, trace = pending
+
+            t_start = time.monotonic()
+            if trace is not None:
+                trace.mark('queued')
+            activate_trace(trace)
+            try:
+                cb(*args)
+            except Exception as ex:  # pylint: disable=broad-except
+                log.critical('Error on MQTT message handling by %s, args %s. Ex: {%s}',
+                             _cb_name(cb), args, ex, exc_info=True)
+            finally:
+                activate_trace(None)
+            t_end = time.monotonic()
+            run_ms = 1000 * (t_end - t_start)
+            record_callback_run(cb, run_ms)
+
+            with self._lock:
+                stats = self._cb_stats.setdefault(_cb_name(cb), [0, 0.0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += run_ms
+                stats[2] = max(stats[2], run_ms)
+                stats[3] += 1000 * (t_start - t_queued)
+
+    def get_stats(self):
+        """ Queue depth of each worker, number of dropped/coalesced messages and per-callback latency """
+        with self._lock:
+            return {
+                "queue_depth": [q.qsize() for q in self._queues],
+                "dropped": self._dropped,
+                "coalesced": self._coalesced,
+                "callbacks": {
+                    name: {
+                        "calls": calls,
+                        "run_ms_avg": total_ms / calls,
+                        "run_ms_max": max_ms,
+                        "queued_ms_avg": queued_ms / calls,
+                    } for name, (calls, total_ms, max_ms, queued_ms) in self._cb_stats.items()
+                },
+            }
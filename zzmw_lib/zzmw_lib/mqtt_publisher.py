@@ -0,0 +1,143 @@
+""" Send queue for outgoing MQTT messages, published over a long lived mqtt client connection """
+
+from collections import deque
+import logging
+import queue
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from .logs import build_logger
+from .metrics import get_metrics_registry
+
+log = build_logger("MqttPublisher", logging.INFO)
+
+_publish_ms = get_metrics_registry().histogram('mqtt_publish_ms',
+                                               'Time from enqueueing an MQTT message to its broker ack')
+
+
+class MqttPublisher:
+    """
+    Publishes messages through an already-connected paho client, instead of opening a new connection per message.
+
+    Messages are pushed to a bounded queue and a worker thread hands them over to paho. The number of messages
+    waiting for a broker ack is capped, so if the broker stops acking (eg we're disconnected) the queue will fill up
+    and callers of publish() will block for a while (backpressure) before the message is dropped.
+
+    The owner of the mqtt client must forward the client's on_publish callback to this object.
+    """
+
+    def __init__(self, client, max_queued=1000, max_inflight=50, enqueue_timeout_secs=5, qos=1):
+        self._client = client
+        self._qos = qos
+        self._enqueue_timeout_secs = enqueue_timeout_secs
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._inflight_slots = threading.BoundedSemaphore(max_inflight)
+
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        # mid -> time the message was enqueued. Protected by self._lock
+        self._pending_acks = {}
+        # paho may ack a message before publish() returns its mid
+        self._early_acks = set()
+        # Messages queued or being handed to paho. Protected by self._lock
+        self._unsent = 0
+        self._published = 0
+        self._dropped = 0
+        self._latencies_ms = deque(maxlen=200)
+
+        self._worker = threading.Thread(target=self._run, name="MqttPublisher", daemon=True)
+        self._worker.start()
+
+    def publish(self, topic, payload):
+        """ Queue a message to be published. Blocks if the queue is full, drops the message (and logs an error)
+        if the queue is still full after the enqueue timeout. Returns True if the message was queued. """
+        with self._lock:
+            self._unsent += 1
+        try:
+            self._queue.put((topic, payload, time.monotonic()), timeout=self._enqueue_timeout_secs)
+            return True
+        except queue.Full:
+            with self._lock:
+                self._unsent -= 1
+                self._dropped += 1
+                self._idle.notify_all()
+            log.error("MQTT send queue is full (%d messages), dropping message for topic '%s'",
+                      self._queue.qsize(), topic)
+            return False
+
+    def on_publish(self, _client, _userdata, mid, _reason_code=None, _props=None):
+        """ Must be called by the mqtt client's on_publish callback """
+        with self._lock:
+            t_enqueued = self._pending_acks.pop(mid, None)
+            if t_enqueued is None:
+                self._early_acks.add(mid)
+                return
+            self._on_acked(t_enqueued)
+
+    def _on_acked(self, t_enqueued):
+        # Must hold self._lock
+        latency_ms = 1000 * (time.monotonic() - t_enqueued)
+        self._latencies_ms.append(latency_ms)
+        _publish_ms.observe(latency_ms)
+        self._published += 1
+        self._inflight_slots.release()
+        self._idle.notify_all()
+
+    def _run(self):
+        while True:
+            topic, payload, t_enqueued = self._queue.get()
+            self._inflight_slots.acquire()
+            try:
+                info = self._client.publish(topic, payload, qos=self._qos)
+            except Exception:  # pylint: disable=broad-except
+                log.error("Failed to publish MQTT message to '%s'", topic, exc_info=True)
+                info = None
+
+            with self._lock:
+                self._unsent -= 1
+                # NO_CONN means paho will hold the message and send it when reconnecting
+                if info is None or info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+                    if info is not None:
+                        log.error("Failed to publish MQTT message to '%s': %s", topic, mqtt.error_string(info.rc))
+                    self._dropped += 1
+                    self._inflight_slots.release()
+                elif info.mid in self._early_acks:
+                    self._early_acks.discard(info.mid)
+                    self._on_acked(t_enqueued)
+                else:
+                    self._pending_acks[info.mid] = t_enqueued
+                self._idle.notify_all()
+
+    def _is_idle(self, wait_for_acks):
+        # Must hold self._lock
+        if self._unsent > 0:
+            return False
+        return not (wait_for_acks and len(self._pending_acks) > 0)
+
+    def flush(self, timeout=5, wait_for_acks=True):
+        """ Wait until all queued messages have been handed to the mqtt client and, if wait_for_acks, until the
+        broker acked them. Acks are only received while the mqtt network loop is running, so don't wait for them
+        from the network thread. Returns True if everything was flushed before the timeout. """
+        with self._lock:
+            flushed = self._idle.wait_for(lambda: self._is_idle(wait_for_acks), timeout=timeout)
+        if not flushed:
+            log.warning("MQTT send queue not flushed after %s seconds, %d messages queued and %d waiting for ack",
+                        timeout, self._queue.qsize(), len(self._pending_acks))
+        return flushed
+
+    def get_stats(self):
+        """ Queue depth and publish latency (time from enqueue to broker ack) """
+        with self._lock:
+            lats = sorted(self._latencies_ms)
+            return {
+                "queue_depth": self._queue.qsize(),
+                "queue_max": self._queue.maxsize,
+                "waiting_ack": len(self._pending_acks),
+                "published": self._published,
+                "dropped": self._dropped,
+                "latency_ms_avg": (sum(lats) / len(lats)) if lats else None,
+                "latency_ms_p50": lats[len(lats) // 2] if lats else None,
+                "latency_ms_max": lats[-1] if lats else None,
+            }
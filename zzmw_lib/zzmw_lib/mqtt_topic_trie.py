@@ -0,0 +1,171 @@
+""" Subscription trie to route MQTT messages to callbacks, following MQTT topic filter semantics """
+
+
+def mqtt_topic_to_filter(topic):
+    """ Services subscribe to a topic prefix (eg 'zigbee2mqtt') meaning 'this topic and anything under it'. Topics
+    which already have a wildcard are kept as they are. """
+    levels = topic.split('/')
+    if '#' in levels or '+' in levels:
+        return topic
+    return f'{topic}/#'
+
+
+def _validate_filter(topic_filter):
+    levels = topic_filter.split('/')
+    for i, level in enumerate(levels):
+        if '#' in level and (level != '#' or i != len(levels) - 1):
+            raise ValueError(f"Invalid MQTT topic filter '{topic_filter}': '#' must be the last level")
+        if '+' in level and level != '+':
+            raise ValueError(f"Invalid MQTT topic filter '{topic_filter}': '+' must be a full level")
+    return levels
+
+
+class _TrieNode:
+    __slots__ = ('children', 'cbs', 'topic_filter', 'prefix')
+
+    def __init__(self):
+        self.children = {}
+        # Callbacks for the filter ending in this node
+        self.cbs = []
+        self.topic_filter = None
+        # Literal levels of topic_filter, before its first wildcard
+        self.prefix = None
+
+
+class MqttTopicTrie:
+    """
+    Maps MQTT topic filters (supporting '+' and '#') to a list of callbacks. Looking up the callbacks for a topic
+    costs O(topic depth) for typical filters, instead of O(number of subscriptions).
+
+    If more than one filter matches a topic, only the most specific one is used: the filter with the most literal
+    levels wins, and an exact match wins over a wildcard match. If that's still a tie, the filter with its first
+    wildcard further down wins (eg 'a/b/#' over 'a/+/c' for 'a/b/c'). Eg 'zmw_thing_extras/FooBar/#' will never match
+    a message published to 'zmw_thing_extras/Foo'.
+
+    Not thread safe.
+    """
+
+    def __init__(self):
+        self._root = _TrieNode()
+        self._filter_count = 0
+
+    def __len__(self):
+        return self._filter_count
+
+    def __contains__(self, topic_filter):
+        node = self._find(topic_filter)
+        return node is not None and len(node.cbs) > 0
+
+    def add(self, topic_filter, cb, replace=False):
+        """ Adds a callback for a topic filter. If replace, any other callbacks for this filter are discarded.
+        Returns True if this filter had no callbacks before. """
+        levels = _validate_filter(topic_filter)
+        node = self._root
+        for level in levels:
+            node = node.children.setdefault(level, _TrieNode())
+
+        is_new = len(node.cbs) == 0
+        if is_new:
+            self._filter_count += 1
+            node.topic_filter = topic_filter
+            literals = []
+            for level in levels:
+                if level in ('+', '#'):
+                    break
+                literals.append(level)
+            node.prefix = '/'.join(literals)
+
+        if replace:
+            node.cbs = [cb]
+        else:
+            node.cbs.append(cb)
+        return is_new
+
+    def remove(self, topic_filter, cb=None):
+        """ Removes a callback (or all callbacks, if cb is None) for a topic filter, and prunes the trie of empty
+        nodes. Returns True if the filter has no callbacks left after this call. """
+        levels = topic_filter.split('/')
+        path = [self._root]
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return True
+            path.append(node)
+
+        node = path[-1]
+        if len(node.cbs) == 0:
+            return True
+        if cb is None:
+            node.cbs = []
+        else:
+            node.cbs = [c for c in node.cbs if c != cb]
+        if len(node.cbs) != 0:
+            return False
+
+        self._filter_count -= 1
+        node.topic_filter = None
+        node.prefix = None
+        for depth in range(len(levels), 0, -1):
+            child = path[depth]
+            if len(child.cbs) != 0 or len(child.children) != 0:
+                break
+            del path[depth - 1].children[levels[depth - 1]]
+        return True
+
+    def get_filters(self):
+        """ All filters with at least one callback """
+        filters = []
+        pending = [self._root]
+        while pending:
+            node = pending.pop()
+            if len(node.cbs) != 0:
+                filters.append(node.topic_filter)
+            pending.extend(node.children.values())
+        return filters
+
+    def match(self, topic):
+        """ Returns (prefix, callbacks) for the most specific filter matching this topic, or (None, []) if no filter
+        matches. prefix is the non-wildcard part of the matched filter, so that the subtopic of a message is
+        topic[len(prefix) + 1:] """
+        levels = topic.split('/')
+        best_node = None
+        best_score = None
+
+        def _consider(node, literal_levels, is_exact):
+            nonlocal best_node, best_score
+            # Prefixes of filters matching the same topic are prefixes of each other, so the longest is the deepest
+            score = (literal_levels, is_exact, len(node.prefix))
+            if best_score is None or score > best_score:
+                best_node = node
+                best_score = score
+
+        pending = [(self._root, 0, 0)]
+        while pending:
+            node, depth, literal_levels = pending.pop()
+            # Per MQTT spec, wildcards in the first level don't match topics starting with '$'
+            wildcards_ok = depth != 0 or not topic.startswith('$')
+            multi = node.children.get('#')
+            if wildcards_ok and multi is not None and len(multi.cbs) != 0:
+                _consider(multi, literal_levels, False)
+            if depth == len(levels):
+                if len(node.cbs) != 0:
+                    _consider(node, literal_levels, literal_levels == len(levels))
+                continue
+            child = node.children.get(levels[depth])
+            if child is not None:
+                pending.append((child, depth + 1, literal_levels + 1))
+            single = node.children.get('+')
+            if wildcards_ok and single is not None:
+                pending.append((single, depth + 1, literal_levels))
+
+        if best_node is None:
+            return None, []
+        return best_node.prefix, list(best_node.cbs)
+
+    def _find(self, topic_filter):
+        node = self._root
+        for level in topic_filter.split('/'):
+            node = node.children.get(level)
+            if node is None:
+                return None
+        return node
@@ -0,0 +1,86 @@
+""" Tracing of the time it takes from an MQTT message arriving to a service publishing a message in response """
+
+import logging
+import threading
+import time
+
+from .logs import build_logger
+from .metrics import get_metrics_registry
+
+log = build_logger("MqttTrace", logging.INFO)
+
+_event_to_publish_ms = get_metrics_registry().histogram(
+        'mqtt_event_to_publish_ms', 'Time from an MQTT message arriving to the first message published in response',
+        ('thing', 'action'))
+
+# The trace of the message whose callbacks are running in this thread
+_local = threading.local()
+
+
+class MqttTrace:
+    """
+    Timeline of the handling of a single MQTT message. Each stage of the handling calls mark(stage) when it's done,
+    and the time since the previous mark is added to that stage. When the first response to this message is
+    published, the total latency is recorded, and the breakdown is logged if it took longer than slow_ms.
+    """
+    __slots__ = ('topic', 'thing', 'action', 'stages', 'published', '_t_arrival', '_t_last', '_slow_ms')
+
+    def __init__(self, topic, t_arrival, slow_ms=None):
+        self.topic = topic
+        # Whatever handles the message may label it with the thing and action it affected
+        self.thing = None
+        self.action = None
+        self.stages = {}
+        self.published = False
+        self._t_arrival = t_arrival
+        self._t_last = t_arrival
+        self._slow_ms = slow_ms
+
+    def mark(self, stage):
+        now = time.monotonic()
+        self.stages[stage] = self.stages.get(stage, 0.0) + 1000 * (now - self._t_last)
+        self._t_last = now
+
+    def on_published(self):
+        """ A response to this message was published. Only the first response is recorded. """
+        self.mark('publish')
+        if self.published:
+            return
+        self.published = True
+        total_ms = 1000 * (self._t_last - self._t_arrival)
+        thing = self.thing if self.thing is not None else self.topic
+        action = self.action if self.action is not None else ''
+        _event_to_publish_ms.observe(total_ms, thing=thing, action=action)
+        if self._slow_ms is not None and total_ms > self._slow_ms:
+            breakdown = ', '.join(f'{stage}={ms:.1f}ms' for stage, ms in self.stages.items())
+            log.warning("Slow response to MQTT message on '%s' (thing %s, action %s): %.1f ms to publish. %s",
+                        self.topic, thing, action or '-', total_ms, breakdown)
+
+
+def activate_trace(trace):
+    """ Make trace the current trace of this thread, returns the previous one so it can be restored """
+    prev = getattr(_local, 'trace', None)
+    _local.trace = trace
+    return prev
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+def mark_trace(stage):
+    """ Mark the end of a stage in the current trace, if any """
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.mark(stage)
+
+
+def label_trace(thing=None, action=None):
+    """ Label the current trace (if any) with the thing and/or action affected by the message """
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return
+    if thing is not None:
+        trace.thing = thing
+    if action is not None:
+        trace.action = action
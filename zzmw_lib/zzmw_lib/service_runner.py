@@ -1,3 +1,4 @@
+import datetime
 import inspect
 import json
 import logging
@@ -9,9 +10,10 @@ import sys
 import threading
 import time
 
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED, EVENT_JOB_SUBMITTED
 from apscheduler.schedulers.background import BackgroundScheduler
 
-from flask import Flask
+from flask import Flask, Response, g, request
 from flask import send_from_directory, abort, redirect, url_for
 from werkzeug.serving import make_server, WSGIRequestHandler
 
@@ -20,7 +22,9 @@ from systemd.journal import JournalHandler
 
 from .zmw_mqtt_base import ZmwMqttBase
 from .logs import build_logger
+from .metrics import get_metrics_registry
 from .network_helpers import get_lan_ip, get_cached_port, is_safe_path
+from .www_events import EventStream
 
 log = build_logger("ServiceRunner")
 
@@ -206,6 +210,91 @@ def get_this_service_logs():
 
     return {"logs": logs, "count": len(logs)}
 
+def _serve_event_stream(events):
+    """ SSE endpoint for www.events """
+    stream = events.subscribe(request.headers.get('Last-Event-ID'))
+    if stream is None:
+        return {"error": "Too many event stream subscribers"}, 503
+    return Response(stream, mimetype='text/event-stream', headers={
+        # Don't let proxies buffer events
+        'X-Accel-Buffering': 'no',
+    })
+
+def _instrument_www(flaskapp, metrics):
+    """ Request latency per endpoint. Endpoints are reported by their url rule (eg /z2m/get/<thing_name>) so that
+    the number of metrics stays bounded """
+    req_ms = metrics.histogram('www_request_ms', 'Time to handle www requests', ('endpoint', 'method', 'status'))
+
+    @flaskapp.before_request
+    def _start_request_timer():
+        g.zmw_request_start = time.monotonic()
+
+    @flaskapp.after_request
+    def _record_request_time(response):
+        t_start = g.get('zmw_request_start')
+        if t_start is not None:
+            endpoint = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+            req_ms.observe(1000 * (time.monotonic() - t_start),
+                           endpoint=endpoint, method=request.method, status=response.status_code)
+        return response
+
+
+def _instrument_scheduler(sched, metrics):
+    """ How long scheduled jobs take to complete, and how late they start """
+    # Measured from apscheduler's events: from submitting the job to the executor until it's done, so it includes
+    # the time waiting for a free executor thread
+    done_ms = metrics.histogram('sched_job_submit_to_done_ms',
+                                'Time from a job being submitted to the executor to it being done, including '
+                                'time waiting for a free executor thread', ('job',))
+    lag_ms = metrics.histogram('sched_job_start_lag_ms', 'Delay between a job being due and being submitted to run',
+                               ('job',))
+    errors = metrics.counter('sched_job_errors_total', 'Scheduled jobs that raised an exception', ('job',))
+    lock = threading.Lock()
+    # (job id, scheduled run time) -> (job name, monotonic time the job was submitted). Protected by lock
+    submitted = {}
+
+    def _on_job_event(ev):
+        if ev.code == EVENT_JOB_SUBMITTED:
+            # Job ids of one-shot jobs are random, so label by the job's name (usually its function name). One-shot
+            # jobs may be gone from the scheduler by now.
+            job = sched.get_job(ev.job_id)
+            job_name = job.name if job is not None else '<oneshot>'
+            now = time.monotonic()
+            with lock:
+                if len(submitted) > 1000:
+                    # Executed events were lost (eg executor shutdown), don't grow forever
+                    submitted.clear()
+                for run_time in ev.scheduled_run_times:
+                    submitted[(ev.job_id, run_time)] = (job_name, now)
+                    lag = datetime.datetime.now(run_time.tzinfo) - run_time
+                    lag_ms.observe(max(0, 1000 * lag.total_seconds()), job=job_name)
+            return
+
+        with lock:
+            job_name, t_submitted = submitted.pop((ev.job_id, ev.scheduled_run_time), (None, None))
+        if job_name is None:
+            return
+        done_ms.observe(1000 * (time.monotonic() - t_submitted), job=job_name)
+        if ev.code == EVENT_JOB_ERROR:
+            errors.inc(job=job_name)
+
+    sched.add_listener(_on_job_event, EVENT_JOB_SUBMITTED | EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+
+
+def _get_rss_bytes():
+    with open('/proc/self/statm', 'r') as fp:
+        return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _serve_metrics(metrics):
+    """ /svc_metrics: Prometheus text format by default, json if requested with ?format=json or an Accept header """
+    wants_json = request.args.get('format') == 'json' or \
+                 request.accept_mimetypes.best_match(['text/plain', 'application/json']) == 'application/json'
+    if wants_json:
+        return metrics.as_json()
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
 def service_runner(AppClass):
     """
     Run a service application with embedded Flask web server.
@@ -220,12 +309,19 @@ def service_runner(AppClass):
                   - serve_url(path, view_func, methods=['GET'])
                   - register_www_dir(wwwdir, prefix='/')
                   - public_url_base (http://host:port)
+                  - events: EventStream served as /svc_events, and
+                    publish_event(event, data) to push events to it
+                  - metrics: MetricsRegistry served as /svc_metrics
 
     The Flask app runs in a background thread while the main thread
     runs the service's loop_forever().
     """
     cfg = _get_config()
     flaskapp, wwwserver = _create_www_server(AppClass, cfg)
+    metrics = get_metrics_registry()
+    _instrument_www(flaskapp, metrics)
+    metrics.gauge('threads', 'Number of running threads', value_fn=threading.active_count)
+    metrics.gauge('rss_bytes', 'Resident memory of this process', value_fn=_get_rss_bytes)
 
     def serve_url(url_path, view_func, methods=['GET']):
         return flaskapp.add_url_rule(rule=url_path,
@@ -270,8 +366,13 @@ def service_runner(AppClass):
     def _www_serve_bg():
         www_thread.start()
 
+    events = EventStream(max_subscribers=cfg.get('www_max_event_subscribers', 20))
+
     flaskapp.serve_url = serve_url
     flaskapp.url_cb_ret_none = url_cb_ret_none
+    flaskapp.events = events
+    flaskapp.publish_event = events.publish
+    flaskapp.metrics = metrics
     flaskapp.register_www_dir = register_www_dir
     flaskapp.startup_automatically = True
     flaskapp.setup_complete = _www_serve_bg
@@ -280,6 +381,10 @@ def service_runner(AppClass):
     # Add an endpoint to retrieve logs for this service
     flaskapp.serve_url('/svc_logs', get_this_service_logs)
     flaskapp.serve_url('/svc_logs.html', lambda: send_from_directory(_lib_www_path, 'svc_logs.html'))
+    # Push events to www UIs
+    flaskapp.serve_url('/svc_events', lambda: _serve_event_stream(events))
+    # Metrics, for this process and for the library code it runs
+    flaskapp.serve_url('/svc_metrics', lambda: _serve_metrics(metrics))
     # Add endpoints for common www things
     flaskapp.serve_url('/zmw.css', lambda: send_from_directory(_lib_www_path, 'build/zmw.css'))
     flaskapp.serve_url('/zmw.js', lambda: send_from_directory(_lib_www_path, 'build/zmw.js'))
@@ -293,6 +398,7 @@ def service_runner(AppClass):
     # reliable mechanism to schedule things (otherwise the service is broken) we'll try to minimize issues that may
     # happen due to concurrency bugs between BG schedulers.
     global_bg_svc_sheduler = BackgroundScheduler()
+    _instrument_scheduler(global_bg_svc_sheduler, metrics)
     global_bg_svc_sheduler.start()
 
     app = AppClass(cfg, flaskapp, global_bg_svc_sheduler)
@@ -304,6 +410,7 @@ def service_runner(AppClass):
 
     def signal_handler(sig, frame):
         log.info("Shutdown requested by signal, stop app...")
+        events.close()
         wwwserver.shutdown()
         app.stop()
         log.info("Clean exit")
@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# Add the zzmw_lib package root to sys.path so tests can import modules
+package_root = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(package_root))
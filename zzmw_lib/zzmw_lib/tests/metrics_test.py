@@ -0,0 +1,144 @@
+import unittest
+
+from zzmw_lib.metrics import MetricsRegistry
+
+
+def _prometheus_lines(registry):
+    return registry.render_prometheus().splitlines()
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def test_same_name_returns_same_metric(self):
+        registry = MetricsRegistry()
+        self.assertIs(registry.counter('msgs', 'Messages'), registry.counter('msgs', 'Messages'))
+
+    def test_same_name_with_other_type_or_labels_fails(self):
+        registry = MetricsRegistry()
+        registry.counter('msgs', 'Messages', ('topic',))
+        self.assertRaises(ValueError, registry.gauge, 'msgs', 'Messages', ('topic',))
+        self.assertRaises(ValueError, registry.counter, 'msgs', 'Messages', ('svc',))
+
+    def test_invalid_names(self):
+        registry = MetricsRegistry()
+        self.assertRaises(ValueError, registry.counter, 'msgs-total', 'Messages')
+        self.assertRaises(ValueError, registry.counter, 'msgs', 'Messages', ('a topic',))
+        self.assertRaises(ValueError, registry.histogram, 'lat', 'Latency', ('le',))
+        self.assertRaises(ValueError, registry.register_collector, 'my stats', dict)
+
+    def test_labels_must_match(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('msgs', 'Messages', ('topic',))
+        self.assertRaises(ValueError, counter.inc)
+        self.assertRaises(ValueError, counter.inc, svc='a')
+        self.assertRaises(ValueError, counter.inc, topic='a', svc='b')
+
+
+class TestPrometheusRendering(unittest.TestCase):
+    def test_counter(self):
+        registry = MetricsRegistry(prefix='t_')
+        counter = registry.counter('msgs_total', 'Messages received', ('topic',))
+        counter.inc(topic='a')
+        counter.inc(2, topic='a')
+        counter.inc(topic='b')
+        self.assertEqual(_prometheus_lines(registry), [
+            '# HELP t_msgs_total Messages received',
+            '# TYPE t_msgs_total counter',
+            't_msgs_total{topic="a"} 3',
+            't_msgs_total{topic="b"} 1',
+        ])
+
+    def test_unlabeled_gauge(self):
+        registry = MetricsRegistry(prefix='t_')
+        registry.gauge('temp', 'Temperature').set(21.5)
+        self.assertEqual(_prometheus_lines(registry), [
+            '# HELP t_temp Temperature',
+            '# TYPE t_temp gauge',
+            't_temp 21.5',
+        ])
+
+    def test_gauge_callback(self):
+        registry = MetricsRegistry(prefix='t_')
+        vals = [1, 2]
+        registry.gauge('queue', 'Queue depth', value_fn=vals.pop)
+        self.assertEqual(_prometheus_lines(registry)[-1], 't_queue 2')
+        self.assertEqual(_prometheus_lines(registry)[-1], 't_queue 1')
+        # A failing callback reports no value, instead of failing the whole page
+        self.assertEqual(_prometheus_lines(registry)[-1], 't_queue NaN')
+        self.assertRaises(ValueError, registry.gauge, 'labeled', 'Labeled', ('a',), value_fn=lambda: 1)
+
+    def test_histogram(self):
+        registry = MetricsRegistry(prefix='t_')
+        hist = registry.histogram('lat_ms', 'Latency', ('op',), buckets=(10, 1, 100))
+        for val in (0.5, 1, 5, 50, 500):
+            hist.observe(val, op='get')
+        self.assertEqual(_prometheus_lines(registry), [
+            '# HELP t_lat_ms Latency',
+            '# TYPE t_lat_ms histogram',
+            't_lat_ms_bucket{op="get",le="1.0"} 2',
+            't_lat_ms_bucket{op="get",le="10.0"} 3',
+            't_lat_ms_bucket{op="get",le="100.0"} 4',
+            't_lat_ms_bucket{op="get",le="+Inf"} 5',
+            't_lat_ms_sum{op="get"} 556.5',
+            't_lat_ms_count{op="get"} 5',
+        ])
+
+    def test_label_values_are_escaped(self):
+        registry = MetricsRegistry(prefix='t_')
+        registry.counter('msgs', 'Messages', ('topic',)).inc(topic='a"b\\c\nd')
+        self.assertEqual(_prometheus_lines(registry)[-1], 't_msgs{topic="a\\"b\\\\c\\nd"} 1')
+
+    def test_collectors_are_flattened_to_gauges(self):
+        registry = MetricsRegistry(prefix='t_')
+        registry.register_collector('pub', lambda: {
+            'queue_depth': 3,
+            'connected': True,
+            'per_worker': [1, 2],
+            'latency': {'p50 ms': 1.5, 'max': None},
+            'name': 'not a number',
+        })
+        self.assertEqual(_prometheus_lines(registry), [
+            '# TYPE t_pub_queue_depth gauge',
+            't_pub_queue_depth 3',
+            '# TYPE t_pub_connected gauge',
+            't_pub_connected 1',
+            '# TYPE t_pub_per_worker_0 gauge',
+            't_pub_per_worker_0 1',
+            '# TYPE t_pub_per_worker_1 gauge',
+            't_pub_per_worker_1 2',
+            '# TYPE t_pub_latency_p50_ms gauge',
+            't_pub_latency_p50_ms 1.5',
+        ])
+
+    def test_failing_collector_doesnt_break_rendering(self):
+        registry = MetricsRegistry(prefix='t_')
+        registry.counter('msgs', 'Messages').inc()
+        registry.register_collector('broken', lambda: 1 / 0)
+        self.assertEqual(_prometheus_lines(registry)[-1], 't_msgs 1')
+        self.assertIn('error', registry.as_json()['stats']['broken'])
+
+    def test_unregistered_collector_is_gone(self):
+        registry = MetricsRegistry(prefix='t_')
+        registry.register_collector('pub', lambda: {'a': 1})
+        registry.unregister_collector('pub')
+        self.assertEqual(registry.render_prometheus(), '\n')
+
+
+class TestJsonRendering(unittest.TestCase):
+    def test_json(self):
+        registry = MetricsRegistry(prefix='t_')
+        registry.counter('msgs', 'Messages', ('topic',)).inc(topic='a')
+        hist = registry.histogram('lat_ms', 'Latency', buckets=(1, 10))
+        hist.observe(2)
+        hist.observe(4)
+        registry.register_collector('pub', lambda: {'queue_depth': 3})
+        as_json = registry.as_json()
+        self.assertEqual(as_json['metrics']['t_msgs']['values'], [{'labels': {'topic': 'a'}, 'value': 1}])
+        self.assertEqual(as_json['metrics']['t_lat_ms']['values'], [{
+            'labels': {}, 'count': 2, 'sum': 6.0, 'avg': 3.0, 'max': 4,
+            'buckets': {'1': 0, '10': 2, '+Inf': 0},
+        }])
+        self.assertEqual(as_json['stats'], {'pub': {'queue_depth': 3}})
+
+
+if __name__ == '__main__':
+    unittest.main()
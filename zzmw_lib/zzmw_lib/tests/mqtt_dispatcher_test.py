@@ -0,0 +1,148 @@
+import threading
+import time
+import unittest
+
+from zzmw_lib.mqtt_dispatcher import MqttCallbackDispatcher, OVERLOAD_BLOCK, OVERLOAD_COALESCE, OVERLOAD_DROP
+from zzmw_lib.mqtt_dispatcher import validate_overload_policy
+
+
+class _Recorder:
+    """ Callback recording its calls. Calls block while the recorder is paused. """
+    def __init__(self):
+        self.calls = []
+        self.running = threading.Event()
+        self._unpaused = threading.Event()
+        self._unpaused.set()
+        self._lock = threading.Lock()
+
+    def pause(self):
+        self._unpaused.clear()
+
+    def resume(self):
+        self._unpaused.set()
+
+    def __call__(self, *args):
+        self.running.set()
+        self._unpaused.wait()
+        with self._lock:
+            self.calls.append(args)
+
+
+def _wait_for(cond, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > deadline:
+            raise AssertionError('Timed out waiting for callbacks')
+        time.sleep(0.01)
+
+
+def _stall_worker(dispatcher, key='stall'):
+    """ Keep the (single) worker busy until the returned callback is resumed """
+    blocker = _Recorder()
+    blocker.pause()
+    dispatcher.submit(key, blocker, ())
+    blocker.running.wait(timeout=2)
+    return blocker
+
+
+class TestMqttCallbackDispatcher(unittest.TestCase):
+    def test_same_key_runs_in_order(self):
+        dispatcher = MqttCallbackDispatcher(n_workers=4)
+        cb = _Recorder()
+        for i in range(100):
+            dispatcher.submit('a/b', cb, (i,))
+        _wait_for(lambda: len(cb.calls) == 100)
+        self.assertEqual(cb.calls, [(i,) for i in range(100)])
+
+    def test_slow_key_doesnt_block_other_workers(self):
+        dispatcher = MqttCallbackDispatcher(n_workers=2)
+        # Find two keys handled by different workers
+        keys = ['a', 'b', 'c', 'd']
+        worker_of = {k: hash(k) % 2 for k in keys}
+        slow_key = keys[0]
+        fast_key = next(k for k in keys if worker_of[k] != worker_of[slow_key])
+        blocker = _stall_worker(dispatcher, slow_key)
+        cb = _Recorder()
+        dispatcher.submit(fast_key, cb, (1,))
+        _wait_for(lambda: len(cb.calls) == 1)
+        blocker.resume()
+
+    def test_exceptions_dont_kill_the_worker(self):
+        dispatcher = MqttCallbackDispatcher(n_workers=1)
+        cb = _Recorder()
+        dispatcher.submit('a', lambda: 1 / 0, ())
+        dispatcher.submit('a', cb, (1,))
+        _wait_for(lambda: len(cb.calls) == 1)
+
+    def test_drop_when_full(self):
+        dispatcher = MqttCallbackDispatcher(n_workers=1, max_queued=2)
+        blocker = _stall_worker(dispatcher)
+        cb = _Recorder()
+        results = [dispatcher.submit('a', cb, (i,), OVERLOAD_DROP) for i in range(3)]
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(dispatcher.get_stats()['dropped'], 1)
+        blocker.resume()
+        _wait_for(lambda: len(cb.calls) == 2)
+        self.assertEqual(cb.calls, [(0,), (1,)])
+
+    def test_coalesce_below_high_water_mark_keeps_every_message(self):
+        dispatcher = MqttCallbackDispatcher(n_workers=1, max_queued=10, coalesce_above=5)
+        blocker = _stall_worker(dispatcher)
+        cb = _Recorder()
+        for i in range(5):
+            dispatcher.submit('a', cb, (i,), OVERLOAD_COALESCE)
+        blocker.resume()
+        _wait_for(lambda: len(cb.calls) == 5)
+        self.assertEqual(cb.calls, [(i,) for i in range(5)])
+        self.assertEqual(dispatcher.get_stats()['coalesced'], 0)
+
+    def test_coalesce_above_high_water_mark_keeps_latest(self):
+        dispatcher = MqttCallbackDispatcher(n_workers=1, max_queued=10, coalesce_above=2)
+        blocker = _stall_worker(dispatcher)
+        cb = _Recorder()
+        other_cb = _Recorder()
+        for i in range(6):
+            dispatcher.submit('a', cb, (i,), OVERLOAD_COALESCE)
+        dispatcher.submit('b', other_cb, ('x',), OVERLOAD_COALESCE)
+        blocker.resume()
+        _wait_for(lambda: len(cb.calls) == 3 and len(other_cb.calls) == 1)
+        # 0 and 1 were queued before the mark, 2 was replaced by the latest message
+        self.assertEqual(cb.calls, [(0,), (1,), (5,)])
+        self.assertEqual(dispatcher.get_stats()['coalesced'], 3)
+
+    def test_coalesced_message_isnt_replaced_after_a_newer_one_is_queued(self):
+        dispatcher = MqttCallbackDispatcher(n_workers=1, max_queued=10, coalesce_above=1)
+        blocker = _stall_worker(dispatcher)
+        cb = _Recorder()
+        dispatcher.submit('a', cb, (0,), OVERLOAD_COALESCE)
+        # Above the mark: replaceable
+        dispatcher.submit('a', cb, (1,), OVERLOAD_COALESCE)
+        dispatcher.submit('a', cb, (2,), OVERLOAD_COALESCE)
+        # Make room, so the next message is queued normally
+        dispatcher._coalesce_above = 10
+        dispatcher.submit('a', cb, (3,), OVERLOAD_COALESCE)
+        dispatcher._coalesce_above = 1
+        dispatcher.submit('a', cb, (4,), OVERLOAD_COALESCE)
+        blocker.resume()
+        _wait_for(lambda: len(cb.calls) == 4)
+        # 4 didn't replace 2, which must still run before 3
+        self.assertEqual(cb.calls, [(0,), (2,), (3,), (4,)])
+
+    def test_stats(self):
+        dispatcher = MqttCallbackDispatcher(n_workers=1)
+        cb = _Recorder()
+        dispatcher.submit('a', cb, (1,), OVERLOAD_BLOCK)
+        _wait_for(lambda: len(cb.calls) == 1)
+        _wait_for(lambda: len(dispatcher.get_stats()['callbacks']) == 1)
+        stats = dispatcher.get_stats()
+        self.assertEqual(stats['queue_depth'], [0])
+        cb_stats = list(stats['callbacks'].values())[0]
+        self.assertEqual(cb_stats['calls'], 1)
+
+    def test_validate_overload_policy(self):
+        self.assertEqual(validate_overload_policy(OVERLOAD_DROP), OVERLOAD_DROP)
+        self.assertRaises(ValueError, validate_overload_policy, 'latest')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import threading
+import unittest
+
+import paho.mqtt.client as mqtt
+from zzmw_lib.mqtt_publisher import MqttPublisher
+
+
+class _PublishInfo:
+    def __init__(self, rc, mid):
+        self.rc = rc
+        self.mid = mid
+
+
+class FakeMqttClient:
+    """ Records published messages. Acks are sent by the test, unless auto_ack is set """
+    def __init__(self, rc=mqtt.MQTT_ERR_SUCCESS, auto_ack=False):
+        self.rc = rc
+        self.auto_ack = auto_ack
+        self.publisher = None
+        self.published = []
+        self.unacked = []
+        self._lock = threading.Lock()
+        self._last_mid = 0
+
+    def publish(self, topic, payload, qos):
+        with self._lock:
+            self._last_mid += 1
+            mid = self._last_mid
+            self.published.append((topic, payload, qos))
+        if self.auto_ack:
+            # Acked before publish() returns its mid
+            self.publisher.on_publish(self, None, mid)
+        else:
+            self.unacked.append(mid)
+        return _PublishInfo(self.rc, mid)
+
+    def ack_all(self):
+        mids, self.unacked = self.unacked, []
+        for mid in mids:
+            self.publisher.on_publish(self, None, mid)
+
+
+def _make_publisher(client, **kwargs):
+    publisher = MqttPublisher(client, **kwargs)
+    client.publisher = publisher
+    return publisher
+
+
+class TestMqttPublisher(unittest.TestCase):
+    def test_publishes_in_order(self):
+        client = FakeMqttClient(auto_ack=True)
+        publisher = _make_publisher(client)
+        for i in range(10):
+            self.assertTrue(publisher.publish('a/b', str(i)))
+        self.assertTrue(publisher.flush())
+        self.assertEqual(client.published, [('a/b', str(i), 1) for i in range(10)])
+        stats = publisher.get_stats()
+        self.assertEqual(stats['published'], 10)
+        self.assertEqual(stats['waiting_ack'], 0)
+        self.assertIsNotNone(stats['latency_ms_max'])
+
+    def test_flush_waits_for_acks(self):
+        client = FakeMqttClient()
+        publisher = _make_publisher(client)
+        publisher.publish('a', 'b')
+        self.assertTrue(publisher.flush(wait_for_acks=False))
+        self.assertFalse(publisher.flush(timeout=0.1))
+        self.assertEqual(publisher.get_stats()['waiting_ack'], 1)
+        client.ack_all()
+        self.assertTrue(publisher.flush(timeout=1))
+        self.assertEqual(publisher.get_stats()['published'], 1)
+
+    def test_unacked_messages_cap_inflight_and_fill_the_queue(self):
+        client = FakeMqttClient()
+        publisher = _make_publisher(client, max_queued=2, max_inflight=2, enqueue_timeout_secs=0.1)
+        # 2 in flight, then 1 taken by the worker (waiting for an inflight slot) and 2 queued
+        results = [publisher.publish('a', str(i)) for i in range(6)]
+        self.assertEqual(results, [True] * 5 + [False])
+        self.assertEqual(len(client.published), 2)
+        stats = publisher.get_stats()
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['queue_depth'], 2)
+
+        # Acks make room for the rest
+        while len(client.published) < 5:
+            client.ack_all()
+            publisher.flush(timeout=0.1, wait_for_acks=False)
+        client.ack_all()
+        self.assertTrue(publisher.flush(timeout=1))
+        self.assertEqual([payload for _, payload, _ in client.published], ['0', '1', '2', '3', '4'])
+        self.assertEqual(publisher.get_stats()['published'], 5)
+
+    def test_failed_publish_is_dropped(self):
+        client = FakeMqttClient(rc=mqtt.MQTT_ERR_QUEUE_SIZE)
+        publisher = _make_publisher(client, max_inflight=1)
+        publisher.publish('a', 'b')
+        publisher.publish('a', 'c')
+        self.assertTrue(publisher.flush(timeout=1))
+        stats = publisher.get_stats()
+        self.assertEqual(stats['dropped'], 2)
+        self.assertEqual(stats['published'], 0)
+
+    def test_client_exception_is_dropped(self):
+        client = FakeMqttClient()
+        client.publish = lambda topic, payload, qos: 1 / 0
+        publisher = _make_publisher(client, max_inflight=1)
+        publisher.publish('a', 'b')
+        publisher.publish('a', 'c')
+        self.assertTrue(publisher.flush(timeout=1))
+        self.assertEqual(publisher.get_stats()['dropped'], 2)
+
+    def test_disconnected_messages_wait_for_ack(self):
+        # paho holds messages published while disconnected, and sends them once it reconnects
+        client = FakeMqttClient(rc=mqtt.MQTT_ERR_NO_CONN)
+        publisher = _make_publisher(client)
+        publisher.publish('a', 'b')
+        self.assertFalse(publisher.flush(timeout=0.1))
+        self.assertEqual(publisher.get_stats()['dropped'], 0)
+        client.ack_all()
+        self.assertTrue(publisher.flush(timeout=1))
+        self.assertEqual(publisher.get_stats()['published'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+import unittest
+from zzmw_lib.mqtt_topic_trie import MqttTopicTrie, mqtt_topic_to_filter
+
+
+def _cb(name):
+    def cb():
+        return name
+    cb.__name__ = name
+    return cb
+
+
+class TestMqttTopicTrieMatching(unittest.TestCase):
+    def test_exact_match(self):
+        trie = MqttTopicTrie()
+        foo = _cb('foo')
+        trie.add('a/b', foo)
+        self.assertEqual(trie.match('a/b'), ('a/b', [foo]))
+        self.assertEqual(trie.match('a'), (None, []))
+        self.assertEqual(trie.match('a/b/c'), (None, []))
+
+    def test_single_level_wildcard(self):
+        trie = MqttTopicTrie()
+        foo = _cb('foo')
+        trie.add('a/+/c', foo)
+        self.assertEqual(trie.match('a/b/c'), ('a', [foo]))
+        self.assertEqual(trie.match('a/x/c'), ('a', [foo]))
+        self.assertEqual(trie.match('a/b/c/d'), (None, []))
+        self.assertEqual(trie.match('a/c'), (None, []))
+
+    def test_multi_level_wildcard(self):
+        trie = MqttTopicTrie()
+        foo = _cb('foo')
+        trie.add('a/#', foo)
+        self.assertEqual(trie.match('a/b'), ('a', [foo]))
+        self.assertEqual(trie.match('a/b/c/d'), ('a', [foo]))
+        self.assertEqual(trie.match('b/a'), (None, []))
+
+    def test_multi_level_wildcard_matches_parent_level(self):
+        trie = MqttTopicTrie()
+        foo = _cb('foo')
+        trie.add('a/b/#', foo)
+        self.assertEqual(trie.match('a/b'), ('a/b', [foo]))
+        self.assertEqual(trie.match('a'), (None, []))
+
+    def test_wildcards_dont_match_system_topics(self):
+        trie = MqttTopicTrie()
+        trie.add('#', _cb('all'))
+        trie.add('+/info', _cb('info'))
+        self.assertEqual(trie.match('$SYS/info'), (None, []))
+        sys_cb = _cb('sys')
+        trie.add('$SYS/#', sys_cb)
+        self.assertEqual(trie.match('$SYS/info'), ('$SYS', [sys_cb]))
+
+    def test_subtopic_follows_prefix(self):
+        trie = MqttTopicTrie()
+        trie.add('zigbee2mqtt/#', _cb('z2m'))
+        topic = 'zigbee2mqtt/Lamp/set'
+        prefix, _ = trie.match(topic)
+        self.assertEqual(topic[len(prefix) + 1:], 'Lamp/set')
+
+
+class TestMqttTopicTrieSpecificity(unittest.TestCase):
+    def test_most_literal_levels_wins(self):
+        trie = MqttTopicTrie()
+        generic = _cb('generic')
+        specific = _cb('specific')
+        trie.add('a/#', generic)
+        trie.add('a/b/#', specific)
+        self.assertEqual(trie.match('a/b/c'), ('a/b', [specific]))
+        self.assertEqual(trie.match('a/x/c'), ('a', [generic]))
+
+    def test_order_of_subscription_doesnt_matter(self):
+        trie = MqttTopicTrie()
+        generic = _cb('generic')
+        specific = _cb('specific')
+        trie.add('a/b/#', specific)
+        trie.add('a/#', generic)
+        self.assertEqual(trie.match('a/b/c'), ('a/b', [specific]))
+
+    def test_exact_match_wins_over_wildcard(self):
+        trie = MqttTopicTrie()
+        wildcard = _cb('wildcard')
+        exact = _cb('exact')
+        trie.add('a/b/#', wildcard)
+        trie.add('a/b', exact)
+        self.assertEqual(trie.match('a/b'), ('a/b', [exact]))
+        self.assertEqual(trie.match('a/b/c'), ('a/b', [wildcard]))
+
+    def test_literal_level_wins_over_single_level_wildcard(self):
+        trie = MqttTopicTrie()
+        single = _cb('single')
+        literal = _cb('literal')
+        trie.add('a/+/c', single)
+        trie.add('a/b/#', literal)
+        self.assertEqual(trie.match('a/b/c'), ('a/b', [literal]))
+
+    def test_prefix_of_a_level_is_not_a_match(self):
+        trie = MqttTopicTrie()
+        foobar = _cb('foobar')
+        trie.add('zmw_thing_extras/FooBar/#', foobar)
+        self.assertEqual(trie.match('zmw_thing_extras/Foo'), (None, []))
+
+    def test_all_callbacks_of_the_filter_are_returned(self):
+        trie = MqttTopicTrie()
+        foo = _cb('foo')
+        bar = _cb('bar')
+        self.assertTrue(trie.add('a/#', foo))
+        self.assertFalse(trie.add('a/#', bar))
+        self.assertEqual(trie.match('a/b'), ('a', [foo, bar]))
+
+    def test_replace_discards_other_callbacks(self):
+        trie = MqttTopicTrie()
+        foo = _cb('foo')
+        bar = _cb('bar')
+        trie.add('a/#', foo)
+        trie.add('a/#', bar, replace=True)
+        self.assertEqual(trie.match('a/b'), ('a', [bar]))
+
+
+class TestMqttTopicTrieRemove(unittest.TestCase):
+    def test_remove_one_callback(self):
+        trie = MqttTopicTrie()
+        foo = _cb('foo')
+        bar = _cb('bar')
+        trie.add('a/#', foo)
+        trie.add('a/#', bar)
+        self.assertFalse(trie.remove('a/#', foo))
+        self.assertEqual(trie.match('a/b'), ('a', [bar]))
+        self.assertEqual(len(trie), 1)
+        self.assertTrue(trie.remove('a/#', bar))
+        self.assertEqual(trie.match('a/b'), (None, []))
+        self.assertEqual(len(trie), 0)
+
+    def test_remove_all_callbacks(self):
+        trie = MqttTopicTrie()
+        trie.add('a/#', _cb('foo'))
+        trie.add('a/#', _cb('bar'))
+        self.assertTrue(trie.remove('a/#'))
+        self.assertNotIn('a/#', trie)
+        self.assertEqual(len(trie), 0)
+
+    def test_remove_unknown_filter(self):
+        trie = MqttTopicTrie()
+        trie.add('a/b', _cb('foo'))
+        self.assertTrue(trie.remove('a/c'))
+        self.assertTrue(trie.remove('a'))
+        self.assertEqual(len(trie), 1)
+
+    def test_removing_specific_filter_falls_back_to_generic(self):
+        trie = MqttTopicTrie()
+        generic = _cb('generic')
+        trie.add('a/#', generic)
+        trie.add('a/b/#', _cb('specific'))
+        trie.remove('a/b/#')
+        self.assertEqual(trie.match('a/b/c'), ('a', [generic]))
+
+    def test_empty_nodes_are_pruned(self):
+        trie = MqttTopicTrie()
+        trie.add('a/b/c/d', _cb('foo'))
+        trie.remove('a/b/c/d')
+        self.assertEqual(trie._root.children, {})
+
+    def test_pruning_keeps_nodes_in_use(self):
+        trie = MqttTopicTrie()
+        foo = _cb('foo')
+        bar = _cb('bar')
+        trie.add('a/b', foo)
+        trie.add('a/b/c/d', bar)
+        trie.remove('a/b/c/d')
+        self.assertEqual(list(trie._root.children['a'].children['b'].children), [])
+        self.assertEqual(trie.match('a/b'), ('a/b', [foo]))
+        trie.add('a/b/c/d', bar)
+        trie.remove('a/b')
+        self.assertEqual(trie.match('a/b/c/d'), ('a/b/c/d', [bar]))
+        self.assertEqual(trie.get_filters(), ['a/b/c/d'])
+
+
+class TestMqttTopicFilters(unittest.TestCase):
+    def test_invalid_filters(self):
+        trie = MqttTopicTrie()
+        self.assertRaises(ValueError, trie.add, 'a/#/b', _cb('foo'))
+        self.assertRaises(ValueError, trie.add, 'a/b#', _cb('foo'))
+        self.assertRaises(ValueError, trie.add, 'a/b+/c', _cb('foo'))
+        self.assertEqual(len(trie), 0)
+
+    def test_topic_to_filter(self):
+        self.assertEqual(mqtt_topic_to_filter('zigbee2mqtt'), 'zigbee2mqtt/#')
+        self.assertEqual(mqtt_topic_to_filter('a/+/c'), 'a/+/c')
+        self.assertEqual(mqtt_topic_to_filter('a/#'), 'a/#')
+
+    def test_get_filters(self):
+        trie = MqttTopicTrie()
+        trie.add('a/#', _cb('foo'))
+        trie.add('a/+/c', _cb('bar'))
+        trie.add('b', _cb('baz'))
+        self.assertEqual(sorted(trie.get_filters()), ['a/#', 'a/+/c', 'b'])
+        self.assertIn('a/+/c', trie)
+        self.assertNotIn('a', trie)
+
+
+if __name__ == '__main__':
+    unittest.main()
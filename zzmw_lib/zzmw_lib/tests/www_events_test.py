@@ -0,0 +1,132 @@
+import json
+import threading
+import unittest
+
+from zzmw_lib.www_events import EventStream
+
+
+def _parse(chunk):
+    """ [(id, event, data)] of the SSE events in a chunk of the stream """
+    events = []
+    for block in chunk.split('\n\n'):
+        fields = {}
+        for line in block.splitlines():
+            if line.startswith(':') or ': ' not in line:
+                continue
+            key, val = line.split(': ', 1)
+            fields[key] = val
+        if 'event' in fields:
+            events.append((int(fields['id']), fields['event'], json.loads(fields['data'])))
+    return events
+
+
+class TestEventStream(unittest.TestCase):
+    def test_stream_starts_with_retry(self):
+        events = EventStream()
+        stream = events.subscribe()
+        self.assertEqual(next(stream), 'retry: 2000\n\n')
+        stream.close()
+
+    def test_new_subscriber_only_gets_new_events(self):
+        events = EventStream()
+        events.publish('old', {'n': 0})
+        stream = events.subscribe()
+        next(stream)
+        events.publish('new', {'n': 1})
+        self.assertEqual(_parse(next(stream)), [(2, 'new', {'n': 1})])
+        stream.close()
+
+    def test_pending_events_are_sent_together(self):
+        events = EventStream()
+        stream = events.subscribe()
+        next(stream)
+        events.publish('a', 1)
+        events.publish('b', 2)
+        self.assertEqual(_parse(next(stream)), [(1, 'a', 1), (2, 'b', 2)])
+        stream.close()
+
+    def test_reconnecting_subscriber_gets_missed_events(self):
+        events = EventStream()
+        for i in range(5):
+            events.publish('ev', i)
+        stream = events.subscribe(last_event_id='3')
+        next(stream)
+        self.assertEqual(_parse(next(stream)), [(4, 'ev', 3), (5, 'ev', 4)])
+        stream.close()
+
+    def test_unknown_last_event_id_is_ignored(self):
+        events = EventStream()
+        events.publish('ev', 0)
+        for last_id in ('garbage', '42'):
+            stream = events.subscribe(last_event_id=last_id)
+            next(stream)
+            events.publish('ev', last_id)
+            self.assertEqual([ev[2] for ev in _parse(next(stream))], [last_id])
+            stream.close()
+
+    def test_subscriber_that_missed_too_much_gets_resync(self):
+        events = EventStream(backlog=3)
+        for i in range(10):
+            events.publish('ev', i)
+        stream = events.subscribe(last_event_id='2')
+        next(stream)
+        self.assertEqual(_parse(next(stream)), [(7, 'resync', {}), (8, 'ev', 7), (9, 'ev', 8), (10, 'ev', 9)])
+        stream.close()
+
+    def test_keepalive_while_idle(self):
+        events = EventStream(keepalive_secs=0.01)
+        stream = events.subscribe()
+        next(stream)
+        self.assertEqual(next(stream), ': keepalive\n\n')
+        stream.close()
+
+    def test_close_ends_streams(self):
+        events = EventStream()
+        stream = events.subscribe()
+        next(stream)
+        result = []
+        reader = threading.Thread(target=lambda: result.extend(stream))
+        reader.start()
+        events.close()
+        reader.join(timeout=2)
+        self.assertFalse(reader.is_alive())
+        self.assertEqual(result, [])
+        self.assertEqual(events.subscriber_count(), 0)
+
+
+class TestEventStreamSubscribers(unittest.TestCase):
+    def test_subscribers_are_capped(self):
+        events = EventStream(max_subscribers=2)
+        first = events.subscribe()
+        second = events.subscribe()
+        # Counted even if the streams didn't start yet
+        self.assertEqual(events.subscriber_count(), 2)
+        self.assertIsNone(events.subscribe())
+        first.close()
+        third = events.subscribe()
+        self.assertIsNotNone(third)
+        second.close()
+        third.close()
+        self.assertEqual(events.subscriber_count(), 0)
+
+    def test_closing_twice_releases_once(self):
+        events = EventStream()
+        stream = events.subscribe()
+        other = events.subscribe()
+        next(stream)
+        stream.close()
+        stream.close()
+        self.assertEqual(events.subscriber_count(), 1)
+        other.close()
+
+    def test_finished_stream_is_released(self):
+        events = EventStream()
+        stream = events.subscribe()
+        next(stream)
+        events.close()
+        self.assertEqual(list(stream), [])
+        self.assertEqual(events.subscriber_count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
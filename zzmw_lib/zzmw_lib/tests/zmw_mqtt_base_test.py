@@ -0,0 +1,149 @@
+import json
+import unittest
+from unittest.mock import patch
+
+from zzmw_lib.zmw_mqtt_base import ZmwMqttBase
+
+
+class _Msg:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class _TestClient(ZmwMqttBase):
+    """ A client that is never connected: messages are delivered by calling _on_message """
+    def __init__(self):
+        super().__init__({})
+        self.client.subscribe = lambda *_args, **_kwargs: None
+        self.client.unsubscribe = lambda *_args, **_kwargs: None
+
+    def get_service_meta(self):
+        return {}
+
+    def deliver(self, topic, payload):
+        self._on_message(None, None, _Msg(topic, payload))
+
+
+class _Recorder:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, subtopic, payload):
+        self.calls.append((subtopic, payload))
+
+
+class _CountingDecoder:
+    def __init__(self, decode=json.loads):
+        self.decode = decode
+        self.decoded = []
+
+    def __call__(self, payload):
+        self.decoded.append(payload)
+        return self.decode(payload)
+
+
+class TestZmwMqttBaseOnMessage(unittest.TestCase):
+    def test_decoded_payload(self):
+        mqtt = _TestClient()
+        cb = _Recorder()
+        mqtt.subscribe_with_cb('a/b', cb)
+        mqtt.deliver('a/b/c', b'{"x": 1}')
+        self.assertEqual(cb.calls, [('c', {'x': 1})])
+
+    def test_unmatched_messages_are_never_decoded(self):
+        mqtt = _TestClient()
+        decoder = _CountingDecoder()
+        mqtt.set_json_decoder(decoder)
+        mqtt.subscribe_with_cb('a/b', _Recorder())
+        mqtt.deliver('a/x', b'{"x": 1}')
+        mqtt.deliver('b', b'{"x": 1}')
+        self.assertEqual(decoder.decoded, [])
+
+    def test_raw_only_subscribers_are_never_decoded(self):
+        mqtt = _TestClient()
+        decoder = _CountingDecoder()
+        mqtt.set_json_decoder(decoder)
+        cb = _Recorder()
+        mqtt.subscribe_with_cb('a/b', cb, raw_payload=True)
+        mqtt.deliver('a/b', b'{"x": 1}')
+        self.assertEqual(decoder.decoded, [])
+        self.assertEqual(cb.calls, [('', b'{"x": 1}')])
+
+    def test_raw_subscribers_get_the_original_bytes(self):
+        mqtt = _TestClient()
+        raw = _Recorder()
+        decoded = _Recorder()
+        mqtt.subscribe_with_cb('a/b', raw, replace=False, raw_payload=True)
+        mqtt.subscribe_with_cb('a/b', decoded, replace=False)
+        mqtt.deliver('a/b/c', b'{"x":  1}')
+        self.assertEqual(raw.calls, [('c', b'{"x":  1}')])
+        self.assertEqual(decoded.calls, [('c', {'x': 1})])
+
+    def test_custom_decoder_is_used(self):
+        mqtt = _TestClient()
+        mqtt.set_json_decoder(_CountingDecoder(lambda payload: ('decoded', payload)))
+        cb = _Recorder()
+        mqtt.subscribe_with_cb('a/b', cb)
+        mqtt.deliver('a/b', b'hello')
+        self.assertEqual(cb.calls, [('', ('decoded', b'hello'))])
+
+    def test_payload_is_decoded_once_for_all_subscribers(self):
+        mqtt = _TestClient()
+        decoder = _CountingDecoder()
+        mqtt.set_json_decoder(decoder)
+        cb1, cb2 = _Recorder(), _Recorder()
+        mqtt.subscribe_with_cb('a', cb1, replace=False)
+        mqtt.subscribe_with_cb('a', cb2, replace=False)
+        mqtt.deliver('a/b', b'[1]')
+        self.assertEqual(len(decoder.decoded), 1)
+        self.assertEqual(cb1.calls + cb2.calls, [('b', [1]), ('b', [1])])
+
+    def test_non_json_payload_still_reaches_raw_subscribers(self):
+        mqtt = _TestClient()
+        raw = _Recorder()
+        decoded = _Recorder()
+        mqtt.subscribe_with_cb('a/b', decoded, replace=False)
+        mqtt.subscribe_with_cb('a/b', raw, replace=False, raw_payload=True)
+        with self.assertLogs('ZmwMqtt', level='WARNING') as logs:
+            mqtt.deliver('a/b', b'not json')
+        self.assertEqual(raw.calls, [('', b'not json')])
+        self.assertEqual(decoded.calls, [])
+        self.assertIn("Ignoring non-json message with topic 'a/b'", '\n'.join(logs.output))
+
+    def test_non_json_payload_doesnt_stop_later_messages(self):
+        mqtt = _TestClient()
+        cb = _Recorder()
+        mqtt.subscribe_with_cb('a/b', cb)
+        with self.assertLogs('ZmwMqtt', level='WARNING'):
+            mqtt.deliver('a/b', b'{')
+        mqtt.deliver('a/b', b'{}')
+        self.assertEqual(cb.calls, [('', {})])
+
+    def test_failing_callback_doesnt_stop_the_others(self):
+        mqtt = _TestClient()
+        def _fail(_subtopic, _payload):
+            raise RuntimeError('boom')
+        before, after = _Recorder(), _Recorder()
+        mqtt.subscribe_with_cb('a/b', before, replace=False)
+        mqtt.subscribe_with_cb('a/b', _fail, replace=False)
+        mqtt.subscribe_with_cb('a/b', after, replace=False)
+        with self.assertLogs('ZmwMqtt', level='CRITICAL') as logs:
+            mqtt.deliver('a/b', b'{}')
+        self.assertEqual(before.calls, [('', {})])
+        self.assertEqual(after.calls, [('', {})])
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('boom', logs.output[0])
+
+    def test_service_discovery_pings_arent_routed(self):
+        mqtt = _TestClient()
+        decoder = _CountingDecoder()
+        mqtt.set_json_decoder(decoder)
+        with patch.object(mqtt, 'on_service_discovery_ping') as ping:
+            mqtt.deliver('svc_ping_bcast', b'{}')
+        ping.assert_called_once()
+        self.assertEqual(decoder.decoded, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+""" Server-sent events, so that web UIs can be pushed updates instead of polling """
+
+from collections import deque
+import json
+import logging
+import threading
+
+from .logs import build_logger
+
+log = build_logger("WwwEvents", logging.INFO)
+
+
+def _format_sse(event_id, event, data):
+    lines = [f'id: {event_id}', f'event: {event}']
+    lines.extend(f'data: {line}' for line in data.splitlines() or [''])
+    return '\n'.join(lines) + '\n\n'
+
+
+class EventStream:
+    """
+    Fan out of events to any number of SSE clients. Each event gets an increasing id, and the last few events are
+    kept so that a client that reconnects (sending Last-Event-ID) won't miss events published while it was
+    disconnected. If it missed more events than that, it gets a 'resync' event, and should reload its state.
+
+    Each connected client holds a www server thread, so the number of clients is capped.
+    """
+
+    def __init__(self, backlog=100, max_subscribers=20, keepalive_secs=15):
+        self._cond = threading.Condition()
+        # (id, formatted event). Protected by self._cond
+        self._backlog = deque(maxlen=backlog)
+        self._last_id = 0
+        self._subscribers = 0
+        self._closed = False
+        self._max_subscribers = max_subscribers
+        self._keepalive_secs = keepalive_secs
+
+    def publish(self, event, data):
+        """ Push an event to all subscribers. data should be json serializable. """
+        payload = json.dumps(data, default=str)
+        with self._cond:
+            self._last_id += 1
+            self._backlog.append((self._last_id, _format_sse(self._last_id, event, payload)))
+            self._cond.notify_all()
+
+    def subscriber_count(self):
+        with self._cond:
+            return self._subscribers
+
+    def close(self):
+        """ Ends all streams, so that the www server can shut down """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def subscribe(self, last_event_id=None):
+        """ Returns an iterator of formatted SSE events, or None if there are too many subscribers already. The
+        subscriber is counted from now until the iterator is exhausted or closed (the www server closes it once the
+        client leaves), even if it's never iterated. """
+        with self._cond:
+            if self._subscribers >= self._max_subscribers:
+                log.warning("Rejecting event stream subscriber, already serving %d", self._subscribers)
+                return None
+            self._subscribers += 1
+            next_id = self._last_id + 1
+            if last_event_id is not None and last_event_id.isdigit() and int(last_event_id) <= self._last_id:
+                next_id = int(last_event_id) + 1
+        return _Subscription(self._stream(next_id), self._unsubscribe)
+
+    def _unsubscribe(self):
+        with self._cond:
+            self._subscribers -= 1
+
+    def _stream(self, next_id):
+        # Tell the client how long to wait before reconnecting
+        yield 'retry: 2000\n\n'
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed or self._last_id >= next_id,
+                                    timeout=self._keepalive_secs)
+                if self._closed:
+                    return
+                pending = [ev for ev_id, ev in self._backlog if ev_id >= next_id]
+                if len(self._backlog) != 0 and self._backlog[0][0] > next_id:
+                    pending.insert(0, _format_sse(self._backlog[0][0] - 1, 'resync', '{}'))
+                next_id = self._last_id + 1
+            if len(pending) == 0:
+                # Comment line: keeps proxies from closing the connection, and lets us notice the client left
+                yield ': keepalive\n\n'
+            else:
+                yield ''.join(pending)
+
+
+class _Subscription:
+    """ Events of a subscriber. Calls on_close exactly once, when the events run out or when it's closed. """
+
+    def __init__(self, events, on_close):
+        self._events = events
+        self._on_close = on_close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._events)
+        except StopIteration:
+            self.close()
+            raise
+
+    def close(self):
+        self._events.close()
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            on_close()
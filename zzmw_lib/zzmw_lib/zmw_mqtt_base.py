@@ -1,11 +1,23 @@
 from abc import ABC, abstractmethod
 from .logs import build_logger
-from paho.mqtt import publish as mqtt_bcast
+from .metrics import get_metrics_registry
+from .mqtt_dispatcher import MqttCallbackDispatcher, OVERLOAD_BLOCK, record_callback_run, validate_overload_policy
+from .mqtt_publisher import MqttPublisher
+from .mqtt_trace import MqttTrace, activate_trace, current_trace
+from .mqtt_topic_trie import MqttTopicTrie, mqtt_topic_to_filter
 import json
 import logging
 from datetime import datetime, date
 import paho.mqtt.client as mqtt
 import threading
+import time
+
+try:
+    # Optional: a faster JSON decoder, if installed
+    import orjson
+    _default_json_decoder = orjson.loads
+except ImportError:
+    _default_json_decoder = json.loads
 
 # Configure third-party library log levels (they use root logger's handlers)
 logging.getLogger('paho').setLevel(logging.INFO)
@@ -15,6 +27,31 @@ logging.getLogger("apscheduler.scheduler").setLevel(logging.ERROR)
 
 log = build_logger("ZmwMqtt", logging.INFO)
 
+_metrics = get_metrics_registry()
+_msgs_in = _metrics.counter('mqtt_messages_in_total', 'MQTT messages received, by first topic level', ('prefix',))
+_msgs_out = _metrics.counter('mqtt_messages_out_total', 'MQTT messages sent, by first topic level', ('prefix',))
+
+
+class _MqttCallback:
+    """ A subscription callback, whether it wants the payload as raw bytes or as a decoded JSON, and what to do
+    with its messages if callback workers are overloaded. Compares equal to the callback it wraps, so callers can
+    unsubscribe by callback. """
+    __slots__ = ('cb', 'raw_payload', 'overload_policy')
+
+    def __init__(self, cb, raw_payload, overload_policy):
+        self.cb = cb
+        self.raw_payload = raw_payload
+        self.overload_policy = overload_policy
+
+    def __eq__(self, other):
+        if isinstance(other, _MqttCallback):
+            return self.cb == other.cb
+        return self.cb == other
+
+    def __hash__(self):
+        return hash(self.cb)
+
+
 class ZmwMqttBase(ABC):
     """ Base ZmwMqtt client for ZmwServices: announces to other clients when this client is up, and provides access
     to mqtt topics """
@@ -40,15 +77,39 @@ class ZmwMqttBase(ABC):
         self.client.on_subscribe = self._on_subscribe
         self.client.on_unsubscribe = self._on_unsubscribe
         self.client.on_message = self._on_message
+        self.client.on_publish = self._on_publish
         self.bg_thread = None
+        self._net_thread = None
+
+        # Outgoing messages are published through self.client, via a send queue
+        self._publisher = MqttPublisher(self.client,
+                                        max_queued=cfg.get('mqtt_publish_queue_size', 1000),
+                                        max_inflight=cfg.get('mqtt_publish_max_inflight', 50))
 
         # Mqtt topics we'll subscribe to
         self._topics_with_cb_lock = threading.Lock()
-        self._topics_with_cb = {}
+        self._topics_with_cb = MqttTopicTrie()
+        self._json_decoder = _default_json_decoder
+
+        # Optionally, run callbacks in a pool of workers instead of in the mqtt network thread
+        self._cb_dispatcher = None
+        if cfg.get('mqtt_callback_workers', 0) > 0:
+            self._cb_dispatcher = MqttCallbackDispatcher(
+                n_workers=cfg['mqtt_callback_workers'],
+                max_queued=cfg.get('mqtt_callback_queue_size', 1000),
+                coalesce_above=cfg.get('mqtt_callback_coalesce_above'))
+
+        # Responses to a message published later than this are logged, with a breakdown of where the time went
+        self._trace_slow_ms = cfg.get('mqtt_trace_slow_ms', 250)
+
+        _metrics.register_collector('mqtt_publisher', self.get_publish_stats)
+        if self._cb_dispatcher is not None:
+            _metrics.register_collector('mqtt_callbacks', self.get_callback_stats)
 
     def loop_forever(self):
         """ Connects to MQTT and starts the net loop. Doesn't return until stop is called """
         log.info('Connecting to MQTT broker [%s]:%d in client only mode...', self._mqtt_ip, self._mqtt_port)
+        self._net_thread = threading.current_thread()
         self.client.connect(self._mqtt_ip, self._mqtt_port, 10)
         self.client.loop_forever()
 
@@ -63,6 +124,9 @@ class ZmwMqttBase(ABC):
 
         # Announce this service is leaving
         self.broadcast(self._global_svc_discovery_leaving_topic, self.get_service_meta())
+        # If stop is called from the network thread (eg from a signal handler) acks will never arrive, so only wait
+        # until the messages are handed over to the client
+        self.flush(wait_for_acks=(threading.current_thread() is not self._net_thread))
 
         self.client.disconnect()
         if self.bg_thread:
@@ -74,8 +138,29 @@ class ZmwMqttBase(ABC):
             if isinstance(obj, (datetime, date)):
                 return obj.isoformat()
             raise TypeError(f"Type {type(obj)} not serializable")
+        # If this is the response to an incoming message, time since the last traced stage was spent in callbacks
+        trace = current_trace()
+        if trace is not None:
+            trace.mark('callback')
         msg = json.dumps(msg, default=_serialize)
-        mqtt_bcast.single(qos=1, hostname=self._mqtt_ip, port=self._mqtt_port, topic=topic, payload=msg)
+        _msgs_out.inc(prefix=topic.partition('/')[0])
+        self._publisher.publish(topic, msg)
+        if trace is not None:
+            trace.on_published()
+
+    def flush(self, timeout=5, wait_for_acks=True):
+        """ Blocks until all pending broadcasts have been sent (or until timeout) """
+        return self._publisher.flush(timeout=timeout, wait_for_acks=wait_for_acks)
+
+    def get_publish_stats(self):
+        """ Send queue depth and publish latency stats """
+        return self._publisher.get_stats()
+
+    def get_callback_stats(self):
+        """ Queue depth and per-callback latency stats, if callbacks run in workers (None otherwise) """
+        if self._cb_dispatcher is None:
+            return None
+        return self._cb_dispatcher.get_stats()
 
     def on_service_discovery_ping(self):
         """ Global request for service announcements """
@@ -90,15 +175,17 @@ class ZmwMqttBase(ABC):
 
         client.subscribe(self._global_svc_discovery_ping_topic, qos=1)
 
-        self._topics_with_cb_lock = threading.Lock()
         with self._topics_with_cb_lock:
-            for topic in self._topics_with_cb.keys():
-                client.subscribe(f'{topic}/#', qos=1)
+            for topic_filter in self._topics_with_cb.get_filters():
+                client.subscribe(topic_filter, qos=1)
 
         # Announce we're up and running
         log.info('Running MQTT listener thread, client mode only')
         self.on_service_discovery_ping()
 
+    def _on_publish(self, client, userdata, mid, reason_code, props):
+        self._publisher.on_publish(client, userdata, mid, reason_code, props)
+
     def _on_disconnect(self, _client, _userdata, _disconnect_flags, _ret_code, _props):
         log.info('Disconnected from MQTT broker [%s]:%d', self._mqtt_ip, self._mqtt_port)
 
@@ -109,40 +196,90 @@ class ZmwMqttBase(ABC):
         log.info('MQTT client [%s]:%d unsubscribed (reason %s)',
                  self._mqtt_ip, self._mqtt_port, str(reason_code))
 
-    def subscribe_with_cb(self, topic, cb):
+    def set_json_decoder(self, decoder):
+        """ Replace the function used to decode incoming payloads. decoder receives bytes, and should raise a
+        ValueError or TypeError if the payload isn't valid. By default orjson is used, if it's installed. """
+        self._json_decoder = decoder
+
+    def subscribe_with_cb(self, topic, cb, replace=True, exact=False, raw_payload=False,
+                          overload_policy=OVERLOAD_BLOCK):
+        """ Subscribe to a topic and everything under it (or to a topic filter, if topic has a + or # wildcard). cb
+        will receive (subtopic, payload). If replace, any other callback for this topic is discarded, otherwise the
+        topic may have multiple callbacks. If exact, only this topic (and not its subtopics) is subscribed; cb will
+        receive an empty subtopic. If raw_payload, cb receives the payload bytes instead of a decoded JSON.
+
+        If callbacks run in workers (cfg mqtt_callback_workers > 0), messages for the same topic are handled in
+        order. overload_policy decides what happens when workers can't keep up: block the mqtt thread, drop the
+        message or coalesce it (for state topics: once the worker queue is above cfg mqtt_callback_coalesce_above,
+        keep only the latest pending message for this topic). """
+        validate_overload_policy(overload_policy)
+        topic_filter = topic if exact else mqtt_topic_to_filter(topic)
         with self._topics_with_cb_lock:
-            if topic in self._topics_with_cb:
+            if replace and topic_filter in self._topics_with_cb:
                 log.warning(f"Topic {topic} already has a callback, will replace it")
-            self._topics_with_cb[topic] = cb
-            log.info("MQTT subscribing to '%s'", topic)
-            # If not subscribed this is a noop, but it will be repeated when connecting
-            self.client.subscribe(topic)
+            is_new = self._topics_with_cb.add(topic_filter, _MqttCallback(cb, raw_payload, overload_policy),
+                                              replace=replace)
+            if is_new:
+                log.info("MQTT subscribing to '%s'", topic_filter)
+                # If not subscribed this is a noop, but it will be repeated when connecting
+                self.client.subscribe(topic_filter, qos=1)
+
+    def unsubscribe_cb(self, topic, cb=None, exact=False):
+        """ Remove a callback (or all callbacks, if cb is None) for a topic. Will unsubscribe from the topic if no
+        callbacks are left. """
+        topic_filter = topic if exact else mqtt_topic_to_filter(topic)
+        with self._topics_with_cb_lock:
+            if topic_filter not in self._topics_with_cb:
+                return
+            if self._topics_with_cb.remove(topic_filter, cb):
+                log.info("MQTT unsubscribing from '%s'", topic_filter)
+                self.client.unsubscribe(topic_filter)
 
     def _on_message(self, _client, _userdata, msg):
+        t_arrival = time.monotonic()
         topic = msg.topic
+        _msgs_in.inc(prefix=topic.partition('/')[0])
         if topic.startswith(self._global_svc_discovery_ping_topic):
             return self.on_service_discovery_ping()
 
-        try:
-            parsed_msg = json.loads(msg.payload)
-        except (TypeError, json.JSONDecodeError):
-            log.warning(f"Ignoring non-json message with topic '%s'", topic)
+        # Route before decoding, so that messages nobody wants don't pay for a decode. Don't hold the lock while
+        # running callbacks, they may (un)subscribe
+        with self._topics_with_cb_lock:
+            prefix, cbs = self._topics_with_cb.match(topic)
+        if len(cbs) == 0:
+            log.error(f"Unhandeld message with topic '%s'", topic)
             return
+        trace = MqttTrace(topic, t_arrival, self._trace_slow_ms)
+        trace.mark('routing')
 
-        try:
-            for (t, cb) in self._topics_with_cb.items():
-                if t[-2:] == '/#':
-                    # This topic has an mqtt wildcard, it fininshes with 'topic/#'. Don't check the wildcard.
-                    t = t[:-2]
-                if topic.startswith(t):
-                    subtopic = topic[len(t) + len('/'):]
-                    return cb(subtopic, parsed_msg)
-            # Fall-through: received unhandled message
-        except Exception as ex:  # pylint: disable=broad-except
-            log.critical(
-                'Error on MQTT message handling. Topic %s, payload %s. '
-                'Ex: {%s}', msg.topic, msg.payload, ex, exc_info=True)
+        parsed_msg = None
+        if any(not sub.raw_payload for sub in cbs):
+            try:
+                parsed_msg = self._json_decoder(msg.payload)
+            except (TypeError, ValueError):
+                log.warning(f"Ignoring non-json message with topic '%s'", topic)
+                cbs = [sub for sub in cbs if sub.raw_payload]
+        trace.mark('decode')
+
+        subtopic = topic[len(prefix) + len('/'):]
+        if self._cb_dispatcher is not None:
+            for sub in cbs:
+                args = (subtopic, msg.payload if sub.raw_payload else parsed_msg)
+                self._cb_dispatcher.submit(topic, sub.cb, args, sub.overload_policy, trace)
             return
 
-        log.error(f"Unhandeld message with topic '%s'", topic)
+        # A failing callback shouldn't stop the others for the same message from running
+        prev_trace = activate_trace(trace)
+        try:
+            for sub in cbs:
+                t_start = time.monotonic()
+                try:
+                    sub.cb(subtopic, msg.payload if sub.raw_payload else parsed_msg)
+                except Exception as ex:  # pylint: disable=broad-except
+                    log.critical(
+                        'Error on MQTT message handling. Topic %s, payload %s. '
+                        'Ex: {%s}', msg.topic, msg.payload, ex, exc_info=True)
+                record_callback_run(sub.cb, 1000 * (time.monotonic() - t_start))
+        finally:
+            activate_trace(prev_trace)
 